@@ -0,0 +1,339 @@
+######################################################################
+#
+# All files associated with the OpenFlow Python Switch (ofps) are
+# made available for public use and benefit with the expectation
+# that others will use, modify and enhance the Software and contribute
+# those enhancements back to the community. However, since we would
+# like to make the Software available for broadest use, with as few
+# restrictions as possible permission is hereby granted, free of
+# charge, to any person obtaining a copy of this Software to deal in
+# the Software under the copyrights without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject
+# to the following conditions:
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT.  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# 
+######################################################################
+
+"""
+Tuple space search classifier for flow tables
+
+Flows are grouped into subtables by their compiled match mask, the
+set of key bits their match compares (see flow.match_mask).  Within
+a subtable each flow is hashed on its compiled match value, so
+matching a packet against a subtable is one AND and a dictionary
+lookup.
+Lookup visits the subtables in order of the highest priority flow
+they hold and stops as soon as no remaining subtable could beat the
+best match found so far.
+
+Packet lookups take no lock.  Writers (serialized by the table's
+flow_sync) never change a structure a reader may be walking: the
+per-value flow lists and the subtable order are tuples that are
+rebuilt and swapped in with a single assignment, so a lookup racing
+with an update sees the classifier either before or after it.
+"""
+
+import random
+import unittest
+
+import oftest.cstruct as ofp
+import oftest.message as message
+from oftest.packet import Packet
+from oftest.packet import ascii_ip_to_bin
+import flow as ofps_flow
+
+class Subtable(object):
+    """
+    The flows sharing one match mask
+    """
+    def __init__(self, mask):
+        self.mask = mask
+        # value -> tuple of flows, highest priority first
+        self.flows = {}
+        # priority -> number of flows in this subtable at that priority
+        self.priorities = {}
+        self.max_priority = -1
+        self.count = 0
+
+    def insert(self, flow):
+        """
+        Add a flow; equal priorities keep insertion order
+        """
+        flows = self.flows.get(flow.value, ())
+        priority = flow.flow_mod.priority
+        idx = len(flows)
+        while idx > 0 and flows[idx - 1].flow_mod.priority < priority:
+            idx -= 1
+        self.flows[flow.value] = flows[:idx] + (flow,) + flows[idx:]
+        self.priorities[priority] = self.priorities.get(priority, 0) + 1
+        if priority > self.max_priority:
+            self.max_priority = priority
+        self.count += 1
+
+    def remove(self, flow):
+        """
+        Remove a flow
+        @return True if the subtable's max_priority changed
+        """
+        flows = self.flows[flow.value]
+        idx = flows.index(flow)
+        if len(flows) == 1:
+            del self.flows[flow.value]
+        else:
+            self.flows[flow.value] = flows[:idx] + flows[idx + 1:]
+        priority = flow.flow_mod.priority
+        self.priorities[priority] -= 1
+        self.count -= 1
+        if self.priorities[priority] == 0:
+            del self.priorities[priority]
+            if priority == self.max_priority:
+                if self.priorities:
+                    self.max_priority = max(self.priorities.keys())
+                else:
+                    self.max_priority = -1
+                return True
+        return False
+
+    def lookup(self, key):
+        """
+        Return the highest priority flow matching the packet key
+        @param key The flow.key_bits() of the packet's key
+        """
+        flows = self.flows.get(key & self.mask)
+        if flows:
+            return flows[0]
+        return None
+
+    def __len__(self):
+        return self.count
+
+class Classifier(object):
+    """
+    A set of flows organized for packet lookup by tuple space search
+    """
+    def __init__(self):
+        # mask -> Subtable
+        self.subtables = {}
+        # (max_priority, subtable) pairs, highest first; replaced, never
+        # modified, so lookups can iterate it unlocked.  The priorities
+        # are those of the last reorder: a remove lowers the subtable's
+        # own max_priority before the new order is in place, and a
+        # lookup breaking early on the lowered value could skip a
+        # subtable still sorted after it, while the old, higher value is
+        # only an over-estimate.
+        self.ordered = ()
+        # The union of the subtable masks: every key bit some flow
+        # compares
+        self.fields = 0
+
+    def _reorder(self):
+        self.ordered = tuple(sorted([(subtable.max_priority, subtable)
+                                     for subtable in self.subtables.values()],
+                                    key=lambda entry: entry[0],
+                                    reverse=True))
+        fields = 0
+        for (max_priority, subtable) in self.ordered:
+            fields |= subtable.mask
+        self.fields = fields
+
+    def insert(self, flow):
+        """
+        Add a flow to the classifier
+        @param flow A FlowEntry with its mask and value set
+        """
+        subtable = self.subtables.get(flow.mask)
+        if subtable is None:
+            # Fill the subtable before readers can see it
+            subtable = Subtable(flow.mask)
+            subtable.insert(flow)
+            self.subtables[flow.mask] = subtable
+            self._reorder()
+            return
+        old_max = subtable.max_priority
+        subtable.insert(flow)
+        if subtable.max_priority != old_max:
+            self._reorder()
+
+    def remove(self, flow):
+        """
+        Remove a flow from the classifier
+        """
+        subtable = self.subtables[flow.mask]
+        if subtable.remove(flow):
+            if len(subtable) == 0:
+                del self.subtables[flow.mask]
+            self._reorder()
+
+    def lookup(self, key):
+        """
+        Return the highest priority flow matching a packet, or None
+        @param key The flow.key_bits() of the packet's key
+        """
+        found = None
+        for (max_priority, subtable) in self.ordered:
+            if (found is not None and 
+                    max_priority <= found.flow_mod.priority):
+                break
+            flow = subtable.lookup(key)
+            if flow is not None and (found is None or 
+                    flow.flow_mod.priority > found.flow_mod.priority):
+                found = flow
+        return found
+
+    def find_strict(self, match):
+        """
+        Return the list of flows whose match is identical to match
+        
+        Identical means the same compiled mask and value; the caller
+        still checks priority, cookie and the like.
+        @param match The match structure of a flow_mod
+        """
+        mask = ofps_flow.match_mask(match)
+        subtable = self.subtables.get(mask)
+        if subtable is None:
+            return []
+        value = ofps_flow.match_key(match) & mask
+        return list(subtable.flows.get(value, ()))
+
+    def __len__(self):
+        return sum([len(subtable) for subtable in self.subtables.values()])
+
+class classifier_test(unittest.TestCase):
+    """
+    Compare classifier lookups with a scan of the flows in priority order
+    """
+    ADDRS = ['10.0.0.1', '10.0.1.1', '10.1.0.1', '192.168.0.1']
+
+    def flow(self, priority, in_port=None, nw_src=None, nw_dst=None,
+             tp_dst=None):
+        """
+        Return a FlowEntry; nw_src and nw_dst are (address, prefix length)
+        """
+        flow_mod = message.flow_mod()
+        flow_mod.priority = priority
+        match = flow_mod.match
+        match.wildcards = ofp.OFPFW_ALL & ~ofp.OFPFW_DL_TYPE
+        match.dl_src_mask = [0xff] * 6
+        match.dl_dst_mask = [0xff] * 6
+        match.dl_type = 0x800
+        match.nw_src_mask = 0xffffffff
+        match.nw_dst_mask = 0xffffffff
+        if in_port is not None:
+            match.wildcards &= ~ofp.OFPFW_IN_PORT
+            match.in_port = in_port
+        if nw_src is not None:
+            match.nw_src = nw_src[0]
+            match.nw_src_mask = 0xffffffff >> nw_src[1]
+        if nw_dst is not None:
+            match.nw_dst = nw_dst[0]
+            match.nw_dst_mask = 0xffffffff >> nw_dst[1]
+        if tp_dst is not None:
+            match.wildcards &= ~ofp.OFPFW_TP_DST
+            match.tp_dst = tp_dst
+        flow = ofps_flow.FlowEntry()
+        flow.flow_mod_set(flow_mod)
+        return flow
+
+    def random_flow(self):
+        def prefix():
+            if self.rand.random() < 0.3:
+                return None
+            addr = self.rand.choice(self.ADDRS)
+            return (ascii_ip_to_bin(addr), 
+                    self.rand.choice([8, 16, 24, 32]))
+        return self.flow(self.rand.randint(1, 5),
+                         in_port=self.rand.choice([None, 1, 2]),
+                         nw_src=prefix(), nw_dst=prefix(),
+                         tp_dst=self.rand.choice([None, 22, 80]))
+
+    def random_key(self):
+        pkt = Packet().simple_tcp_packet(
+            ip_src=self.rand.choice(self.ADDRS),
+            ip_dst=self.rand.choice(self.ADDRS),
+            tcp_dport=self.rand.choice([22, 80, 443]))
+        pkt = Packet(in_port=self.rand.choice([1, 2, 3]), data=pkt.data)
+        return ofps_flow.key_bits(pkt.key)
+
+    def check_lookups(self, classifier, flows):
+        for i in range(300):
+            key = self.random_key()
+            matching = [flow for flow in flows 
+                        if key & flow.mask == flow.value]
+            found = classifier.lookup(key)
+            if not matching:
+                self.assertEqual(found, None)
+                continue
+            # Equal priorities may overlap; any of the top ones will do
+            best = max([flow.flow_mod.priority for flow in matching])
+            self.assertTrue(found in matching)
+            self.assertEqual(found.flow_mod.priority, best)
+
+    def setUp(self):
+        self.rand = random.Random(1)
+        self.classifier = Classifier()
+        self.flows = []
+        for i in range(200):
+            flow = self.random_flow()
+            self.classifier.insert(flow)
+            self.flows.append(flow)
+
+    def runTest(self):
+        self.assertEqual(len(self.classifier), len(self.flows))
+        self.check_lookups(self.classifier, self.flows)
+
+class classifier_remove_test(classifier_test):
+    def runTest(self):
+        for flow in self.rand.sample(self.flows, 120):
+            self.classifier.remove(flow)
+            self.flows.remove(flow)
+        self.assertEqual(len(self.classifier), len(self.flows))
+        self.check_lookups(self.classifier, self.flows)
+        # The top flows going must lower the subtables' max_priority
+        for flow in [flow for flow in self.flows 
+                     if flow.flow_mod.priority == 5]:
+            self.classifier.remove(flow)
+            self.flows.remove(flow)
+        self.check_lookups(self.classifier, self.flows)
+        for flow in self.flows:
+            self.classifier.remove(flow)
+        self.assertEqual(len(self.classifier), 0)
+        self.assertEqual(self.classifier.subtables, {})
+        self.assertEqual(self.classifier.lookup(self.random_key()), None)
+
+class classifier_remove_race_test(classifier_test):
+    def runTest(self):
+        classifier = Classifier()
+        top = self.flow(10, tp_dst=22)
+        matching = self.flow(7, nw_src=(ascii_ip_to_bin('10.0.0.0'), 24))
+        for flow in [self.flow(12, in_port=2), self.flow(5, in_port=1),
+                     top, self.flow(3, tp_dst=22), matching]:
+            classifier.insert(flow)
+        pkt = Packet().simple_tcp_packet(ip_src='10.0.0.1', tcp_dport=22)
+        key = ofps_flow.key_bits(Packet(in_port=1, data=pkt.data).key)
+        self.assertEqual(classifier.lookup(key), top)
+        # A lookup between the subtable update and the reorder
+        self.assertTrue(classifier.subtables[top.mask].remove(top))
+        self.assertEqual(classifier.lookup(key), matching)
+        classifier._reorder()
+        self.assertEqual(classifier.lookup(key), matching)
+
+class classifier_strict_test(classifier_test):
+    def runTest(self):
+        for flow in self.flows:
+            found = self.classifier.find_strict(flow.flow_mod.match)
+            same = [other for other in self.flows 
+                    if other.mask == flow.mask and other.value == flow.value]
+            self.assertEqual(sorted(found), sorted(same))
+        # A match no flow has
+        flow = self.flow(1, in_port=7)
+        self.assertEqual(self.classifier.find_strict(flow.flow_mod.match), [])
@@ -235,6 +235,8 @@ def flow_stats_request(switch, msg, rawmsg):
     @param rawmsg The actual packet received as a string
     """
     switch.logger.debug("Received flow_stats_request from controller")
+    if switch.workers is not None:
+        switch.workers.counters_sync()
     reply = switch.pipeline.flow_stats_get(msg,switch.groups)
     if not reply : 
         switch.logger.error("Got None reply from switch.pipeline.flow_stats_get(); dropping request")
@@ -304,7 +306,9 @@ def group_mod(switch, msg, rawmsg):
     @param rawmsg The actual packet received as a string
     """
     switch.logger.debug("Received group_mod from controller")
-    switch.groups.update(msg)
+    error = switch.pipeline.group_mod_process(msg, switch.groups)
+    if error:
+        switch.controller.message_send(error)
 
 def group_mod_failed_error_msg(switch, msg, rawmsg):
     """
@@ -376,6 +380,9 @@ def port_mod(switch, msg, rawmsg):
                 port.curr = port.advertise
                 #@todo update port.curr and call to ioctl() to actually change
                 #the port's speed
+            switch.ports_update()
+            if switch.workers is not None:
+                switch.workers.update(('ports', switch.ports))
         else:
             err =  ofutils.of_error_msg_make(ofp.OFPET_PORT_MOD_FAILED, ofp.OFPPMFC_BAD_HW_ADDR, msg)
     except IndexError:
@@ -411,6 +418,10 @@ def port_stats_request(switch, msg, rawmsg):
     @param rawmsg The actual packet received as a string
     """
     switch.logger.debug("Received port_stats_request from controller")
+    if switch.workers is not None:
+        switch.workers.counters_sync()
+    for reply in switch.dataplane.port_stats_get(msg):
+        switch.controller.message_send(reply)
 
 def port_status(switch, msg, rawmsg):
     """
@@ -441,6 +452,8 @@ def queue_get_config_request(switch, msg, rawmsg):
     @param rawmsg The actual packet received as a string
     """
     switch.logger.debug("Received queue_get_config_request from controller")
+    reply = switch.dataplane.queue_config_get(msg)
+    switch.controller.message_send(reply)
 
 def queue_op_failed_error_msg(switch, msg, rawmsg):
     """
@@ -468,6 +481,8 @@ def queue_stats_request(switch, msg, rawmsg):
     @param rawmsg The actual packet received as a string
     """
     switch.logger.debug("Received queue_stats_request from controller")
+    reply = switch.dataplane.queue_stats_get(msg)
+    switch.controller.message_send(reply)
 
 def set_config(switch, msg, rawmsg):
     """
@@ -525,6 +540,8 @@ def table_stats_request(switch, msg, rawmsg):
     @param rawmsg The actual packet received as a string
     """
     switch.logger.debug("Received table_stats_request from controller")
+    if switch.workers is not None:
+        switch.workers.counters_sync()
     reply = switch.pipeline.table_stats_get(msg)
     if reply :
         switch.logger.debug("Sending table_stats_reply")
@@ -28,6 +28,8 @@ import traceback
 
 import oftest.cstruct as ofp
 import oftest.message as message
+import oftest.instruction as instruction
+from oftest.packet import Packet, ACTION_SET_ORDINAL
 
 
 """
@@ -77,3 +79,97 @@ def packet_in_to_controller(switch, packet, reason=ofp.OFPR_NO_MATCH,
     msg.table_id = table_id
     switch.controller.message_send(msg)
 
+
+def action_function(action):
+    """
+    Return the Packet method implementing an action, or None
+    The method is called as function(packet, action, switch)
+    """
+    return getattr(Packet, action.__class__.__name__, None)
+
+def actions_compile(actions):
+    """
+    Compile an action list into a list of (function, action) steps,
+    run in order as function(packet, action, switch)
+    @param actions The action_list of an instruction or group bucket
+    """
+    log = logging.getLogger('execute_actions')
+    steps = []
+    for action in actions.actions:
+        function = action_function(action)
+        if function is None:
+            log.error("Could not compile packet action %s" % 
+                      action.__class__.__name__)
+            continue
+        steps.append((function, action))
+    return steps
+
+class Program(object):
+    """
+    A flow's instruction list compiled for execution
+
+    steps: list of (function, arg), run in order as
+        function(packet, arg, switch)
+    replay: the steps that change the packet itself, as opposed to
+        its action set; what a cached decision has to re-run
+    goto: the goto_table target, or None
+    """
+    def __init__(self):
+        self.steps = []
+        self.replay = []
+        self.goto = None
+
+def _write_actions(packet, (slots, bits), switch):
+    action_set = packet.action_set
+    for idx, action in slots:
+        action_set[idx] = action
+    packet.action_set_bits |= bits
+
+def _clear_actions(packet, arg, switch):
+    packet.clear_actions()
+
+def _write_metadata(packet, (metadata, mask), switch):
+    packet.set_metadata(metadata, mask)
+
+def instructions_compile(instructions):
+    """
+    Compile a list of instructions into a Program
+    Instructions keep their order; consecutive write_actions are
+    merged into a single precomputed update of the action set slots.
+    @param instructions The list of instruction objects of a flow_mod
+    """
+    log = logging.getLogger('execute_actions')
+    program = Program()
+    for inst in instructions:
+        if inst.__class__ == instruction.instruction_apply_actions:
+            steps = actions_compile(inst.actions)
+            program.steps.extend(steps)
+            program.replay.extend(steps)
+        elif inst.__class__ == instruction.instruction_write_actions:
+            slots = {}
+            if program.steps and program.steps[-1][0] is _write_actions:
+                slots = dict(program.steps.pop()[1][0])
+            for action in inst.actions.actions:
+                idx = ACTION_SET_ORDINAL.get(action.__class__)
+                if idx is None:
+                    log.error("Could not compile write action %s" %
+                              action.__class__.__name__)
+                    continue
+                slots[idx] = action
+            bits = 0
+            for idx in slots:
+                bits |= 1 << idx
+            program.steps.append((_write_actions, (slots.items(), bits)))
+        elif inst.__class__ == instruction.instruction_clear_actions:
+            program.steps.append((_clear_actions, None))
+        elif inst.__class__ == instruction.instruction_write_metadata:
+            step = (_write_metadata, (inst.metadata, inst.metadata_mask))
+            program.steps.append(step)
+            program.replay.append(step)
+        elif inst.__class__ == instruction.instruction_goto_table:
+            program.goto = inst.table_id
+        elif inst.__class__ == instruction.instruction_experimenter:
+            log.error("Got experimenter instruction")
+        else:
+            log.error("Bad instruction")
+    return program
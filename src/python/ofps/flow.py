@@ -34,6 +34,8 @@ table.
 import oftest.cstruct as ofp
 import oftest.message as message
 import oftest.instruction as instruction
+from oftest.packet import LAYER_NONE, LAYER_L2, LAYER_L3, LAYER_L4
+from exec_actions import instructions_compile
 import copy
 import time
 import logging
@@ -56,42 +58,39 @@ def is_strict_cmd(command):
             command == ofp.OFPFC_DELETE_STRICT or
             command == ofp.OFPFC_ADD)
 
-def action_list_has_out_port(action_list, port, groups):
+def instructions_outputs(instructions):
     """
-    Return boolean indicating if the flow has a set output port
-    action for the given port.  Assumes port is not OFPP_ANY.
-    Called recursively on bucket action lists (so someone had
-    better check for loops in group lists elsewhere).
-    """
-    for action in action_list:
-        if action.__class__ == action.set_output:
-            if action.port == port:
-                return True
-        if action.__class__ == action.action_group:
-            group = groups.group_get(action.group_id)
-            for bucket in group.buckets:
-                # @todo Do we need to take into account bucket type?
-                if action_list_has_out_port(bucket.actions, port, groups):
-                    return True
-    return False
+    Return (ports, groups), the frozensets of the ports and group_ids
+    that the write and apply actions of an instruction list output to
+    """
+    ports = set()
+    groups = set()
+    for inst in instructions:
+        if inst.__class__ == instruction.instruction_write_actions or \
+                inst.__class__ == instruction.instruction_apply_actions:
+            for act in inst.actions:
+                if act.type == ofp.OFPAT_OUTPUT:
+                    ports.add(act.port)
+                elif act.type == ofp.OFPAT_GROUP:
+                    groups.add(act.group_id)
+    return (frozenset(ports), frozenset(groups))
 
 def flow_has_out_port(flow, port, groups):
     """
     Return boolean indicating if the flow has a set output port
-    action for the given port.  Assumes port is not OFPP_ANY.
+    action for the given port, directly or through its groups.
 
     NOTE: All groups and all group buckets are searched, not just
     active buckets.
     """
     if port == ofp.OFPP_ANY or port == ofp.OFPP_ALL:
         return True
-
-    for inst in flow.flow_mod.instructions:
-        if inst.__class__ == instruction.instruction_write_actions or \
-                inst.__class__ == instruction.instruction_apply_actions:
-            if action_list_has_out_port(inst.actions, port, groups):
-                return True
-
+    if port in flow.out_ports:
+        return True
+    for group_id in flow.out_groups:
+        # @todo Do we need to take into account bucket type?
+        if groups.group_has_out_port(group_id, port):
+            return True
     return False
 
 def flow_has_cookie(flow, cookie):
@@ -104,32 +103,205 @@ def flow_has_cookie(flow, cookie):
         return True
     return False
         
-def action_list_has_out_group(action_list, group_id, groups):
-    """
-    Return boolean indicating if the action list has a group action
-    action for the given port.  Assumes group is not OFPG_ANY.
-    """
-    for action in action_list:
-        if action.__class__ == action.set_group:
-            if action.group_id == group_id:
-                return True
-            group = groups.group_get(action.group_id)
-            for bucket in group.buckets:
-                # @todo Do we need to take into account bucket type?
-                if action_list_has_out_group(bucket.actions, group_id, groups):
-                    return True
+def flow_has_out_group(flow, group_id, groups):
+    """
+    Return boolean indicating if the flow has a group action for the
+    given group, directly or through a chain of groups.
+    """
+    if group_id == ofp.OFPG_ANY:
+        return True
+    if group_id in flow.out_groups:
+        return True
+    for out_group in flow.out_groups:
+        if groups.group_has_out_group(out_group, group_id):
+            return True
     return False
 
-def flow_has_out_group(flow, group_id, groups):
+# Layout of the packed integer match key: (field, width in bits), most
+# significant first.  VLAN appears twice, as the VLAN id and as a
+# one bit "packet has a tag" flag, which is what OFPVID_ANY compares.
+MATCH_KEY_LAYOUT = [
+    ("metadata", 64),
+    ("in_port", 32),
+    ("dl_src", 48),
+    ("dl_dst", 48),
+    ("dl_vlan", 16),
+    ("has_vlan", 1),
+    ("dl_vlan_pcp", 8),
+    ("dl_type", 16),
+    ("mpls_label", 32),
+    ("mpls_tc", 8),
+    ("nw_tos", 8),
+    ("nw_proto", 8),
+    ("nw_src", 32),
+    ("nw_dst", 32),
+    ("tp_src", 16),
+    ("tp_dst", 16),
+    ]
+
+def _key_layout():
+    shifts = {}
+    masks = {}
+    shift = 0
+    for name, width in reversed(MATCH_KEY_LAYOUT):
+        shifts[name] = shift
+        masks[name] = ((1 << width) - 1) << shift
+        shift += width
+    return shifts, masks
+
+_SHIFT, _FIELD_MASK = _key_layout()
+
+# The packet header layer each key field is decoded from
+FIELD_LAYER = {
+    "metadata": LAYER_NONE,
+    "in_port": LAYER_NONE,
+    "dl_src": LAYER_L2,
+    "dl_dst": LAYER_L2,
+    "dl_vlan": LAYER_L2,
+    "has_vlan": LAYER_L2,
+    "dl_vlan_pcp": LAYER_L2,
+    "dl_type": LAYER_L2,
+    "mpls_label": LAYER_L2,
+    "mpls_tc": LAYER_L2,
+    "nw_tos": LAYER_L3,
+    "nw_proto": LAYER_L3,
+    "nw_src": LAYER_L3,
+    "nw_dst": LAYER_L3,
+    "tp_src": LAYER_L4,
+    "tp_dst": LAYER_L4,
+    }
+
+def _layer_masks():
+    masks = {}
+    for name, layer in FIELD_LAYER.items():
+        masks[layer] = masks.get(layer, 0) | _FIELD_MASK[name]
+    return sorted(masks.items(), reverse=True)
+
+# (layer, mask of the key bits decoded from it), deepest layer first
+_LAYER_MASKS = _layer_masks()
+
+def match_layer(mask):
     """
-    Return boolean indicating if the flow has a group action
-    action for the given port.  Assumes group is not OFPG_ANY.
+    Return the deepest packet header layer a key mask compares
+
+    A packet decoded up to this layer has every key field the mask
+    covers filled in.
+    @param mask A match_mask(), or several OR'd together
     """
-    for inst in flow.instructions:
-        if inst.__class__ == instruction.instruction_write_actions or \
-                inst.__class__ == instruction.instruction_apply_actions:
-            if action_list_has_out_group(inst.actions, group_id, groups):
-                return True
+    for layer, layer_mask in _LAYER_MASKS:
+        if mask & layer_mask:
+            return layer
+    return LAYER_NONE
+
+def mac_to_int(mac):
+    """
+    Convert a list of 6 bytes to an integer
+    """
+    value = 0
+    for byte in mac:
+        value = (value << 8) | byte
+    return value
+
+def match_key(match):
+    """
+    Return the packed integer key of a match structure
+
+    Every field in MATCH_KEY_LAYOUT is present, unmasked; AND the
+    key with a flow's match_mask() to compare it with the flow.
+    @param match The match structure, from a flow_mod or a parsed packet
+    """
+    return ((match.metadata << _SHIFT["metadata"]) |
+            (match.in_port << _SHIFT["in_port"]) |
+            (mac_to_int(match.dl_src) << _SHIFT["dl_src"]) |
+            (mac_to_int(match.dl_dst) << _SHIFT["dl_dst"]) |
+            (match.dl_vlan << _SHIFT["dl_vlan"]) |
+            (int(match.dl_vlan != ofp.OFPVID_NONE) << _SHIFT["has_vlan"]) |
+            (match.dl_vlan_pcp << _SHIFT["dl_vlan_pcp"]) |
+            (match.dl_type << _SHIFT["dl_type"]) |
+            (match.mpls_label << _SHIFT["mpls_label"]) |
+            (match.mpls_tc << _SHIFT["mpls_tc"]) |
+            (match.nw_tos << _SHIFT["nw_tos"]) |
+            (match.nw_proto << _SHIFT["nw_proto"]) |
+            (match.nw_src << _SHIFT["nw_src"]) |
+            (match.nw_dst << _SHIFT["nw_dst"]) |
+            (match.tp_src << _SHIFT["tp_src"]) |
+            (match.tp_dst << _SHIFT["tp_dst"]))
+
+def key_bits(key):
+    """
+    Return the packed integer key of a packet
+
+    The same as match_key(packet.match), read straight from the
+    packet's PacketKey without building a match structure.
+    @param key The packet's PacketKey, decoded at least as far as the
+    bits are compared
+    """
+    (in_port, metadata, dl_dst, dl_src, dl_vlan, dl_vlan_pcp, dl_type,
+     mpls_label, mpls_tc, nw_tos, nw_proto, nw_src, nw_dst,
+     tp_src, tp_dst) = key
+    return ((metadata << _SHIFT["metadata"]) |
+            (in_port << _SHIFT["in_port"]) |
+            (dl_src << _SHIFT["dl_src"]) |
+            (dl_dst << _SHIFT["dl_dst"]) |
+            (dl_vlan << _SHIFT["dl_vlan"]) |
+            (int(dl_vlan != ofp.OFPVID_NONE) << _SHIFT["has_vlan"]) |
+            (dl_vlan_pcp << _SHIFT["dl_vlan_pcp"]) |
+            (dl_type << _SHIFT["dl_type"]) |
+            (mpls_label << _SHIFT["mpls_label"]) |
+            (mpls_tc << _SHIFT["mpls_tc"]) |
+            (nw_tos << _SHIFT["nw_tos"]) |
+            (nw_proto << _SHIFT["nw_proto"]) |
+            (nw_src << _SHIFT["nw_src"]) |
+            (nw_dst << _SHIFT["nw_dst"]) |
+            (tp_src << _SHIFT["tp_src"]) |
+            (tp_dst << _SHIFT["tp_dst"]))
+
+def match_mask(match):
+    """
+    Return the packed integer mask of the key bits a flow compares
+
+    The rules are those of meta_match, l2_match and l3_match:
+    metadata is always compared in full (the two functions use
+    opposite halves of the mask), MPLS fields only for an exact MPLS
+    ethertype, PCP only for a tagged VLAN and the IP fields only for
+    dl_type 0x800.
+    @param match The match structure of a flow_mod
+    """
+    wildcards = match.wildcards
+    mask = _FIELD_MASK["metadata"]
+
+    def exact(bit, name):
+        if wildcards & bit:
+            return 0
+        return _FIELD_MASK[name]
+
+    mask |= exact(ofp.OFPFW_IN_PORT, "in_port")
+    mask |= ((~mac_to_int(match.dl_src_mask) << _SHIFT["dl_src"]) &
+             _FIELD_MASK["dl_src"])
+    mask |= ((~mac_to_int(match.dl_dst_mask) << _SHIFT["dl_dst"]) &
+             _FIELD_MASK["dl_dst"])
+    if not (wildcards & ofp.OFPFW_DL_VLAN):
+        if match.dl_vlan == ofp.OFPVID_ANY:
+            mask |= _FIELD_MASK["has_vlan"]
+        else:
+            mask |= _FIELD_MASK["dl_vlan"]
+        if match.dl_vlan != ofp.OFPVID_NONE:
+            mask |= exact(ofp.OFPFW_DL_VLAN_PCP, "dl_vlan_pcp")
+    if not (wildcards & ofp.OFPFW_DL_TYPE):
+        mask |= _FIELD_MASK["dl_type"]
+        if match.dl_type in (0x8847, 0x8848):
+            mask |= exact(ofp.OFPFW_MPLS_LABEL, "mpls_label")
+            mask |= exact(ofp.OFPFW_MPLS_TC, "mpls_tc")
+    if match.dl_type == 0x800:
+        mask |= exact(ofp.OFPFW_NW_TOS, "nw_tos")
+        mask |= exact(ofp.OFPFW_NW_PROTO, "nw_proto")
+        mask |= ((~match.nw_src_mask << _SHIFT["nw_src"]) &
+                 _FIELD_MASK["nw_src"])
+        mask |= ((~match.nw_dst_mask << _SHIFT["nw_dst"]) &
+                 _FIELD_MASK["nw_dst"])
+        mask |= exact(ofp.OFPFW_TP_SRC, "tp_src")
+        mask |= exact(ofp.OFPFW_TP_DST, "tp_dst")
+    return mask
 
 def meta_match(match_a, match_b):
     """
@@ -199,7 +371,8 @@ def l2_match(match_a, match_b):
                               (match_a.dl_vlan, match_b.dl_vlan))
             return False
         # @note check pcp only if there is a vlan tag 
-        if not (wildcards & ofp.OFPFW_DL_VLAN_PCP):
+        if (not (wildcards & ofp.OFPFW_DL_VLAN_PCP) and
+                match_a.dl_vlan != ofp.OFPVID_NONE):
             if match_a.dl_vlan_pcp != match_b.dl_vlan_pcp:
                 flow_logger.debug("Failed dl_vlan_pcp: %d vs %d" %
                                   (match_a.dl_vlan_pcp, match_b.dl_vlan_pcp))
@@ -268,7 +441,7 @@ def l3_match(match_a, match_b):
 
     return True
 
-def flow_match_strict(flow_a, flow_b, groups):
+def flow_match_strict(flow_a, flow_b):
     """
     Check if flows match strictly
     @param flow_a Primary key for cookie mask, etc
@@ -289,15 +462,6 @@ def flow_match_strict(flow_a, flow_b, groups):
         flow_logger.debug("Failed cookie: 0x%x vs 0x%x" % 
                           (flow_a.cookie, flow_b.cookie))
         return False
-    if is_delete_cmd(flow_a.command):
-        if (flow_a.out_port != ofp.OFPP_ANY):
-            if not flow_has_out_port(flow_b, flow_a.out_port, groups):
-                flow_logger.debug("Failed out_port" + str(flow_a.out_port))
-                return False
-        if (flow_a.out_group != ofp.OFPG_ANY):
-            if not flow_has_out_group(flow_b, flow_a.out_group, groups):
-                flow_logger.debug("Failed out_group" + str(flow_a.out_group))
-                return False
 
     if not l2_match(flow_a.match, flow_b.match):
         return False
@@ -312,26 +476,62 @@ def flow_match_strict(flow_a, flow_b, groups):
 
     return True
 
+class FlowCounters(object):
+    """
+    The statistics of a flow entry
+
+    Kept apart from the FlowEntry so that they survive a modify, which
+    installs a new entry in place of the old one; both entries share
+    the same counters, so a lookup racing with the swap still counts.
+    Only the forwarding thread, or the worker counter sync, writes
+    them, so they take no lock.
+    """
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.last_hit = None
+        # worker index -> (packets, bytes) when forwarding is sharded
+        # over worker processes (see workers.py)
+        self.worker_counters = None
+
 class FlowEntry(object):
     """
     Structure to track a flow table entry
     """
     def __init__(self):
         self.flow_mod = message.flow_mod()
-        self.last_hit = None
-        self.packets = 0
-        self.bytes = 0
+        self.counters = FlowCounters()
         self.insert_time = None
+        # Compiled match: the flow matches a packet whose
+        # match_key() ANDed with mask equals value
+        self.mask = None
+        self.value = None
+        # The instructions, compiled (see exec_actions.Program)
+        self.program = None
+        # Sequence number of this flow's live entry in its table's
+        # timeout heap, None if it has none
+        self.timer_seq = None
+        # Set by the table on insert; identical in every replica of
+        # the table since they apply the same updates in order
+        self.flow_id = None
+        # The ports and groups the instructions output to directly
+        self.out_ports = frozenset()
+        self.out_groups = frozenset()
 
     def flow_mod_set(self, flow_mod):
         """
         Set this flow entry's core flow_mod message
         """
         self.flow_mod = copy.deepcopy(flow_mod)
-        self.packets = 0
-        self.bytes = 0
+        self.mask = match_mask(self.flow_mod.match)
+        self.value = match_key(self.flow_mod.match) & self.mask
+        self.program = instructions_compile(
+            self.flow_mod.instructions.instructions)
+        self.out_ports, self.out_groups = instructions_outputs(
+            self.flow_mod.instructions.instructions)
+        self.counters = FlowCounters()
         self.insert_time = time.time()
-        self.last_hit = time.time() # important for idle expiration
+        self.counters.last_hit = time.time() # important for idle expiration
 
     def match_flow_mod(self, new_flow, groups):
         """
@@ -343,8 +543,17 @@ class FlowEntry(object):
             print("Check overlap set but not implemented")
             #@todo implement
 
+        if is_delete_cmd(new_flow.command):
+            if not flow_has_out_port(self, new_flow.out_port, groups):
+                flow_logger.debug("Failed out_port " + str(new_flow.out_port))
+                return False
+            if not flow_has_out_group(self, new_flow.out_group, groups):
+                flow_logger.debug("Failed out_group " +
+                                  str(new_flow.out_group))
+                return False
+
         if is_strict_cmd(new_flow.command):
-            return flow_match_strict(new_flow, self.flow_mod, groups)
+            return flow_match_strict(new_flow, self.flow_mod)
         
         # This just looks like a packet match from here.
         if not meta_match(new_flow.match, self.flow_mod.match):
@@ -363,43 +572,40 @@ class FlowEntry(object):
         Updates flow's counters if match occurs
         @param packet The packet object to match.  Assumes parse is up to date
         """
-
-        # Uncomment these for dump of matches being checked
-        # flow_logger.debug("Matching:\n" + packet.match.show())
-        # flow_logger.debug("Me:\n" + self.flow_mod.match.show())
-        if not meta_match(self.flow_mod.match, packet.match):
-            flow_logger.debug("packet match failed meta_match")
+        if not self.packet_matches(packet):
             return False
-        if (self.flow_mod.match.dl_vlan == ofp.OFPVID_NONE and 
-                (self.flow_mod.match.wildcards & ofp.OFPFMF_DL_VLAN) == 0):
-            self.flow_mod.match.dl_vlan_pcp = 9
-#        if ((self.flow_mod.match.dl_vlan == ofp.OFPVID_ANY) and
-#            (packet.match.dl_vlan != ofp.OFPVID_NONE)):
-#                self.flow_mod.match.dl_vlan_pcp = 0
-#                packet.match.dl_vlan = ofp.OFPVID_ANY
-#                packet.match.dl_vlan_pcp = 0
-        if not l2_match(self.flow_mod.match, packet.match):
-            flow_logger.debug("packet match failed l2_match")
-            return False
-        if self.flow_mod.match.dl_type == 0x800:
-            if not l3_match(self.flow_mod.match, packet.match):
-                flow_logger.debug("packet match failed l3_match")
-                return False
+        self.hit(packet)
+        return True
 
-        flow_logger.debug("Packet matched flow")
-        # Okay, if we get here, we have a match.
-        self.last_hit = time.time()
-        self.packets += 1
-        self.bytes += packet.bytes
+    def packet_matches(self, packet, key=None):
+        """
+        Return boolean indicating packet matches this flow entry
+        Does not touch the flow's counters
+        @param packet The packet object to match.  Assumes parse is up to date
+        @param key The key_bits() of the packet's key, if already computed
+        """
+        if key is None:
+            key = key_bits(packet.key)
+        return key & self.mask == self.value
 
-        return True
+    def hit(self, packet):
+        """
+        Update the flow's counters for a packet that matched it
+        @param packet The packet object that matched this flow
+        """
+        counters = self.counters
+        counters.last_hit = time.time()
+        counters.packets += 1
+        counters.bytes += packet.bytes
 
-    def expire(self):
+    def expire(self, now=None):
         """
         Check if this entry should be expired.  
         Returns True if so, False otherwise
+        @param now The current time, if already known
         """
-        now = time.time()
+        if now is None:
+            now = time.time()
         ret = None
         h_delta = 999999
         i_delta = 999999
@@ -407,8 +613,9 @@ class FlowEntry(object):
             h_delta = now - self.insert_time
             if h_delta > self.flow_mod.hard_timeout:
                 ret = ofp.OFPRR_HARD_TIMEOUT
-        if self.flow_mod.idle_timeout and self.last_hit:
-            i_delta = now - self.last_hit
+        last_hit = self.counters.last_hit
+        if self.flow_mod.idle_timeout and last_hit:
+            i_delta = now - last_hit
             if i_delta > self.flow_mod.idle_timeout:
                 ret = ofp.OFPRR_IDLE_TIMEOUT
 #        str = "-------- FLOWEXP: ht=%f it=%f h=%f i=%f" % (
@@ -424,6 +631,22 @@ class FlowEntry(object):
 #        flow_logger.error(str)
         return ret
     
+    def deadline(self):
+        """
+        Return the earliest time after which this flow may time out,
+        or None if it has no timeouts
+        A hit after this call can move the idle deadline later
+        """
+        deadline = None
+        if self.flow_mod.hard_timeout and self.insert_time:
+            deadline = self.insert_time + self.flow_mod.hard_timeout
+        last_hit = self.counters.last_hit
+        if self.flow_mod.idle_timeout and last_hit:
+            idle = last_hit + self.flow_mod.idle_timeout
+            if deadline is None or idle < deadline:
+                deadline = idle
+        return deadline
+
     def flow_stat_get(self):
         """
         Create a single flow_stat object representing this flow entry
@@ -443,8 +666,8 @@ class FlowEntry(object):
         stat.idle_timeout = self.flow_mod.idle_timeout
         stat.hard_timeout = self.flow_mod.hard_timeout
         stat.cookie = self.flow_mod.cookie
-        stat.packet_count = self.packets
-        stat.byte_count = self.bytes
+        stat.packet_count = self.counters.packets
+        stat.byte_count = self.counters.bytes
         stat.match = self.flow_mod.match
         stat.instructions = self.flow_mod.instructions
         return stat 
@@ -460,8 +683,8 @@ class FlowEntry(object):
         outstr = prefix + 'flow_entry\n'
         prefix += '  '
         outstr += self.flow_mod.show(prefix)
-        outstr += prefix + 'packets:   ' + str(self.packets)
-        outstr += prefix + 'bytes:     ' + str(self.bytes)
+        outstr += prefix + 'packets:   ' + str(self.counters.packets)
+        outstr += prefix + 'bytes:     ' + str(self.counters.bytes)
         outstr += prefix + 'in time:   ' + str(self.insert_time)
-        outstr += prefix + 'last hit:  ' + str(self.last_hit)
+        outstr += prefix + 'last hit:  ' + str(self.counters.last_hit)
         return outstr
@@ -30,75 +30,286 @@ The FlowTable class definition
 """
 
 import logging
+import bisect
+import heapq
+import random
+import unittest
+from collections import OrderedDict
 import flow as ofps_flow
+from classifier import Classifier
+from prefixtrie import PrefixIndex
 from threading import Lock
 import oftest.cstruct as ofp
 import oftest.message as message
+from oftest.packet import Packet
+from oftest.packet import ascii_ip_to_bin
 
-def prio_sort(entry_x, entry_y):
+class PriorityBuckets(object):
     """
-    Sort flow entries x and y by priority
-    return -1 if x.prio < y.prio, etc.
+    Flow entries kept in priority order
+
+    A sorted list of the priorities in use, each with its own bucket
+    of flows in insertion order.  Adding a flow costs a binary search
+    over the priorities; iteration yields the highest priority flows
+    first and is stable within a priority.
     """
-    if entry_x.flow_mod.priority > entry_y.flow_mod.priority:
-        return 1
-    if entry_x.flow_mod.priority < entry_y.flow_mod.priority:
-        return -1
-    return 0
+    def __init__(self):
+        self.priorities = []    # ascending
+        self.buckets = {}       # priority -> OrderedDict of flows
+        self.count = 0
+
+    def add(self, flow):
+        priority = flow.flow_mod.priority
+        bucket = self.buckets.get(priority)
+        if bucket is None:
+            bucket = OrderedDict()
+            self.buckets[priority] = bucket
+            bisect.insort(self.priorities, priority)
+        bucket[flow] = None
+        self.count += 1
+
+    def remove(self, flow):
+        priority = flow.flow_mod.priority
+        bucket = self.buckets[priority]
+        del bucket[flow]
+        if len(bucket) == 0:
+            del self.buckets[priority]
+            del self.priorities[bisect.bisect_left(self.priorities, 
+                                                   priority)]
+        self.count -= 1
+
+    def __iter__(self):
+        for priority in reversed(self.priorities):
+            for flow in self.buckets[priority]:
+                yield flow
+
+    def __len__(self):
+        return self.count
                 
 class FlowTable(object):
     """
     The flow table class
     """
 
-    def __init__(self, table_id=0):
-        self.flow_entries = []
+    def __init__(self, table_id=0, prefix_trie=True):
+        self.flow_entries = PriorityBuckets()
+        # The same flows, organized for packet and strict lookups
+        self.classifier = Classifier()
+        # Optional longest prefix match index, used for packet lookups
+        # while the flows differ only in their nw_src/nw_dst prefixes;
+        # it only holds a trie while it is in use
+        self.prefix_index = None
+        if prefix_trie:
+            self.prefix_index = PrefixIndex(self.classifier.lookup)
+        # The lookup match_packet uses; chosen by writers
+        self.packet_lookup = self.classifier.lookup
         self.table_id = table_id
+        # Serializes writers and stats; packet lookups take no lock
         self.flow_sync = Lock()
         self.logger = logging.getLogger("flowtable")
+        # Only written by the forwarding thread
         self.lookup_count = 0
         self.matched_count = 0
+        # If a set, every flow hit is added to it (see workers.py)
+        self.hit_log = None
+        self.next_flow_id = 0
+        self.flows_by_id = {}
+        # group_id -> set of the flows with a group action for it
+        self.group_refs = {}
+        # bumped on every insert and remove, so callers can tell
+        # whether the table contents changed
+        self.version = 0
+        # Min-heap of (deadline, seq, flow) for flows with timeouts.
+        # Entries whose seq no longer matches flow.timer_seq are stale
+        # (flow removed or re-armed) and are skipped when popped.
+        self.timeouts = []
+        self.timer_seq = 0
+        self.timer_stale = 0
         # by default, when a packet does not match the table
         # is send to controller -- OpenFlow Spec, A.3.3
         self.miss_policy = ofp.OFPTC_TABLE_MISS_CONTROLLER
 
-    def expire(self):
+    def expire(self, removed=None):
         """
         Run the expiration process on this table
-        Run through all flows in the table and call the expire
-        method.  Build a list of expired flows.
+        Only flows whose deadline has passed are looked at; those that
+        were hit since being armed get re-armed instead of removed.
+        @param removed If a list, the expired flows are appended to it
         @return A list of flow_removed messages, ready to send to controller
         """
         msgs = []
-        # @todo May be a better approach than sync'ing
+        now = time.time()
+        rearm = []
         self.flow_sync.acquire()
-        delete_list = []
-        for flow in self.flow_entries:
-            timeout = flow.expire()
-            if timeout is not None: # timeout == one of None, OFPRR_IDLE_TIMEOUT, or OFPRR_HARD_TIMEOUT
-                delete_list.append(flow)
-                if flow.flow_mod.flags & ofp.OFPFF_SEND_FLOW_REM:
-                    msg = message.flow_removed()
-                    msg.cookie = flow.flow_mod.cookie
-                    msg.priority = flow.flow_mod.priority
-                    msg.reason = timeout
-                    msg.table_id = self.table_id
-                    if flow.insert_time:
-                        duration = time.time() - flow.insert_time
-                    else:
-                        duration = 0
-                    msg.duration_sec = int(duration)
-                    msg.duration_nsec = (duration-msg.duration_sec) * 10e9
-                    msg.idle_timeout = flow.flow_mod.idle_timeout
-                    msg.packet_count = flow.packets
-                    msg.byte_count = flow.bytes
-                    msg.match = flow.flow_mod.match
-                    msgs.append(msg)
-        for flow in delete_list:
-            self.flow_entries.remove(flow)
+        while self.timeouts and self.timeouts[0][0] < now:
+            deadline, seq, flow = heapq.heappop(self.timeouts)
+            if flow.timer_seq != seq:
+                self.timer_stale -= 1
+                continue
+            flow.timer_seq = None
+            timeout = flow.expire(now)
+            if timeout is None: # idle deadline moved on by a hit
+                rearm.append(flow)
+                continue
+            self._flow_remove(flow)
+            if removed is not None:
+                removed.append(flow)
+            if flow.flow_mod.flags & ofp.OFPFF_SEND_FLOW_REM:
+                msgs.append(self._flow_removed_msg(flow, timeout, now))
+        # Re-arm after the loop so a deadline equal to now is not
+        # popped again in this pass
+        for flow in rearm:
+            self._timer_arm(flow)
+        self.flow_sync.release()
+        return msgs
+
+    def flows_remove_group(self, group_ids, removed=None):
+        """
+        Remove the flows with a group action for any of the given groups
+        Used when the groups are deleted
+        @param group_ids The deleted group_ids
+        @param removed If a list, the removed flows are appended to it
+        @return A list of flow_removed messages, ready to send to controller
+        """
+        msgs = []
+        now = time.time()
+        self.flow_sync.acquire()
+        flows = set()
+        for group_id in group_ids:
+            flows |= self.group_refs.get(group_id, set())
+        # Removed in flow_id order, the same in every replica
+        for flow in sorted(flows, key=lambda flow: flow.flow_id):
+            self._flow_remove(flow)
+            if removed is not None:
+                removed.append(flow)
+            if flow.flow_mod.flags & ofp.OFPFF_SEND_FLOW_REM:
+                msgs.append(self._flow_removed_msg(flow, 
+                                                   ofp.OFPRR_GROUP_DELETE, now))
         self.flow_sync.release()
         return msgs
 
+    def _flow_removed_msg(self, flow, reason, now):
+        """
+        Return a flow_removed message for a flow removed at time now
+        """
+        msg = message.flow_removed()
+        msg.cookie = flow.flow_mod.cookie
+        msg.priority = flow.flow_mod.priority
+        msg.reason = reason
+        msg.table_id = self.table_id
+        if flow.insert_time:
+            duration = now - flow.insert_time
+        else:
+            duration = 0
+        msg.duration_sec = int(duration)
+        msg.duration_nsec = (duration-msg.duration_sec) * 10e9
+        msg.idle_timeout = flow.flow_mod.idle_timeout
+        msg.packet_count = flow.counters.packets
+        msg.byte_count = flow.counters.bytes
+        msg.match = flow.flow_mod.match
+        return msg
+
+    def _timer_arm(self, flow):
+        """
+        Push the flow's next deadline on the timeout heap
+        @attention:  ASSUMES caller has the flow_sync lock!
+        """
+        deadline = flow.deadline()
+        if deadline is None:
+            return
+        self.timer_seq += 1
+        flow.timer_seq = self.timer_seq
+        heapq.heappush(self.timeouts, (deadline, flow.timer_seq, flow))
+
+    def _timer_disarm(self, flow):
+        """
+        Mark the flow's heap entry stale, compacting the heap once
+        stale entries make up most of it
+        @attention:  ASSUMES caller has the flow_sync lock!
+        """
+        if flow.timer_seq is None:
+            return
+        flow.timer_seq = None
+        self.timer_stale += 1
+        if self.timer_stale * 2 > len(self.timeouts):
+            self.timeouts = [entry for entry in self.timeouts 
+                             if entry[2].timer_seq == entry[1]]
+            heapq.heapify(self.timeouts)
+            self.timer_stale = 0
+
+    def _flow_insert(self, flow):
+        """
+        Add a flow to the table and to the lookup indexes
+        @attention:  ASSUMES caller has the flow_sync lock!
+        """
+        self.flow_entries.add(flow)
+        flow.flow_id = self.next_flow_id
+        self.next_flow_id += 1
+        self.flows_by_id[flow.flow_id] = flow
+        self.packet_lookup = self.classifier.lookup
+        self.classifier.insert(flow)
+        if self.prefix_index is not None:
+            self.prefix_index.insert(flow)
+        self._lookup_select()
+        self._timer_arm(flow)
+        for group_id in flow.out_groups:
+            self.group_refs.setdefault(group_id, set()).add(flow)
+        self.version += 1
+
+    def _flow_remove(self, flow):
+        """
+        Remove a flow from the table and from the lookup indexes
+        @attention:  ASSUMES caller has the flow_sync lock!
+        """
+        self.flow_entries.remove(flow)
+        del self.flows_by_id[flow.flow_id]
+        self.packet_lookup = self.classifier.lookup
+        self.classifier.remove(flow)
+        if self.prefix_index is not None:
+            self.prefix_index.remove(flow)
+        self._lookup_select()
+        self._timer_disarm(flow)
+        for group_id in flow.out_groups:
+            refs = self.group_refs[group_id]
+            refs.discard(flow)
+            if not refs:
+                del self.group_refs[group_id]
+        self.version += 1
+
+    def flows_remove(self, flow_ids):
+        """
+        Remove the flows with the given flow_ids, ignoring unknown ones
+        Used to replay removals decided by another replica of the table
+        """
+        self.flow_sync.acquire()
+        for flow_id in flow_ids:
+            flow = self.flows_by_id.get(flow_id)
+            if flow is not None:
+                self._flow_remove(flow)
+        self.flow_sync.release()
+
+    def _lookup_select(self):
+        """
+        Point packet_lookup at the best index for the current flows
+        Writers switch to the classifier, which is always correct,
+        while they update the other indexes.  The prefix trie is built
+        the first time it becomes the best index; the index drops it
+        itself once the flows stop qualifying.  While the table is down
+        to a single subtable the trie is kept up to date but unused, so
+        a table going back and forth between one and two subtables does
+        not rebuild it each time.
+        """
+        index = self.prefix_index
+        # With a single subtable the classifier is one hash lookup
+        if (index is not None and 
+                len(self.classifier.subtables) > 1 and
+                index.qualifies()):
+            if not index.built():
+                index.build(self.flow_entries)
+            self.packet_lookup = index.lookup
+        else:
+            self.packet_lookup = self.classifier.lookup
+
     def flow_mod_process(self, flow_mod, groups):
         """
         Update the flow table according to the operation
@@ -120,7 +331,9 @@ class FlowTable(object):
     def _match(self,flow_mod, groups):
         """ Return the set of flows that match this flow_mod and group
         
-        Strict vs. non-strict is done in the flow.match_flow_mod structure
+        Strict vs. non-strict is done in the flow.match_flow_mod structure;
+        strict operations only need to check the flows the classifier
+        holds under an identical match.
         @param flow_mod: a valid flow_mod
         @param groups: the group table
         @param strict: whether or not we are doing strict matching
@@ -128,8 +341,11 @@ class FlowTable(object):
         @return a list of flows that match the flow_mod
         """
         match_list = []    
-        # @todo Verify this will iterate in sorted order by priority
-        for flow in self.flow_entries:
+        if ofps_flow.is_strict_cmd(flow_mod.command):
+            candidates = self.classifier.find_strict(flow_mod.match)
+        else:
+            candidates = self.flow_entries
+        for flow in candidates:
             if flow.match_flow_mod(flow_mod, groups):
                 self.logger.debug("flow_mod matched in table " + 
                                   str(self.table_id))
@@ -148,9 +364,7 @@ class FlowTable(object):
         else:
             new_flow = ofps_flow.FlowEntry()
             new_flow.flow_mod_set(flow_mod)
-            # @todo Is there a sorted list insert operation?
-            self.flow_entries.append(new_flow)
-            self.flow_entries.sort(prio_sort)
+            self._flow_insert(new_flow)
             self.logger.debug(
                     "Installing flow into table %d: now has %d entries" % 
                                   (flow_mod.table_id, len(self.flow_entries))
@@ -165,7 +379,14 @@ class FlowTable(object):
         if len(match_list) > 0 : 
             for flow in match_list:
                     self.logger.debug("Updating flow " + str(flow.flow_mod.cookie))
-                    flow.flow_mod_set(flow_mod)
+                    # Lookups run unlocked and may be using the old
+                    # entry, so install a new one before dropping it.
+                    # A modify keeps the flow's counters.
+                    new_flow = ofps_flow.FlowEntry()
+                    new_flow.flow_mod_set(flow_mod)
+                    new_flow.counters = flow.counters
+                    self._flow_insert(new_flow)
+                    self._flow_remove(flow)
         else:
             ret = (-1, ofp.OFPFMFC_BAD_MATCH) 
         self.flow_sync.release()
@@ -175,12 +396,10 @@ class FlowTable(object):
         ret = (0, None)
         del_count = 0
         self.flow_sync.acquire()
-        # this is O(n^2) in the worst case b/c
-        # list.remove() is O(n)
         #@todo add a test for common case, i.e., 
         #    if flow_mod.match == ALL, then self.flow_entries.clear()
         for flow in self._match(flow_mod, groups):
-            self.flow_entries.remove(flow)
+            self._flow_remove(flow)
             del_count+=1
         if del_count == 0:
             ret = (-1, ofp.OFPFMFC_BAD_MATCH) 
@@ -190,17 +409,18 @@ class FlowTable(object):
     def match_packet(self, packet):
         """
         Return a flow object if a match is found for the match structure
+        Runs without flow_sync: the lookup structures are only ever
+        swapped, never changed in place, so a lookup racing with a
+        flow_mod sees the table before or after it
         @packet An OFPS packet structure, already parsed
         """
-        found = None
-        self.flow_sync.acquire()
         self.lookup_count += 1
-        for flow in self.flow_entries:
-            if flow.match_packet(packet):
-                found = flow
-                self.matched_count +=1
-                break
-        self.flow_sync.release()
+        found = self.packet_lookup(ofps_flow.key_bits(packet.key))
+        if found is not None:
+            found.hit(packet)
+            self.matched_count +=1
+            if self.hit_log is not None:
+                self.hit_log.add(found)
         return found
     
     def flow_stats_get(self, flow_stats_request, groups):
@@ -218,9 +438,11 @@ class FlowTable(object):
         fake_flow_mod.match = flow_stats_request.match
         fake_flow_mod.command = ofp.OFPFC_MODIFY # non-strict!
         for flow in self.flow_entries:
-            # match the out_port
+            # match the out_port and out_group
             if ofps_flow.flow_has_out_port(flow, 
                                            flow_stats_request.out_port, groups) and \
+                    ofps_flow.flow_has_out_group(flow,
+                                           flow_stats_request.out_group, groups) and \
                     ofps_flow.flow_has_cookie(flow, 
                                               flow_stats_request.cookie) and \
                     flow.match_flow_mod(fake_flow_mod, groups):
@@ -233,3 +455,182 @@ class FlowTable(object):
     
     def __len__(self):
         return len(self.flow_entries)
+
+class flow_table_lookup_test(unittest.TestCase):
+    """
+    Check that packet lookups switch between the prefix trie and the
+    classifier as flows come and go, and agree with a priority scan
+    """
+    ADDRS = ['10.0.0.1', '10.0.0.2', '10.0.1.1', '10.1.0.1', '192.168.0.1']
+
+    def flow_mod(self, priority, nw_src, nw_dst, command=ofp.OFPFC_ADD,
+                 nw_src_mask=None, in_port=None):
+        """
+        Return a flow_mod; nw_src and nw_dst are (address, prefix length)
+        """
+        flow_mod = message.flow_mod()
+        flow_mod.command = command
+        flow_mod.priority = priority
+        flow_mod.out_port = ofp.OFPP_ANY
+        flow_mod.out_group = ofp.OFPG_ANY
+        match = flow_mod.match
+        match.wildcards = ofp.OFPFW_ALL & ~ofp.OFPFW_DL_TYPE
+        match.dl_src_mask = [0xff] * 6
+        match.dl_dst_mask = [0xff] * 6
+        match.dl_type = 0x800
+        (match.nw_src, length) = nw_src
+        match.nw_src_mask = 0xffffffff >> length
+        if nw_src_mask is not None:
+            match.nw_src_mask = nw_src_mask
+        (match.nw_dst, length) = nw_dst
+        match.nw_dst_mask = 0xffffffff >> length
+        if in_port is not None:
+            match.wildcards &= ~ofp.OFPFW_IN_PORT
+            match.in_port = in_port
+        return flow_mod
+
+    def add(self, *args, **kwargs):
+        flow_mod = self.flow_mod(*args, **kwargs)
+        self.assertEqual(self.table.flow_mod_process(flow_mod, None), 
+                         (0, None))
+        return flow_mod
+
+    def delete(self, flow_mod):
+        flow_mod.command = ofp.OFPFC_DELETE_STRICT
+        self.assertEqual(self.table.flow_mod_process(flow_mod, None), 
+                         (0, None))
+
+    def random_prefix(self):
+        length = self.rand.choice([0, 8, 16, 24, 30, 32])
+        addr = ascii_ip_to_bin(self.rand.choice(self.ADDRS))
+        return (addr & ~(0xffffffff >> length) & 0xffffffff, length)
+
+    def check_lookups(self):
+        for src in self.ADDRS:
+            for dst in self.ADDRS:
+                pkt = Packet().simple_tcp_packet(ip_src=src, ip_dst=dst)
+                pkt = Packet(in_port=1, data=pkt.data)
+                expected = None
+                for flow in self.table.flow_entries:
+                    if flow.packet_matches(pkt):
+                        expected = flow
+                        break
+                found = self.table.match_packet(pkt)
+                if expected is None:
+                    self.assertEqual(found, None)
+                else:
+                    self.assertEqual(found.flow_mod.priority, 
+                                     expected.flow_mod.priority)
+                    self.assertTrue(found.packet_matches(pkt))
+
+    def trie_used(self):
+        index = self.table.prefix_index
+        if self.table.packet_lookup == index.lookup:
+            self.assertTrue(index.built())
+            return True
+        self.assertEqual(self.table.packet_lookup, 
+                         self.table.classifier.lookup)
+        return False
+
+    def setUp(self):
+        self.rand = random.Random(1)
+        self.table = FlowTable()
+        self.flow_mods = []
+        for i in range(40):
+            self.flow_mods.append(self.add(self.rand.randint(1, 1000),
+                                           self.random_prefix(), 
+                                           self.random_prefix()))
+
+    def runTest(self):
+        self.assertTrue(self.trie_used())
+        self.check_lookups()
+        for flow_mod in self.rand.sample(self.flow_mods, 20):
+            self.delete(flow_mod)
+        self.assertTrue(self.trie_used())
+        self.check_lookups()
+
+class flow_table_irregular_test(flow_table_lookup_test):
+    def runTest(self):
+        # A non-contiguous mask drops the trie until the flow goes
+        irregular = self.add(2000, (ascii_ip_to_bin('10.0.0.1'), 32), 
+                             (ascii_ip_to_bin('10.0.0.1'), 32),
+                             nw_src_mask=0x00ff00ff)
+        self.assertFalse(self.trie_used())
+        self.check_lookups()
+        self.delete(irregular)
+        self.assertTrue(self.trie_used())
+        self.check_lookups()
+        # As does a flow comparing another field
+        other = self.add(2000, (0, 0), (0, 0), in_port=1)
+        self.assertFalse(self.trie_used())
+        self.check_lookups()
+        self.delete(other)
+        self.assertTrue(self.trie_used())
+        self.check_lookups()
+
+class flow_table_no_trie_test(flow_table_lookup_test):
+    def setUp(self):
+        self.rand = random.Random(1)
+        self.table = FlowTable()
+
+    def runTest(self):
+        # One subtable: the classifier is a single hash lookup
+        flow_mods = []
+        for src in self.ADDRS:
+            flow_mods.append(self.add(1, (ascii_ip_to_bin(src), 32), 
+                                      (ascii_ip_to_bin(src), 32)))
+        self.assertFalse(self.trie_used())
+        self.assertFalse(self.table.prefix_index.built())
+        self.check_lookups()
+        self.add(1, (0, 0), (0, 0))
+        self.assertTrue(self.trie_used())
+        trie = self.table.prefix_index.trie
+        for flow_mod in flow_mods:
+            self.delete(flow_mod)
+        self.assertFalse(self.trie_used())
+        self.check_lookups()
+        # The unused trie is kept up to date rather than rebuilt each
+        # time the table has two subtables again
+        for src in self.ADDRS:
+            flow_mod = self.add(2, (ascii_ip_to_bin(src), 32), (0, 0))
+            self.assertTrue(self.trie_used())
+            self.check_lookups()
+            self.delete(flow_mod)
+            self.assertFalse(self.trie_used())
+        self.assertTrue(self.table.prefix_index.trie is trie)
+        # A flow that does not qualify drops it
+        self.add(1, (0, 0), (0, 0), in_port=1)
+        self.assertFalse(self.table.prefix_index.built())
+        self.check_lookups()
+        # Tables that opt out never build one
+        table = FlowTable(prefix_trie=False)
+        self.assertEqual(table.prefix_index, None)
+
+class flow_table_modify_test(flow_table_lookup_test):
+    """
+    A modify replaces the entry but keeps its counters
+    """
+    def setUp(self):
+        self.table = FlowTable()
+
+    def runTest(self):
+        addr = ascii_ip_to_bin('10.0.0.1')
+        flow_mod = self.add(100, (addr, 32), (0, 0))
+        pkt = Packet().simple_tcp_packet(ip_src='10.0.0.1')
+        for i in range(3):
+            self.table.match_packet(Packet(in_port=1, data=pkt.data))
+        old = self.table.flows_by_id.values()[0]
+        last_hit = old.counters.last_hit
+        flow_mod.command = ofp.OFPFC_MODIFY_STRICT
+        flow_mod.cookie = 7
+        self.assertEqual(self.table.flow_mod_process(flow_mod, None), 
+                         (0, None))
+        self.assertEqual(len(self.table), 1)
+        new = self.table.flows_by_id.values()[0]
+        self.assertTrue(new is not old)
+        self.assertEqual(new.flow_mod.cookie, 7)
+        self.assertEqual(new.counters.packets, 3)
+        self.assertEqual(new.counters.bytes, 3 * len(pkt.data))
+        self.assertEqual(new.counters.last_hit, last_hit)
+        self.table.match_packet(Packet(in_port=1, data=pkt.data))
+        self.assertEqual(new.flow_stat_get().packet_count, 4)
@@ -0,0 +1,661 @@
+######################################################################
+#
+# All files associated with the OpenFlow Python Switch (ofps) are
+# made available for public use and benefit with the expectation
+# that others will use, modify and enhance the Software and contribute
+# those enhancements back to the community. However, since we would
+# like to make the Software available for broadest use, with as few
+# restrictions as possible permission is hereby granted, free of
+# charge, to any person obtaining a copy of this Software to deal in
+# the Software under the copyrights without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject
+# to the following conditions:
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT.  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# 
+######################################################################
+
+
+"""
+Group table and group execution
+
+Groups are compiled when they are installed: each bucket's action
+list becomes a list of (function, action) steps, like the
+apply_actions of a flow, and a SELECT group gets the cumulative
+weights of its buckets, so forwarding never walks the group_mod.
+Every bucket runs on a clone of the packet, which shares the packet
+buffer until the bucket rewrites it.
+
+Groups whose buckets point at other groups are resolved when a
+group_mod changes the chain: a bucket's group actions call the target
+Group directly, and each group knows every port and group its chain
+can output to, for the out_port/out_group filters of flow_mods and
+flow stats, and a group_mod that would make a chain loop is rejected
+with a set lookup per bucket group action.
+"""
+
+import bisect
+import logging
+import unittest
+
+import oftest.cstruct as ofp
+import oftest.message as message
+import oftest.action as action
+import oftest.bucket as bucket
+from oftest import ofutils
+from oftest.packet import Packet
+from oftest.packet import LAYER_L4
+from oftest.packet import ETHERTYPE_IP
+from oftest.packet import KEY_DL_DST, KEY_DL_TYPE, KEY_NW_PROTO
+from exec_actions import actions_compile
+
+class Bucket(object):
+    """
+    A group bucket compiled for execution
+
+    @arg bucket The bucket of the group_mod
+    @arg steps The bucket's actions as (function, action) steps, with
+    group actions resolved to their Group
+    @arg out_ports The ports the bucket's own actions output to
+    @arg out_groups The group_ids of the bucket's own group actions
+    """
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.weight = bucket.weight
+        self.watch_port = bucket.watch_port
+        self.watch_group = bucket.watch_group
+        self.compiled = actions_compile(bucket.actions)
+        self.steps = self.compiled
+        self.out_ports = set()
+        self.out_groups = set()
+        for function, action in self.compiled:
+            if action.type == ofp.OFPAT_OUTPUT:
+                self.out_ports.add(action.port)
+            elif action.type == ofp.OFPAT_GROUP:
+                self.out_groups.add(action.group_id)
+
+    def resolve(self, groups):
+        """
+        Bind the bucket's group actions to the Group objects they name
+        @param groups Dict of the installed groups, by group_id
+
+        An action for a group that is not installed stays a lookup in
+        the group table when it runs.
+        """
+        if not self.out_groups:
+            return
+        steps = []
+        for function, action in self.compiled:
+            if action.type == ofp.OFPAT_GROUP:
+                group = groups.get(action.group_id)
+                if group is not None:
+                    steps.append((_execute_group, group))
+                    continue
+            steps.append((function, action))
+        self.steps = steps
+
+    def run(self, packet, switch):
+        """
+        Execute the bucket's actions on the packet
+        """
+        for function, action in self.steps:
+            function(packet, action, switch)
+
+def _execute_group(packet, group, switch):
+    group.execute(packet, switch)
+
+class Group(object):
+    """
+    A group_mod compiled for execution
+
+    @arg group_mod The group_mod that installed the group
+    @arg buckets The compiled buckets, in order
+    @arg live_buckets Bitmap of the buckets whose watched port and group
+    are live
+    @arg refs The group_ids the buckets name in group actions
+    @arg out_ports All ports the group's chain outputs to
+    @arg out_groups All group_ids the group's chain reaches
+    @arg execute Runs the group on a packet, as execute(packet, switch);
+    the method for the group's type
+    """
+    def __init__(self, group_mod):
+        self.group_mod = group_mod
+        self.group_id = group_mod.group_id
+        self.type = group_mod.type
+        self.buckets = [Bucket(bucket) for bucket in group_mod.buckets]
+        # Bit i is set if bucket i is live; kept by GroupTable.liveness_update
+        self.live_buckets = 0
+        self.refs = set()
+        for bucket in self.buckets:
+            self.refs |= bucket.out_groups
+        # Resolved over the whole chain by GroupTable.chains_update
+        self.out_ports = frozenset()
+        self.out_groups = frozenset()
+        # SELECT: the buckets a hash can pick and the running total of
+        # their weights; if no bucket has a weight, all weigh the same
+        self.select_buckets = []
+        self.select_bounds = []
+        weighted = [bucket for bucket in self.buckets if bucket.weight > 0]
+        total = 0
+        for bucket in weighted or self.buckets:
+            total += bucket.weight or 1
+            self.select_buckets.append(bucket)
+            self.select_bounds.append(total)
+        self.select_total = total
+        self.execute = {
+            ofp.OFPGT_ALL: self.execute_all,
+            ofp.OFPGT_SELECT: self.execute_select,
+            ofp.OFPGT_INDIRECT: self.execute_indirect,
+            ofp.OFPGT_FF: self.execute_fast_failover,
+            }.get(self.type, self.execute_unknown)
+
+    def execute_all(self, packet, switch):
+        for bucket in self.buckets:
+            bucket.run(packet.clone(), switch)
+
+    def execute_select(self, packet, switch):
+        if not self.select_total:
+            return
+        if packet.decoded < LAYER_L4:
+            packet.decode(LAYER_L4)
+        key = packet.key
+        if key[KEY_DL_TYPE] == ETHERTYPE_IP:
+            # proto, nw_src, nw_dst, tp_src, tp_dst
+            flow = key[KEY_NW_PROTO:]
+        else:
+            # dl_dst, dl_src, dl_vlan, dl_vlan_pcp, dl_type
+            flow = key[KEY_DL_DST:KEY_DL_TYPE + 1]
+        idx = bisect.bisect(self.select_bounds, hash(flow) % self.select_total)
+        self.select_buckets[idx].run(packet.clone(), switch)
+
+    def execute_indirect(self, packet, switch):
+        if self.buckets:
+            self.buckets[0].run(packet.clone(), switch)
+
+    def execute_fast_failover(self, packet, switch):
+        live = self.live_buckets
+        if live:
+            # The lowest set bit is the first live bucket
+            self.buckets[(live & -live).bit_length() - 1].run(packet.clone(),
+                                                              switch)
+
+    def execute_unknown(self, packet, switch):
+        logging.getLogger("groups").error("Group %d has bad type %d" %
+                                          (self.group_id, self.type))
+
+class GroupTable(object):
+    """
+    Class to implement a group table object
+
+    Fast failover needs the liveness of each bucket on every packet.
+    The table keeps a bitmap of the live ports, and each group a bitmap
+    of its live buckets; both are recomputed when a group or a port
+    changes, never while forwarding.
+    """
+    def __init__(self):
+        """
+        Constructor for base class
+        Groups is a dict indexed by group_id with values Group objects
+        live_ports is a bitmap with bit port_no set for each live port
+        referrers is a dict indexed by group_id of the set of groups
+        with a group action for it, installed or not
+        """
+        self.groups = {}
+        self.live_ports = 0
+        self.referrers = {}
+        self.logger = logging.getLogger("groups")
+
+    def update(self, group_mod):
+        """
+        Execute the group_mod operation on the table
+        @return None on success, an ofp_error message on error
+        """
+        error = self.validate(group_mod)
+        if error is not None:
+            return error
+        # Changes go to a copy of the table that replaces it once its
+        # chains and bucket liveness are known
+        group_id = group_mod.group_id
+        if group_mod.command == ofp.OFPGC_DELETE and \
+                group_id == ofp.OFPG_ALL:
+            self.groups = {}
+            self.referrers = {}
+            return
+        groups = dict(self.groups)
+        old = groups.pop(group_id, None)
+        if old is not None:
+            for ref in old.refs:
+                self.referrers[ref].discard(group_id)
+        if group_mod.command != ofp.OFPGC_DELETE:
+            group = Group(group_mod)
+            groups[group_id] = group
+            for ref in group.refs:
+                self.referrers.setdefault(ref, set()).add(group_id)
+        self.chains_update(groups, group_id)
+        self.liveness_update(groups)
+        self.groups = groups
+        return None
+
+    def validate(self, group_mod):
+        """
+        Check an add or modify group_mod against the table
+        @return None if it may be applied, else an ofp_error message
+        """
+        group_id = group_mod.group_id
+        if group_mod.command == ofp.OFPGC_DELETE:
+            return None
+        code = None
+        if group_id > ofp.OFPG_MAX:
+            code = ofp.OFPGMFC_INVALID_GROUP
+        elif group_mod.command == ofp.OFPGC_ADD and group_id in self.groups:
+            code = ofp.OFPGMFC_GROUP_EXISTS
+        elif group_mod.command == ofp.OFPGC_MODIFY and \
+                group_id not in self.groups:
+            code = ofp.OFPGMFC_UNKNOWN_GROUP
+        else:
+            # A loop needs a path back to this group; the chains of
+            # the installed groups are already resolved
+            for bucket in group_mod.buckets:
+                for action in bucket.actions:
+                    if action.type != ofp.OFPAT_GROUP:
+                        continue
+                    if self.group_has_out_group(action.group_id, group_id):
+                        code = ofp.OFPGMFC_LOOP
+        if code is None:
+            return None
+        self.logger.error("Rejected group_mod for group %d: %s" %
+                          (group_id, ofp.ofp_group_mod_failed_code_map[code]))
+        return ofutils.of_error_msg_make(ofp.OFPET_GROUP_MOD_FAILED, code,
+                                         group_mod)
+
+    def chains_update(self, groups, group_id):
+        """
+        Resolve the chains of a changed group and of the groups that
+        lead to it; other groups are untouched
+        @param groups Dict of the installed groups, by group_id
+        @param group_id The group that was added, modified or deleted
+        """
+        affected = set()
+        pending = [group_id]
+        while pending:
+            gid = pending.pop()
+            if gid in affected:
+                continue
+            affected.add(gid)
+            pending.extend(self.referrers.get(gid, ()))
+        for gid in affected:
+            group = groups.get(gid)
+            if group is None:
+                continue
+            for bucket in group.buckets:
+                bucket.resolve(groups)
+            out_ports = set()
+            out_groups = set()
+            pending = [group]
+            while pending:
+                chained = pending.pop()
+                for bucket in chained.buckets:
+                    out_ports |= bucket.out_ports
+                    for ref in bucket.out_groups - out_groups:
+                        out_groups.add(ref)
+                        if ref in groups:
+                            pending.append(groups[ref])
+            group.out_ports = frozenset(out_ports)
+            group.out_groups = frozenset(out_groups)
+
+    def group_has_out_port(self, group_id, port):
+        """
+        Return True if the group's chain has an output action for port
+        """
+        group = self.groups.get(group_id)
+        return group is not None and port in group.out_ports
+
+    def group_has_out_group(self, group_id, out_group):
+        """
+        Return True if the group is out_group or its chain reaches it
+        """
+        if group_id == out_group:
+            return True
+        group = self.groups.get(group_id)
+        return group is not None and out_group in group.out_groups
+
+    def group_get(self, group_id):
+        """
+        Return the group_mod that installed group_id, or None
+        """
+        group = self.groups.get(group_id)
+        if group is None:
+            return None
+        return group.group_mod
+
+    def group_execute(self, group_id, packet, switch):
+        """
+        Run a group action on the packet
+        @param group_id The group to run
+        @param packet The packet; the buckets run on clones of it
+        @param switch The parent switch object
+        """
+        group = self.groups.get(group_id)
+        if group is None:
+            self.logger.error("Group action for unknown group %d" % group_id)
+            return
+        group.execute(packet, switch)
+
+    def ports_update(self, ports):
+        """
+        Rebuild the live port bitmap after a port was added or changed
+        @param ports The switch's ports, a dict of ofp_port by port_no
+
+        A port is live if neither it nor its link is down.
+        """
+        live_ports = 0
+        for port in ports.itervalues():
+            if port.config & ofp.OFPPC_PORT_DOWN:
+                continue
+            if port.state & ofp.OFPPS_LINK_DOWN:
+                continue
+            live_ports |= 1 << port.port_no
+        if live_ports != self.live_ports:
+            self.live_ports = live_ports
+            self.liveness_update()
+
+    def liveness_update(self, groups=None):
+        """
+        Recompute the live bucket bitmap of every group
+        @param groups The groups to update; the table's groups by default
+
+        A bucket is live if the port it watches is live and the group
+        it watches has a live bucket.  Liveness only grows from all
+        buckets dead, so chains of watched groups settle in a few
+        passes, and a watch loop leaves its buckets dead.
+        """
+        live_ports = self.live_ports
+        if groups is None:
+            groups = self.groups
+        # Computed aside, so forwarding never sees a half-done update
+        live_buckets = dict.fromkeys(groups, 0)
+        changed = True
+        while changed:
+            changed = False
+            for group_id, group in groups.iteritems():
+                live = 0
+                for idx, bucket in enumerate(group.buckets):
+                    if bucket.watch_port != ofp.OFPP_ANY and \
+                            not (live_ports >> bucket.watch_port) & 1:
+                        continue
+                    if bucket.watch_group != ofp.OFPG_ANY and \
+                            not live_buckets.get(bucket.watch_group):
+                        continue
+                    live |= 1 << idx
+                if live != live_buckets[group_id]:
+                    live_buckets[group_id] = live
+                    changed = True
+        for group_id, group in groups.iteritems():
+            group.live_buckets = live_buckets[group_id]
+
+    def group_stats_get(self, group_id):
+        """
+        Return an ofp_group_stats object for the group_id
+        """
+        return None
+
+class group_test(unittest.TestCase):
+    """
+    Run packets through groups; the test is its own switch and
+    dataplane, and records the ports each packet is sent to
+    """
+    def setUp(self):
+        self.logger = logging.getLogger("switch")
+        self.ports = {}
+        for port_no in range(1, 5):
+            port = ofp.ofp_port()
+            port.port_no = port_no
+            self.ports[port_no] = port
+        self.fwd_ports = frozenset(self.ports)
+        self.dataplane = self
+        self.sent = []
+        self.groups = GroupTable()
+        self.groups.ports_update(self.ports)
+
+    def send(self, port_no, data, queue_id=0):
+        self.sent.append(port_no)
+
+    def output(self, port_no):
+        act = action.action_output()
+        act.port = port_no
+        return act
+
+    def group(self, group_id):
+        act = action.action_group()
+        act.group_id = group_id
+        return act
+
+    def bucket(self, actions, weight=0, watch_port=ofp.OFPP_ANY,
+               watch_group=ofp.OFPG_ANY):
+        group_bucket = bucket.bucket()
+        group_bucket.weight = weight
+        group_bucket.watch_port = watch_port
+        group_bucket.watch_group = watch_group
+        for act in actions:
+            group_bucket.actions.add(act)
+        return group_bucket
+
+    def group_mod(self, group_id, group_type=ofp.OFPGT_ALL, buckets=[],
+                  command=ofp.OFPGC_ADD):
+        group_mod = message.group_mod()
+        group_mod.command = command
+        group_mod.group_id = group_id
+        group_mod.type = group_type
+        for group_bucket in buckets:
+            group_mod.buckets.add(group_bucket)
+        return group_mod
+
+    def add(self, group_id, group_type=ofp.OFPGT_ALL, buckets=[],
+            command=ofp.OFPGC_ADD):
+        group_mod = self.group_mod(group_id, group_type, buckets, command)
+        self.assertEqual(self.groups.update(group_mod), None)
+
+    def execute(self, group_id, tcp_sport=1234):
+        """
+        Run a TCP packet through a group
+        @return The ports it was sent to
+        """
+        pkt = Packet().simple_tcp_packet(tcp_sport=tcp_sport)
+        self.sent = []
+        self.groups.group_execute(group_id, Packet(in_port=1, data=pkt.data),
+                                  self)
+        return self.sent
+
+    def runTest(self):
+        self.add(1, ofp.OFPGT_ALL, [self.bucket([self.output(2)]),
+                                    self.bucket([self.output(3)])])
+        self.assertEqual(self.execute(1), [2, 3])
+        self.add(2, ofp.OFPGT_INDIRECT, [self.bucket([self.output(4)])])
+        self.assertEqual(self.execute(2), [4])
+        self.assertEqual(self.execute(3), [])
+
+class group_select_test(group_test):
+    def spread(self, group_id, n_flows=400):
+        """
+        Run two packets of each of n_flows flows through a group
+        @return Dict of the number of flows sent to each port
+        """
+        counts = {}
+        for tcp_sport in range(n_flows):
+            ports = self.execute(group_id, tcp_sport)
+            self.assertEqual(len(ports), 1)
+            # A flow sticks to its bucket
+            self.assertEqual(self.execute(group_id, tcp_sport), ports)
+            counts[ports[0]] = counts.get(ports[0], 0) + 1
+        return counts
+
+    def runTest(self):
+        # A bucket without weight is never picked when others have one
+        self.add(1, ofp.OFPGT_SELECT, [self.bucket([self.output(1)], 1),
+                                       self.bucket([self.output(2)], 3),
+                                       self.bucket([self.output(4)], 0)])
+        counts = self.spread(1)
+        self.assertEqual(sorted(counts), [1, 2])
+        self.assertTrue(80 < counts[1] < 120, counts)
+        picks = [self.execute(1, tcp_sport) for tcp_sport in range(50)]
+        # Unrelated group changes leave the picks alone
+        self.add(2, ofp.OFPGT_ALL, [self.bucket([self.output(3)])])
+        self.add(2, ofp.OFPGT_ALL, [self.bucket([self.output(4)])],
+                 ofp.OFPGC_MODIFY)
+        self.assertEqual([self.execute(1, tcp_sport) for tcp_sport 
+                          in range(50)], picks)
+        # With no weights at all, every bucket is picked alike
+        self.add(3, ofp.OFPGT_SELECT, [self.bucket([self.output(port_no)])
+                                       for port_no in [1, 2, 3, 4]])
+        counts = self.spread(3)
+        self.assertEqual(sorted(counts), [1, 2, 3, 4])
+        self.assertTrue(min(counts.values()) > 60, counts)
+        # An empty group drops
+        self.add(4, ofp.OFPGT_SELECT, [])
+        self.assertEqual(self.execute(4), [])
+
+
+class group_fast_failover_test(group_test):
+    def port_set(self, port_no, live):
+        if live:
+            self.ports[port_no].state &= ~ofp.OFPPS_LINK_DOWN
+        else:
+            self.ports[port_no].state |= ofp.OFPPS_LINK_DOWN
+        self.groups.ports_update(self.ports)
+
+    def runTest(self):
+        self.add(2, ofp.OFPGT_FF, [self.bucket([self.output(2)], 
+                                               watch_port=2)])
+        self.add(1, ofp.OFPGT_FF, [self.bucket([self.output(1)], 
+                                               watch_port=1),
+                                   self.bucket([self.output(2)], 
+                                               watch_group=2),
+                                   self.bucket([self.output(3)], 
+                                               watch_port=3)])
+        self.assertEqual(self.groups.live_ports, 0x1e)
+        self.assertEqual(self.groups.groups[1].live_buckets, 0x7)
+        self.assertEqual(self.execute(1), [1])
+        self.port_set(1, False)
+        self.assertEqual(self.groups.groups[1].live_buckets, 0x6)
+        self.assertEqual(self.execute(1), [2])
+        # The watched group has no live bucket left
+        self.port_set(2, False)
+        self.assertEqual(self.groups.groups[2].live_buckets, 0)
+        self.assertEqual(self.groups.groups[1].live_buckets, 0x4)
+        self.assertEqual(self.execute(1), [3])
+        self.ports[3].config |= ofp.OFPPC_PORT_DOWN
+        self.groups.ports_update(self.ports)
+        self.assertEqual(self.execute(1), [])
+        self.port_set(1, True)
+        self.assertEqual(self.execute(1), [1])
+        # A watched group that goes away takes its buckets down, and
+        # one that is added back brings them up
+        self.port_set(2, True)
+        self.groups.update(self.group_mod(2, command=ofp.OFPGC_DELETE))
+        self.assertEqual(self.groups.groups[1].live_buckets, 0x1)
+        self.add(2, ofp.OFPGT_FF, [self.bucket([self.output(2)], 
+                                               watch_port=2)])
+        self.assertEqual(self.groups.groups[1].live_buckets, 0x3)
+
+class group_watch_loop_test(group_fast_failover_test):
+    def runTest(self):
+        # Groups 3 and 4 watch each other; group 5 watches the loop
+        self.add(3, ofp.OFPGT_FF, [self.bucket([self.output(1)], 
+                                               watch_group=4)])
+        self.add(4, ofp.OFPGT_FF, [self.bucket([self.output(2)], 
+                                               watch_group=3),
+                                   self.bucket([self.output(3)], 
+                                               watch_port=3,
+                                               watch_group=3)])
+        self.add(5, ofp.OFPGT_FF, [self.bucket([self.output(4)], 
+                                               watch_group=3),
+                                   self.bucket([self.output(1)])])
+        for port_no in [3, 1, 3]:
+            self.port_set(port_no, False)
+            self.port_set(port_no, True)
+            for group_id in [3, 4]:
+                self.assertEqual(self.groups.groups[group_id].live_buckets, 0)
+                self.assertEqual(self.execute(group_id), [])
+            self.assertEqual(self.groups.groups[5].live_buckets, 0x2)
+            self.assertEqual(self.execute(5), [1])
+
+class group_chain_test(group_test):
+    def runTest(self):
+        # 1 -> 2 -> 3, with group 1 installed first
+        self.add(1, ofp.OFPGT_ALL, [self.bucket([self.group(2)]),
+                                    self.bucket([self.output(1)])])
+        self.assertEqual(self.execute(1), [1])
+        self.add(2, ofp.OFPGT_INDIRECT, [self.bucket([self.group(3)])])
+        self.add(3, ofp.OFPGT_INDIRECT, [self.bucket([self.output(2)])])
+        self.assertEqual(self.execute(1), [2, 1])
+        self.assertEqual(self.groups.groups[1].out_ports, set([1, 2]))
+        self.assertEqual(self.groups.groups[1].out_groups, set([2, 3]))
+        # Changing the end of the chain re-resolves every group on it
+        self.add(3, ofp.OFPGT_INDIRECT, [self.bucket([self.output(3)])],
+                 ofp.OFPGC_MODIFY)
+        self.assertEqual(self.execute(1), [3, 1])
+        self.assertTrue(self.groups.group_has_out_port(1, 3))
+        self.assertFalse(self.groups.group_has_out_port(1, 2))
+        self.assertTrue(self.groups.group_has_out_group(1, 3))
+        # The buckets call the installed Group objects
+        (function, target) = self.groups.groups[2].buckets[0].steps[0]
+        self.assertTrue(target is self.groups.groups[3])
+        # Deleting a group in the middle cuts the chain; adding it back
+        # restores it
+        self.groups.update(self.group_mod(2, command=ofp.OFPGC_DELETE))
+        self.assertEqual(self.execute(1), [1])
+        self.assertEqual(self.groups.groups[1].out_ports, set([1]))
+        self.assertEqual(self.groups.groups[1].out_groups, set([2]))
+        self.add(2, ofp.OFPGT_ALL, [self.bucket([self.group(3)]),
+                                    self.bucket([self.output(4)])])
+        self.assertEqual(self.execute(1), [3, 4, 1])
+        self.assertEqual(self.groups.groups[1].out_ports, set([1, 3, 4]))
+        self.assertEqual(self.groups.referrers[3], set([2]))
+        self.assertEqual(self.groups.referrers[2], set([1]))
+
+class group_error_test(group_test):
+    def check_error(self, group_mod, code):
+        groups = self.groups.groups
+        error = self.groups.update(group_mod)
+        self.assertTrue(isinstance(error, message.error))
+        self.assertEqual(error.type, ofp.OFPET_GROUP_MOD_FAILED)
+        self.assertEqual(error.code, code)
+        # The table is left as it was
+        self.assertTrue(self.groups.groups is groups)
+
+    def runTest(self):
+        self.add(1, ofp.OFPGT_INDIRECT, [self.bucket([self.group(2)])])
+        self.add(2, ofp.OFPGT_INDIRECT, [self.bucket([self.group(3)])])
+        self.check_error(self.group_mod(1), ofp.OFPGMFC_GROUP_EXISTS)
+        self.check_error(self.group_mod(4, command=ofp.OFPGC_MODIFY),
+                         ofp.OFPGMFC_UNKNOWN_GROUP)
+        self.check_error(self.group_mod(ofp.OFPG_MAX + 1), 
+                         ofp.OFPGMFC_INVALID_GROUP)
+        # A group may not reach itself, directly or down its chain,
+        # even through a group installed after the chain was
+        self.check_error(self.group_mod(4, ofp.OFPGT_INDIRECT,
+                                        [self.bucket([self.group(4)])]),
+                         ofp.OFPGMFC_LOOP)
+        self.check_error(self.group_mod(3, ofp.OFPGT_INDIRECT,
+                                        [self.bucket([self.group(1)])]),
+                         ofp.OFPGMFC_LOOP)
+        self.check_error(self.group_mod(2, ofp.OFPGT_ALL,
+                                        [self.bucket([self.output(1)]),
+                                         self.bucket([self.group(1)])],
+                                        ofp.OFPGC_MODIFY),
+                         ofp.OFPGMFC_LOOP)
+        self.assertEqual(sorted(self.groups.groups), [1, 2])
+        # Not a loop: two chains joining
+        self.add(3, ofp.OFPGT_INDIRECT, [self.bucket([self.output(1)])])
+        self.add(4, ofp.OFPGT_ALL, [self.bucket([self.group(2)]),
+                                    self.bucket([self.group(3)])])
+        self.assertEqual(self.execute(4), [1, 1])
@@ -0,0 +1,266 @@
+######################################################################
+#
+# All files associated with the OpenFlow Python Switch (ofps) are
+# made available for public use and benefit with the expectation
+# that others will use, modify and enhance the Software and contribute
+# those enhancements back to the community. However, since we would
+# like to make the Software available for broadest use, with as few
+# restrictions as possible permission is hereby granted, free of
+# charge, to any person obtaining a copy of this Software to deal in
+# the Software under the copyrights without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject
+# to the following conditions:
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT.  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# 
+######################################################################
+
+
+"""
+Ingress ring
+
+The ports share one bounded ingress ring.  Each port thread reads its
+interface a burst at a time and adds the burst to the ring under a
+single lock acquisition; the switch loop takes up to a burst of
+packets per wakeup.  When the ring is full a port first waits briefly
+for room (backpressure, leaving packets in the kernel's capture
+buffer) and then drops the packets that do not fit (drop tail).  Both
+are counted: the drops per port as rx_dropped.  Runt frames and
+failed reads are counted as rx_errors.
+"""
+
+import sys
+import select
+import socket
+import unittest
+from collections import deque
+from threading import Condition
+
+from oftest.oft_assert import oft_assert
+from oftest.dataplane import DataPlane
+from oftest.dataplane import DataPlanePort
+from portstats import PortCounters
+
+# Received packets held between the ports and the switch loop
+INGRESS_LIMIT = 4096
+# Packets read from an interface, or taken from the ring, per wakeup
+INGRESS_BURST = 64
+# Seconds a port waits for room in a full ring before dropping
+INGRESS_STALL = 0.01
+# Shortest frame received: an ethernet header
+INGRESS_MIN_FRAME = 14
+
+class IngressRing(object):
+    """
+    Bounded FIFO of (port, packet, time) between the port threads and
+    the switch loop, filled and drained a burst at a time
+    """
+    def __init__(self, limit=INGRESS_LIMIT):
+        self.limit = limit
+        self.packets = deque()
+        self.lock = Condition()
+        self.not_empty = Condition(self.lock)
+        self.not_full = Condition(self.lock)
+        # Packets dropped because the ring was full
+        self.dropped = 0
+        # Bursts that had to wait for room in the ring
+        self.stalls = 0
+        # Most packets the ring has held
+        self.high_water = 0
+
+    def put(self, burst):
+        """
+        Add a burst of received packets
+        @param burst A list of (port, packet, time)
+        @return The number of packets dropped for want of room
+        """
+        self.lock.acquire()
+        room = self.limit - len(self.packets)
+        if room < len(burst):
+            self.stalls += 1
+            self.not_full.wait(INGRESS_STALL)
+            room = self.limit - len(self.packets)
+        dropped = 0
+        if room < len(burst):
+            dropped = len(burst) - room
+            self.dropped += dropped
+            burst = burst[:room]
+        self.packets.extend(burst)
+        if len(self.packets) > self.high_water:
+            self.high_water = len(self.packets)
+        self.not_empty.notify()
+        self.lock.release()
+        return dropped
+
+    def get(self, max_count, timeout=None):
+        """
+        Take up to max_count packets, oldest first
+        @param timeout If positive and the ring is empty, wait up to
+        this many seconds for a packet
+        @return A list of (port, packet, time), empty on timeout
+        """
+        self.lock.acquire()
+        if not self.packets and timeout:
+            self.not_empty.wait(timeout)
+        packets = self.packets
+        count = min(max_count, len(packets))
+        burst = [packets.popleft() for i in xrange(count)]
+        if count:
+            self.not_full.notify_all()
+        self.lock.release()
+        return burst
+
+    def __str__(self):
+        return ("ingress ring: %d/%d packets, high water %d, "
+                "%d stalls, %d dropped" %
+                (len(self.packets), self.limit, self.high_water,
+                 self.stalls, self.dropped))
+
+class IngressPort(DataPlanePort):
+    """
+    A DataPlanePort that adds what it receives to its dataplane's
+    ingress ring, a burst at a time, instead of to its own list
+    """
+    def __init__(self, interface_name, port_number, parent):
+        DataPlanePort.__init__(self, interface_name, port_number, parent)
+        self.ring = parent.ingress
+        self.counters = parent.counters
+        self.burst = []
+
+    def pcap_cb(self, ts, pkt):
+        if len(pkt) < INGRESS_MIN_FRAME:
+            self.counters.rx_error(self.port_number)
+            return
+        self.burst.append((self.port_number, pkt, ts))
+
+    def run(self):
+        """
+        Activity function for class
+        """
+        self.running = True
+        self.socs = [self.pcap.fd]
+        while self.running:
+            try:
+                sel_in, sel_out, sel_err = \
+                    select.select(self.socs, [], [], 1)
+            except (StandardError, socket.error):
+                self.logger.error("Select error: " + str(sys.exc_info()))
+                break
+
+            if not self.running:
+                break
+
+            if not sel_in:
+                continue
+
+            self.burst = []
+            try:
+                self.pcap.dispatch(INGRESS_BURST, self.pcap_cb)
+            except OSError:
+                self.logger.error("Receive error: " + str(sys.exc_info()))
+                self.counters.rx_error(self.port_number)
+            if not self.burst:
+                continue
+            self.packets_total += len(self.burst)
+            dropped = self.ring.put(self.burst)
+            if dropped:
+                self.counters.rx_dropped(self.port_number, dropped)
+
+        self.logger.info("Thread exit ")
+        self.pcap.close()
+
+class IngressDataPlane(DataPlane):
+    """
+    A DataPlane whose ports receive into one ingress ring, and that
+    counts the packets of every port
+    """
+    def __init__(self, ingress_limit=INGRESS_LIMIT):
+        DataPlane.__init__(self)
+        self.ingress = IngressRing(ingress_limit)
+        self.counters = PortCounters()
+
+    def port_add(self, interface_name, port_number):
+        """
+        Add a port that receives into the ingress ring
+        """
+        self.port_list[port_number] = IngressPort(interface_name,
+                                                  port_number, self)
+        self.port_list[port_number].start()
+
+    def poll_burst(self, max_count=INGRESS_BURST, timeout=None):
+        """
+        Take up to max_count received packets from the ingress ring
+        and count them
+        @param timeout If positive and no packet is waiting, block up
+        to this many seconds for one
+        @return A list of (port_number, packet, pkt_time), oldest
+        first; empty on timeout
+        """
+        burst = self.ingress.get(max_count, timeout)
+        counters = self.counters
+        for (of_port, packet, pkt_time) in burst:
+            counters.rx(of_port, len(packet))
+        return burst
+
+    def poll(self, port_number=None, timeout=None):
+        """
+        Take the oldest received packet, as DataPlane.poll
+        All ports share the ingress ring, so port_number must be None.
+        """
+        oft_assert(port_number is None, 
+                   "Poll: ingress ring cannot be polled per port")
+        burst = self.poll_burst(1, timeout)
+        if not burst:
+            return (None, None, None)
+        return burst[0]
+
+class ingress_ring_test(unittest.TestCase):
+    def burst(self, port_no, count):
+        return [(port_no, "x" * 60, float(idx)) for idx in range(count)]
+
+    def runTest(self):
+        ring = IngressRing(8)
+        self.assertEqual(ring.put(self.burst(1, 5)), 0)
+        self.assertEqual(ring.high_water, 5)
+        self.assertEqual(ring.stalls, 0)
+        # No room for 2 of the burst, even after waiting: drop tail
+        self.assertEqual(ring.put(self.burst(2, 5)), 2)
+        self.assertEqual((ring.dropped, ring.stalls, ring.high_water),
+                         (2, 1, 8))
+        self.assertEqual(ring.put(self.burst(3, 1)), 1)
+        self.assertEqual((ring.dropped, ring.stalls, ring.high_water),
+                         (3, 2, 8))
+        burst = ring.get(5)
+        self.assertEqual([port_no for (port_no, pkt, ts) in burst],
+                         [1] * 5)
+        # The oldest packets of a burst are the ones kept
+        self.assertEqual([(port_no, ts) for (port_no, pkt, ts) 
+                          in ring.get(8)],
+                         [(2, 0.0), (2, 1.0), (2, 2.0)])
+        self.assertEqual(ring.get(8, timeout=0.001), [])
+        self.assertEqual(ring.high_water, 8)
+        self.assertEqual(str(ring), "ingress ring: 0/8 packets, high "
+                         "water 8, 2 stalls, 3 dropped")
+
+class ingress_stall_test(ingress_ring_test):
+    def runTest(self):
+        ring = IngressRing(4)
+        ring.put(self.burst(1, 4))
+        # The switch loop takes packets while the port waits for room
+        # (backpressure): nothing is dropped
+        ring.not_full.wait = lambda timeout: ring.packets.popleft()
+        self.assertEqual(ring.put(self.burst(2, 1)), 0)
+        self.assertEqual((ring.dropped, ring.stalls, ring.high_water),
+                         (0, 1, 4))
+        self.assertEqual([port_no for (port_no, pkt, ts) in ring.get(8)],
+                         [1, 1, 1, 2])
+
@@ -0,0 +1,104 @@
+######################################################################
+#
+# All files associated with the OpenFlow Python Switch (ofps) are
+# made available for public use and benefit with the expectation
+# that others will use, modify and enhance the Software and contribute
+# those enhancements back to the community. However, since we would
+# like to make the Software available for broadest use, with as few
+# restrictions as possible permission is hereby granted, free of
+# charge, to any person obtaining a copy of this Software to deal in
+# the Software under the copyrights without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject
+# to the following conditions:
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT.  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# 
+######################################################################
+
+"""
+Megaflow decision cache for the flow pipeline
+
+Caches the outcome of running a packet through the pipeline, keyed
+on the packet's PacketKey as it entered table 0: the flow matched
+in each table visited, the instructions that must be re-run on every
+packet and the resulting action set.  Entries are tagged with the
+pipeline generation, which changes on every flow_mod, table_mod,
+group_mod and flow expiry, and are dropped when it moves.
+"""
+
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE = 4096
+
+class MegaflowEntry(object):
+    """
+    The cached pipeline decision for one packet key
+
+    @arg steps List of (table, flow, replay) in visit order; flow is
+    None for a table miss, replay is the flow's Program.replay, the
+    compiled steps to re-run on the packet
+    @arg action_set The packet's action set slots at the end of the pipeline
+    @arg action_set_bits The occupied slots of action_set
+    @arg matched True if any table matched
+    @arg dropped True if a table miss dropped the packet
+    """
+    def __init__(self):
+        self.steps = []
+        self.action_set = None
+        self.action_set_bits = 0
+        self.matched = False
+        self.dropped = False
+
+class MegaflowCache(object):
+    """
+    Bounded LRU cache of MegaflowEntry objects
+    """
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key, generation):
+        """
+        Return the entry for key, or None on a miss
+        @param key The packet's PacketKey
+        @param generation The current pipeline generation; a change
+        since the last call flushes the cache
+        """
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[key] = entry      # most recently used goes last
+        self.hits += 1
+        return entry
+
+    def insert(self, key, entry, generation):
+        """
+        Add an entry computed while the pipeline was at generation
+        Ignored if the pipeline has changed since
+        """
+        if generation != self.generation:
+            return
+        if len(self.entries) >= self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        self.entries[key] = entry
+
+    def __len__(self):
+        return len(self.entries)
@@ -47,12 +47,17 @@ from optparse import OptionParser
 import pdb
 
 import oftest.cstruct as ofp
-import oftest.dataplane as dataplane
 import oftest.message as message
 import oftest.action as action
 from ctrl_if import ControllerInterface
 from oftest.packet import Packet
+from oftest.packet import LAYER_NONE
 from pipeline import FlowPipeline
+from megaflow import DEFAULT_CACHE_SIZE
+from workers import WorkerPool
+from groups import GroupTable
+from queues import QueuedDataPlane
+from ingress import INGRESS_BURST
 import oftest.netutils as netutils
 import ctrl_msg
 
@@ -68,6 +73,9 @@ class OFSwitchConfig(object):
         self.controller_ip = None
         self.controller_port = None
         self.n_tables = None
+        self.cache_size = None
+        self.n_workers = None
+        self.queues = []    # (port, queue_id, min_rate, max_rate)
         self.passive_listen_port = None 
         self.port_map = {}
         self.env = {}  # Extensible array
@@ -77,6 +85,9 @@ class OFSwitchConfig(object):
         parser.set_defaults(controller_port=6633)
         parser.set_defaults(passive_connect=False)
         parser.set_defaults(n_tables=DEFAULT_TABLE_COUNT)
+        parser.set_defaults(cache_size=DEFAULT_CACHE_SIZE)
+        parser.set_defaults(n_workers=0)
+        parser.set_defaults(queues="")
         parser.set_defaults(interfaces="veth0,veth2,veth4,veth6")
         parser.set_defaults(datapath_id=self.devine_datapath_id())
         parser.set_defaults(validate_flow_mods=True)
@@ -92,6 +103,12 @@ class OFSwitchConfig(object):
                           action="store_true")
         parser.add_option('-t', '--tables', type='int', dest="n_tables",
                           help="Number of tables to create in the pipeline")
+        parser.add_option('-C', '--cache-size', type='int', dest="cache_size",
+                          help="Number of megaflow cache entries (0 disables)")
+        parser.add_option('-w', '--workers', type='int', dest="n_workers",
+                          help="Number of worker processes to forward packets (0 forwards in the switch process)")
+        parser.add_option('-q', '--queues', type='string',
+                          help="Comma separated egress queues, as port:queue_id:min_rate[:max_rate]; rates in tenths of a percent of the port speed, '-' for none; a max_rate of 0 blocks the queue")
         parser.add_option('-d', '--datapath-id', dest='datapath_id', type='long'
                           ,help="DatapathID for switch")
         self.parser = parser
@@ -117,14 +134,30 @@ class OFSwitchConfig(object):
         self.controller_port = self.options.controller_port
         self.passive_connect = self.options.passive_connect
         self.n_tables = self.options.n_tables
+        self.cache_size = self.options.cache_size
+        self.n_workers = self.options.n_workers
         for intr in self.options.interfaces.split(','):
             self.addInterface(intr)
+        for queue in self.options.queues.split(','):
+            if queue:
+                self.addQueue(queue)
  
     def getConfig(self, config):
         return getattr(self.options, config)
 
     def addInterface(self, intr):
         self.port_map[len(self.port_map) + 1] = intr
+
+    def addQueue(self, queue):
+        fields = queue.split(':')
+        if len(fields) == 3:
+            fields.append('-')
+        if len(fields) != 4:
+            self.parser.error("Bad queue %s" % queue)
+        rates = [None if rate == '-' else int(rate) for rate in fields[2:]]
+        if [rate for rate in rates if rate is not None and rate < 0]:
+            self.parser.error("Bad queue rate %s" % queue)
+        self.queues.append((int(fields[0]), int(fields[1])) + tuple(rates))
  
 class OFSwitch(Thread):
     """
@@ -153,6 +186,29 @@ class OFSwitch(Thread):
         self.logger = logging.getLogger("switch")
         self.groups = GroupTable()
         self.ports = {}         # hash of ports[index]=ofp.ofp_port
+        self.workers = None     # WorkerPool if forwarding is sharded
+        # Egress lists, rebuilt by ports_update() when the ports change:
+        # the ports that may be forwarded to, and for each in_port the
+        # ports OFPP_ALL and OFPP_FLOOD send to
+        self.fwd_ports = frozenset()
+        self.all_ports = ()
+        self.flood_lists = {}
+
+    def ports_update(self):
+        """
+        Rebuild everything derived from the ports' config and state
+        Call after a port is added or its config or state changes
+        """
+        self.groups.ports_update(self.ports)
+        fwd = [of_port for of_port in sorted(self.ports.iterkeys())
+               if not self.ports[of_port].config & ofp.OFPPC_NO_FWD]
+        self.fwd_ports = frozenset(fwd)
+        self.all_ports = tuple(fwd)
+        # There is no spanning tree, so FLOOD and ALL are the same
+        self.flood_lists = dict((in_port, tuple([of_port for of_port in fwd
+                                                 if of_port != in_port]))
+                                for in_port in self.ports)
+
     def config_set(self, config):
         """
         Set the configuration for the switch.
@@ -199,9 +255,10 @@ class OFSwitch(Thread):
             host = None
         self.controller = ControllerInterface(host=host,
                                               port=self.config.controller_port)
-        self.dataplane = dataplane.DataPlane()
+        self.dataplane = QueuedDataPlane()
         self.logger.info("Dataplane started")
-        self.pipeline = FlowPipeline(self, self.config.n_tables)
+        self.pipeline = FlowPipeline(self, self.config.n_tables,
+                                     self.config.cache_size)
         self.pipeline.controller_set(self.controller)
         self.pipeline.start()
         self.logger.info("Pipeline started")
@@ -223,6 +280,20 @@ class OFSwitch(Thread):
             port.curr = link_status
             port.peer = link_status
             self.ports[of_port]=port
+        self.ports_update()
+        for (of_port, queue_id, min_rate, max_rate) in self.config.queues:
+            if of_port not in self.ports:
+                self.logger.error("Queue %d for unknown port %d" % 
+                                  (queue_id, of_port))
+                continue
+            self.dataplane.queue_add(of_port, queue_id, 
+                                     self.ports[of_port].curr_speed,
+                                     min_rate, max_rate)
+        if self.config.n_workers > 0:
+            # Fork before the controller can install anything
+            self.workers = WorkerPool(self, self.config.n_workers)
+            self.workers.start()
+            self.pipeline.workers = self.workers
         # Register to receive all controller packets
         self.controller.register("all", self.ctrl_pkt_handler, calling_obj=self)
         self.controller.start()
@@ -231,7 +302,7 @@ class OFSwitch(Thread):
         # Process packets when they arrive
         self.logger.info("Entering packet processing loop")
         while True:
-            (of_port, data, recv_time) = self.dataplane.poll(timeout=5)
+            burst = self.dataplane.poll_burst(INGRESS_BURST, timeout=5)
             if not self.controller.isAlive():
                 # @todo Implement fail open/closed
                 self.logger.error("Controller dead\n")
@@ -240,15 +311,25 @@ class OFSwitch(Thread):
                 # @todo Implement fail open/closed
                 self.logger.error("Pipeline dead\n")
                 break
-            if data is None:
+            if self.workers is not None and not self.workers.isAlive():
+                self.logger.error("Worker dead\n")
+                break
+            if not burst:
                 self.logger.debug("No packet for 5 seconds\n")
                 continue
-            self.logger.debug("Packet len " + str(len(data)) +
-                              " in on port " + str(of_port))
-            packet = Packet(in_port=of_port, data=data)
-            self.pipeline.apply_pipeline(self, packet)
+            if self.workers is not None:
+                for (of_port, data, recv_time) in burst:
+                    self.workers.dispatch(of_port, data)
+                # Hand over the batches once per burst
+                self.workers.flush()
+                continue
+            for (of_port, data, recv_time) in burst:
+                packet = Packet(in_port=of_port, data=data, layer=LAYER_NONE)
+                self.pipeline.apply_pipeline(self, packet)
 
         self.logger.error("Exiting OFSwitch thread")
+        if self.workers is not None:
+            self.workers.kill()
         self.pipeline.kill()
         self.dataplane.kill()
         self.pipeline.join()
@@ -265,36 +346,6 @@ class OFSwitch(Thread):
     def version(self):
         return OFSwitch.VERSION
 
-class GroupTable(object):
-    """
-    Class to implement a group table object
-    """
-    def __init__(self):
-        """
-        Constructor for base class
-        Groups is a dict indexed by group_id with values group_mod messages
-        """
-        self.groups = {}
-
-    def update(self, group_mod):
-        """
-        Execute the group_mod operation on the table
-        """
-        # @todo Error checking, etc; should this be copy?
-        self.groups[group_mod.group_id] = group_mod
-
-    def group_get(self, group_id):
-        if group_id in self.groups.keys():
-            return self.groups[group_id]
-        else:
-            return None
-
-    def group_stats_get(self, group_id):
-        """
-        Return an ofp_group_stats object for the group_id
-        """
-        return None
-
 def sigint_handler(signum, frame):
     sys.exit()
 
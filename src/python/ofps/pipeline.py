@@ -30,26 +30,37 @@ import logging
 import sys
 import os
 import socket
+import unittest
 
 from flowtable import FlowTable
+from megaflow import MegaflowCache
+from megaflow import MegaflowEntry
+from megaflow import DEFAULT_CACHE_SIZE
 from threading import Thread
-from exec_actions import execute_actions
+from threading import Lock
 from exec_actions import packet_in_to_controller
 import oftest.cstruct as ofp
 import oftest.message as message 
+import oftest.action as action
 import oftest.instruction as instruction
+import oftest.bucket as bucket
 from oftest import ofutils
+from oftest.packet import Packet
+from oftest.packet import LAYER_NONE
+from groups import GroupTable
 import validate
-
+import flow as ofps_flow
 
 class FlowPipeline(Thread):
     """
     Class to implement a pipeline of flow tables
     The thread interface is to allow flow expiration operations
     """
-    def __init__(self, switch, n_tables):
+    def __init__(self, switch, n_tables, cache_size=DEFAULT_CACHE_SIZE):
         """
         Constructor for base class
+        @param cache_size Number of megaflow cache entries; 0 disables
+        the cache
         """
         super(FlowPipeline, self).__init__()
         self.controller = None
@@ -61,6 +72,20 @@ class FlowPipeline(Thread):
         for idx in range(n_tables):
             self.tables.append(FlowTable(table_id=idx))
         self.logger = logging.getLogger("pipeline")
+        # Changes whenever a table, table config or group changes;
+        # cached decisions from an older generation are discarded
+        self.generation = 0
+        # How deep packets are decoded before lookup: the deepest
+        # header layer any installed flow matches on
+        self.parse_layer = LAYER_NONE
+        self.cache = None
+        if cache_size > 0:
+            self.cache = MegaflowCache(cache_size)
+        # Serializes flow_mod, table_mod, group_mod and expiry, so that
+        # they reach worker replicas in the order they were applied
+        self.update_sync = Lock()
+        # A WorkerPool when forwarding is sharded over processes
+        self.workers = None
 
     def run(self):
         """
@@ -71,15 +96,47 @@ class FlowPipeline(Thread):
             time.sleep(1)
             #self.logger.debug("Pipeline thread awake");
             if self.active:
-                for idx in range(self.n_tables):
-                    flow_remove_msgs= self.tables[idx].expire()
-                    for msg in flow_remove_msgs:
-                        self.logger.debug("Expire " + str(msg))
-                        self.controller.message_send(msg)
+                self.flows_expire()
         self.logger.info("Exiting pipeline thread")
 
+    def flows_expire(self):
+        """
+        Remove the flows that have timed out and report them
+        """
+        if self.workers is not None:
+            # idle timeouts need the workers' last hit times
+            self.workers.counters_sync()
+        self.update_sync.acquire()
+        flow_remove_msgs = []
+        for idx in range(self.n_tables):
+            removed = []
+            flow_remove_msgs += self.tables[idx].expire(removed)
+            if removed:
+                self.invalidate()
+                if self.workers is not None:
+                    self.workers.update(('flow_remove', idx, 
+                            [flow.flow_id for flow in removed]))
+        self.update_sync.release()
+        for msg in flow_remove_msgs:
+            self.logger.debug("Expire " + str(msg))
+            self.controller.message_send(msg)
+
     def kill(self):
         self.active = False
+
+    def invalidate(self):
+        """
+        Start a new generation, invalidating all cached decisions
+        Must be called after the change has been made, so that a
+        lookup racing with the change never caches the old state
+        under the new generation.  Also recomputes the layer packets
+        are decoded to from the fields the flows now match on.
+        """
+        fields = 0
+        for table in self.tables:
+            fields |= table.classifier.fields
+        self.parse_layer = ofps_flow.match_layer(fields)
+        self.generation += 1
                 
     def controller_set(self, controller):
         """
@@ -95,6 +152,17 @@ class FlowPipeline(Thread):
         @param flow_mod The flow mod message to process
         @return tuple(err_code, err_msg) ; err_code = 0 --> success
         """
+        self.update_sync.acquire()
+        try:
+            ret = self._flow_mod_apply(flow_mod, groups)
+            if ret[0] == 0 and self.workers is not None:
+                self.workers.update(('flow_mod', flow_mod))
+        finally:
+            self.invalidate()
+            self.update_sync.release()
+        return ret
+
+    def _flow_mod_apply(self, flow_mod, groups):
         tables = []
         
         if (flow_mod.command !=  ofp.OFPFC_DELETE and
@@ -147,13 +215,50 @@ class FlowPipeline(Thread):
             update_list = self.tables
         else:
             update_list = [ self.tables[table_mod.table_id]]
+        self.update_sync.acquire()
         for table in update_list:
             self.logger.debug("table_mod: " + 
                               "setting table %d " % table.table_id +
                               "to miss_policy %d" % table_mod.config)
             table.miss_policy = table_mod.config
+        self.invalidate()
+        if self.workers is not None:
+            self.workers.update(('table_mod', table_mod))
+        self.update_sync.release()
         return None 
 
+    def group_mod_process(self, group_mod, groups):
+        """
+        Apply a group_mod to the group table
+        Deleting a group removes the flows that forward to it
+        @param group_mod The group_mod message to process
+        @param groups The switch's group table
+        @return None on success, an ofp_error message on error
+        """
+        flow_remove_msgs = []
+        self.update_sync.acquire()
+        try:
+            deleted = []
+            if group_mod.command == ofp.OFPGC_DELETE:
+                if group_mod.group_id == ofp.OFPG_ALL:
+                    deleted = groups.groups.keys()
+                elif group_mod.group_id in groups.groups:
+                    deleted = [group_mod.group_id]
+            error = groups.update(group_mod)
+            if error is None:
+                for table in self.tables:
+                    flow_remove_msgs += table.flows_remove_group(deleted)
+                if self.workers is not None:
+                    self.workers.update(('group_mod', group_mod))
+        finally:
+            self.invalidate()
+            self.update_sync.release()
+        # Workers remove the same flows, but only the switch reports them
+        if self.controller is not None:
+            for msg in flow_remove_msgs:
+                self.controller.message_send(msg)
+        return error
+
     def table_caps_get(self, table_id=0):
         """
         Return the capabilities supported by this implementation
@@ -224,54 +329,67 @@ class FlowPipeline(Thread):
         """
         return None
 
-    def run_instruction(self, switch, inst, packet):
+    def apply_pipeline(self, switch, packet):
         """
-        Private function to execute one instruction on a packet.
-        Need switch for immeidate apply
+        Run the pipeline on the packet and execute any actions indicated
+        Decisions are looked up in the megaflow cache first; on a miss
+        the tables are walked and the outcome is cached.  The packet
+        headers are decoded only as deep as the flows match on.
+        @param packet An OFPS packet object
         """
-        if inst.__class__ == instruction.instruction_goto_table:
-            if inst.table_id >= self.n_tables:
-                self.logger.error("Bad goto table %d" % inst.table_id)
-            else:
-                return inst.table_id
-        elif inst.__class__ == instruction.instruction_write_actions:
-            for action in inst.actions:
-                packet.write_action(action)
-        elif inst.__class__ == instruction.instruction_apply_actions:
-            execute_actions(switch, packet, inst.actions)
-        elif inst.__class__ == instruction.instruction_experimenter:
-            self.logger.error("Got experimenter instruction")
-        elif inst.__class__ == instruction.instruction_write_metadata:
-            packet.set_metadata(inst.metadata, inst.metadata_mask)
-        elif inst.__class__ == instruction.instruction_clear_actions:
-            packet.clear_actions()
+        generation = self.generation
+        layer = self.parse_layer
+        if packet.decoded < layer:
+            packet.decode(layer)
+        if self.cache is None:
+            entry = self.walk_pipeline(switch, packet)
         else:
-            self.logger.error("Bad instruction")
+            key = packet.key
+            entry = self.cache.lookup(key, generation)
+            if entry is None:
+                entry = self.walk_pipeline(switch, packet)
+                self.cache.insert(key, entry, generation)
+            else:
+                self.replay_pipeline(switch, packet, entry)
 
-        return None
+        if entry.dropped:
+            return
+        if entry.matched:
+            if packet.action_set_bits:
+                self.logger.debug("Executing actions on packet")
+                packet.execute_action_set(switch)
+        else: 
+            if (switch.ports[packet.in_port].config & ofp.OFPPC_NO_PACKET_IN) == 0: 
+                self.logger.debug("Forwarding packet to controller")
+                packet_in_to_controller(switch, packet)
+            else:
+                self.logger.debug("Would forward packet to controller; but OFPPC_NO_PACKET_IN set on port")
 
-    def apply_pipeline(self, switch, packet):
+    def walk_pipeline(self, switch, packet):
         """
-        Run the pipeline on the packet and execute any actions indicated
+        Run the packet through the flow tables, executing instructions
         @param packet An OFPS packet object, already parsed
+        @return A MegaflowEntry recording the decision
         """
-        # Generate a match structure from the packet
+        entry = MegaflowEntry()
         table_id = 0     # Start at table 0, per spec
-        matched = False  # Did we get any match?
         while table_id is not None:
-            next_table_id = None
             table = self.tables[table_id]
             flow = table.match_packet(packet)
             if flow is not None:
                 self.logger.debug("Matched packet in table " + str(table_id))
-                matched = True
-                # Check instruction set and execute it updating packet
-                for inst in flow.flow_mod.instructions.instructions:
-                    new_table_id = self.run_instruction(switch, inst, packet)
-                    if new_table_id is not None:
-                        next_table_id = new_table_id
-                table_id = next_table_id
+                entry.matched = True
+                # Run the compiled instructions, updating the packet
+                program = flow.program
+                for function, arg in program.steps:
+                    function(packet, arg, switch)
+                entry.steps.append((table, flow, program.replay))
+                table_id = program.goto
+                if table_id is not None and table_id >= self.n_tables:
+                    self.logger.error("Bad goto table %d" % table_id)
+                    table_id = None
             else:
+                entry.steps.append((table, None, None))
                 if table.miss_policy == ofp.OFPTC_TABLE_MISS_CONTINUE:
                     self.logger.debug("No match in table %d:" % table_id
                                       + " next table")
@@ -293,17 +411,33 @@ class FlowPipeline(Thread):
                     self.logger.debug(
                             "No match in table %d: dropping" 
                             % table_id)
-                    return
-                    
-        if matched:
-            self.logger.debug("Executing actions on packet")
-            packet.execute_action_set(switch)
-        else: 
-            if (switch.ports[packet.in_port].config & ofp.OFPPC_NO_PACKET_IN) == 0: 
-                self.logger.debug("Forwarding packet to controller")
-                packet_in_to_controller(switch, packet)
-            else:
-                self.logger.debug("Would forward packet to controller; but OFPPC_NO_PACKET_IN set on port")
+                    entry.dropped = True
+                    table_id = None
+        entry.action_set = packet.action_set[:]
+        entry.action_set_bits = packet.action_set_bits
+        return entry
+
+    def replay_pipeline(self, switch, packet, entry):
+        """
+        Apply a cached decision to the packet without any table lookups
+        Counters are updated as if the tables had been walked, and
+        apply_actions/write_metadata are re-run since they change the
+        packet itself
+        @param packet An OFPS packet object, already parsed
+        @param entry The MegaflowEntry from the cache
+        """
+        for table, flow, replay in entry.steps:
+            table.lookup_count += 1
+            if flow is None:
+                continue
+            table.matched_count += 1
+            flow.hit(packet)
+            if table.hit_log is not None:
+                table.hit_log.add(flow)
+            for function, arg in replay:
+                function(packet, arg, switch)
+        packet.action_set = entry.action_set[:]
+        packet.action_set_bits = entry.action_set_bits
 
     def desc_stats_get(self, request, switch):
         """ Get a desc_stats description of the switch
@@ -322,3 +456,286 @@ class FlowPipeline(Thread):
         #switch.logger.debug("########## %s" % stat.show("--------------"))
         reply.stats.append(stat)
         return reply
+
+class TestSwitch(object):
+    """
+    Just enough of an OFSwitch to run packets through a pipeline;
+    it is its own dataplane and controller, and records what it sends
+    """
+    def __init__(self, n_tables=2, cache_size=DEFAULT_CACHE_SIZE):
+        self.logger = logging.getLogger("switch")
+        self.ports = {}
+        for port_no in range(1, 5):
+            port = ofp.ofp_port()
+            port.port_no = port_no
+            self.ports[port_no] = port
+        self.fwd_ports = frozenset(self.ports)
+        self.all_ports = tuple(sorted(self.ports))
+        self.flood_lists = dict((in_port, tuple([port_no for port_no 
+                                                 in self.all_ports 
+                                                 if port_no != in_port]))
+                                for in_port in self.ports)
+        self.dataplane = self
+        self.controller = self
+        self.sent = []
+        self.messages = []
+        self.groups = GroupTable()
+        self.groups.ports_update(self.ports)
+        self.pipeline = FlowPipeline(self, n_tables, cache_size)
+        self.pipeline.controller_set(self)
+
+    def send(self, port_no, data, queue_id=0):
+        self.sent.append((port_no, str(data)))
+        return len(data)
+
+    def send_multi(self, port_nos, data, queue_id=0):
+        for port_no in port_nos:
+            self.send(port_no, data, queue_id)
+
+    def message_send(self, msg, zero_xid=False):
+        self.messages.append(msg)
+
+def test_flow_mod(priority=100, table_id=0, actions=[], goto=None,
+                  tp_dst=None, command=ofp.OFPFC_ADD, hard_timeout=0):
+    """
+    Return a flow_mod for TCP packets, optionally to one tp_dst, that
+    applies actions and then goes to table goto
+    """
+    flow_mod = message.flow_mod()
+    flow_mod.command = command
+    flow_mod.table_id = table_id
+    flow_mod.priority = priority
+    flow_mod.hard_timeout = hard_timeout
+    flow_mod.buffer_id = 0xffffffff
+    flow_mod.out_port = ofp.OFPP_ANY
+    flow_mod.out_group = ofp.OFPG_ANY
+    match = flow_mod.match
+    match.wildcards = ofp.OFPFW_ALL & ~ofp.OFPFW_DL_TYPE
+    match.dl_src_mask = [0xff] * 6
+    match.dl_dst_mask = [0xff] * 6
+    match.dl_type = 0x800
+    match.nw_src_mask = 0xffffffff
+    match.nw_dst_mask = 0xffffffff
+    if tp_dst is not None:
+        match.wildcards &= ~ofp.OFPFW_TP_DST
+        match.tp_dst = tp_dst
+    if actions:
+        inst = instruction.instruction_apply_actions()
+        for act in actions:
+            inst.actions.add(act)
+        flow_mod.instructions.add(inst)
+    if goto is not None:
+        inst = instruction.instruction_goto_table()
+        inst.table_id = goto
+        flow_mod.instructions.add(inst)
+    return flow_mod
+
+def test_output(port_no):
+    act = action.action_output()
+    act.port = port_no
+    return act
+
+class pipeline_cache_test(unittest.TestCase):
+    """
+    Cached decisions must never outlive the state they were made from
+    """
+    def setUp(self):
+        self.switch = TestSwitch()
+        self.pipeline = self.switch.pipeline
+
+    def add(self, flow_mod):
+        self.assertEqual(self.pipeline.flow_mod_process(flow_mod, 
+                                                        self.switch.groups),
+                         (0, None))
+
+    def forward(self, tp_dst=80):
+        """
+        Run a packet through the pipeline
+        @return The ports it was sent to
+        """
+        pkt = Packet().simple_tcp_packet(tcp_dport=tp_dst)
+        self.switch.sent = []
+        self.pipeline.apply_pipeline(self.switch, 
+                                     Packet(in_port=1, data=pkt.data))
+        return [port_no for (port_no, data) in self.switch.sent]
+
+    def cached(self):
+        """
+        Forward twice; the second packet must be a cache hit
+        @return The ports the second packet was sent to
+        """
+        self.forward()
+        hits = self.pipeline.cache.hits
+        ports = self.forward()
+        self.assertEqual(self.pipeline.cache.hits, hits + 1)
+        return ports
+
+    def runTest(self):
+        # flow_mod
+        self.add(test_flow_mod(priority=100, actions=[test_output(2)]))
+        self.assertEqual(self.cached(), [2])
+        generation = self.pipeline.generation
+        self.add(test_flow_mod(priority=200, actions=[test_output(3)]))
+        self.assertNotEqual(self.pipeline.generation, generation)
+        self.assertEqual(self.cached(), [3])
+        self.assertEqual(len(self.pipeline.cache), 1)
+        flow_mod = test_flow_mod(priority=200, 
+                                 command=ofp.OFPFC_DELETE_STRICT)
+        self.add(flow_mod)
+        self.assertEqual(self.cached(), [2])
+
+class pipeline_cache_table_mod_test(pipeline_cache_test):
+    def table_mod(self, table_id, config):
+        table_mod = message.table_mod()
+        table_mod.table_id = table_id
+        table_mod.config = config
+        self.assertEqual(self.pipeline.table_mod_process(table_mod), None)
+
+    def runTest(self):
+        self.add(test_flow_mod(table_id=1, actions=[test_output(2)]))
+        # Table 0 misses to the controller
+        self.assertEqual(self.cached(), [])
+        self.assertEqual(len(self.switch.messages), 2)
+        self.table_mod(0, ofp.OFPTC_TABLE_MISS_CONTINUE)
+        self.assertEqual(self.cached(), [2])
+        self.table_mod(0, ofp.OFPTC_TABLE_MISS_DROP)
+        self.assertEqual(self.cached(), [])
+        self.assertEqual(len(self.switch.messages), 2)
+
+class pipeline_cache_group_mod_test(pipeline_cache_test):
+    def group_mod(self, command, port_no):
+        group_mod = message.group_mod()
+        group_mod.command = command
+        group_mod.group_id = 1
+        group_mod.type = ofp.OFPGT_ALL
+        group_bucket = bucket.bucket()
+        group_bucket.watch_port = ofp.OFPP_ANY
+        group_bucket.watch_group = ofp.OFPG_ANY
+        group_bucket.actions.add(test_output(port_no))
+        group_mod.buckets.add(group_bucket)
+        self.assertEqual(self.pipeline.group_mod_process(group_mod, 
+                                                         self.switch.groups),
+                         None)
+
+    def runTest(self):
+        self.group_mod(ofp.OFPGC_ADD, 2)
+        group = action.action_group()
+        group.group_id = 1
+        self.add(test_flow_mod(actions=[group]))
+        self.assertEqual(self.cached(), [2])
+        self.group_mod(ofp.OFPGC_MODIFY, 3)
+        self.assertEqual(self.cached(), [3])
+        # Deleting the group removes the flow: the packets now miss
+        self.group_mod(ofp.OFPGC_DELETE, 3)
+        self.assertEqual(len(self.pipeline.tables[0]), 0)
+        self.assertEqual(self.cached(), [])
+        self.assertEqual([msg.__class__ for msg in self.switch.messages],
+                         [message.packet_in, message.packet_in])
+
+class pipeline_cache_expiry_test(pipeline_cache_test):
+    def runTest(self):
+        self.add(test_flow_mod(priority=100, actions=[test_output(2)]))
+        self.add(test_flow_mod(priority=200, actions=[test_output(3)],
+                               hard_timeout=10))
+        self.assertEqual(self.cached(), [3])
+        # Make the flow's deadline pass rather than waiting for it
+        for flow in self.pipeline.tables[0].flow_entries:
+            if flow.flow_mod.hard_timeout:
+                flow.insert_time -= 20
+                self.pipeline.tables[0].timeouts = [
+                    (flow.deadline(), flow.timer_seq, flow)]
+        self.pipeline.flows_expire()
+        self.assertEqual(len(self.pipeline.tables[0]), 1)
+        self.assertEqual(self.cached(), [2])
+
+class pipeline_replay_test(unittest.TestCase):
+    """
+    Counters and output after cache hits match walking the tables
+    """
+    def runTest(self):
+        switches = [TestSwitch(cache_size=0), TestSwitch()]
+        rewrite = action.action_set_nw_src()
+        rewrite.nw_addr = 0x0a0a0a0a
+        flow_mods = [
+            test_flow_mod(priority=10, goto=1),
+            test_flow_mod(priority=20, tp_dst=22, actions=[rewrite], goto=1),
+            test_flow_mod(priority=20, tp_dst=23, actions=[test_output(4)]),
+            test_flow_mod(priority=10, table_id=1, actions=[test_output(2)]),
+            test_flow_mod(priority=20, table_id=1, tp_dst=80, 
+                          actions=[test_output(3)]),
+            ]
+        for switch in switches:
+            for flow_mod in flow_mods:
+                self.assertEqual(switch.pipeline.flow_mod_process(
+                        flow_mod, switch.groups), (0, None))
+            for tp_dst in [22, 23, 80, 81, 22, 23, 80, 81, 22, 443] * 3:
+                pkt = Packet().simple_tcp_packet(tcp_dport=tp_dst)
+                switch.pipeline.apply_pipeline(switch, 
+                                               Packet(in_port=1, 
+                                                      data=pkt.data))
+        (walked, cached) = switches
+        self.assertEqual(walked.pipeline.cache, None)
+        self.assertTrue(cached.pipeline.cache.hits > 0)
+        self.assertEqual(walked.sent, cached.sent)
+        self.assertEqual(walked.messages, cached.messages)
+        for (table_a, table_b) in zip(walked.pipeline.tables, 
+                                      cached.pipeline.tables):
+            self.assertEqual(table_a.lookup_count, table_b.lookup_count)
+            self.assertEqual(table_a.matched_count, table_b.matched_count)
+            for (flow_a, flow_b) in zip(table_a.flow_entries, 
+                                        table_b.flow_entries):
+                self.assertEqual(flow_a.counters.packets, 
+                                 flow_b.counters.packets)
+                self.assertEqual(flow_a.counters.bytes, 
+                                 flow_b.counters.bytes)
+
+class pipeline_group_delete_test(pipeline_cache_test):
+    """
+    Deleting a group removes the flows that forward to it, and only
+    those
+    """
+    def group_action(self, group_id):
+        group = action.action_group()
+        group.group_id = group_id
+        return group
+
+    def group_add(self, group_id):
+        group_mod = message.group_mod()
+        group_mod.command = ofp.OFPGC_ADD
+        group_mod.group_id = group_id
+        group_mod.type = ofp.OFPGT_INDIRECT
+        self.assertEqual(self.pipeline.group_mod_process(group_mod, 
+                                                         self.switch.groups),
+                         None)
+
+    def group_delete(self, group_id):
+        group_mod = message.group_mod()
+        group_mod.command = ofp.OFPGC_DELETE
+        group_mod.group_id = group_id
+        self.assertEqual(self.pipeline.group_mod_process(group_mod, 
+                                                         self.switch.groups),
+                         None)
+
+    def runTest(self):
+        self.group_add(1)
+        self.group_add(2)
+        flow_mod = test_flow_mod(tp_dst=80, actions=[self.group_action(1)])
+        flow_mod.flags = ofp.OFPFF_SEND_FLOW_REM
+        self.add(flow_mod)
+        self.add(test_flow_mod(tp_dst=81, actions=[self.group_action(2)]))
+        self.add(test_flow_mod(tp_dst=82, actions=[test_output(3)]))
+        self.add(test_flow_mod(table_id=1, actions=[self.group_action(1)]))
+        self.group_delete(1)
+        self.assertEqual([len(table) for table in self.pipeline.tables], 
+                         [2, 0])
+        self.assertEqual(len(self.switch.messages), 1)
+        flow_removed = self.switch.messages[0]
+        self.assertTrue(isinstance(flow_removed, message.flow_removed))
+        self.assertEqual(flow_removed.reason, ofp.OFPRR_GROUP_DELETE)
+        self.assertEqual(flow_removed.match.tp_dst, 80)
+        # Deleting a group that is not there removes nothing
+        self.group_delete(1)
+        self.assertEqual(len(self.pipeline.tables[0]), 2)
+        self.group_delete(ofp.OFPG_ALL)
+        self.assertEqual(len(self.pipeline.tables[0]), 1)
+        self.assertEqual(self.forward(82), [3])
@@ -0,0 +1,216 @@
+######################################################################
+#
+# All files associated with the OpenFlow Python Switch (ofps) are
+# made available for public use and benefit with the expectation
+# that others will use, modify and enhance the Software and contribute
+# those enhancements back to the community. However, since we would
+# like to make the Software available for broadest use, with as few
+# restrictions as possible permission is hereby granted, free of
+# charge, to any person obtaining a copy of this Software to deal in
+# the Software under the copyrights without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject
+# to the following conditions:
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT.  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# 
+######################################################################
+
+
+"""
+Per-port packet counters
+
+Counting is on every packet's path, so it takes no lock: each thread
+that counts has its own dict of counters (a threading.local), and the
+threads' dicts are only summed when a port_stats reply is built.
+Worker processes (see workers.py) report their totals in their
+counter syncs.
+"""
+
+import threading
+import unittest
+
+import oftest.cstruct as ofp
+import oftest.message as message
+
+# Index of each counter in a port's list of counters
+RX_PACKETS = 0
+RX_BYTES = 1
+TX_PACKETS = 2
+TX_BYTES = 3
+TX_DROPPED = 4
+TX_ERRORS = 5
+RX_DROPPED = 6
+RX_ERRORS = 7
+N_COUNTERS = 8
+
+# Largest OpenFlow message, as its 16 bit length field allows
+OFP_MAX_MESSAGE_LEN = 0xffff
+
+class PortCounters(object):
+    """
+    rx/tx counters of the switch's ports
+
+    @arg threads Every counting thread's dict of port_no -> counters
+    @arg workers Worker index -> that worker's totals
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.threads = []
+        # Only taken when a thread counts for the first time
+        self.threads_lock = threading.Lock()
+        self.workers = {}
+
+    def _counters(self, port_no):
+        """
+        Return this thread's counters list for port_no
+        """
+        try:
+            ports = self.local.ports
+        except AttributeError:
+            ports = self.local.ports = {}
+            self.threads_lock.acquire()
+            self.threads.append(ports)
+            self.threads_lock.release()
+        counters = ports.get(port_no)
+        if counters is None:
+            counters = ports[port_no] = [0] * N_COUNTERS
+        return counters
+
+    def rx(self, port_no, size):
+        counters = self._counters(port_no)
+        counters[RX_PACKETS] += 1
+        counters[RX_BYTES] += size
+
+    def tx(self, port_no, size):
+        counters = self._counters(port_no)
+        counters[TX_PACKETS] += 1
+        counters[TX_BYTES] += size
+
+    def rx_dropped(self, port_no, count=1):
+        self._counters(port_no)[RX_DROPPED] += count
+
+    def rx_error(self, port_no):
+        self._counters(port_no)[RX_ERRORS] += 1
+
+    def tx_dropped(self, port_no):
+        self._counters(port_no)[TX_DROPPED] += 1
+
+    def tx_error(self, port_no):
+        self._counters(port_no)[TX_ERRORS] += 1
+
+    def worker_set(self, index, totals):
+        """
+        Store the totals reported by a worker process
+        """
+        self.workers[index] = totals
+
+    def totals(self):
+        """
+        Return a dict of port_no -> counters summed over all threads
+        and workers
+        Counters may be a packet or so behind threads still counting.
+        """
+        self.threads_lock.acquire()
+        sources = self.threads + self.workers.values()
+        self.threads_lock.release()
+        totals = {}
+        for ports in sources:
+            for port_no, counters in ports.items():
+                total = totals.get(port_no)
+                if total is None:
+                    total = totals[port_no] = [0] * N_COUNTERS
+                for idx in range(N_COUNTERS):
+                    total[idx] += counters[idx]
+        return totals
+
+def port_stats_replies(request, port_nos, totals):
+    """
+    Return the port_stats_replies answering a request
+    Ports that would take a reply past OFP_MAX_MESSAGE_LEN go in the
+    next one; every reply but the last has OFPSF_REPLY_MORE set.
+    @param request The port_stats_request
+    @param port_nos The ports to report, in order
+    @param totals The port counters, as PortCounters.totals() returns
+    """
+    reply = message.port_stats_reply()
+    reply.header.xid = request.header.xid
+    replies = [reply]
+    length = len(reply)
+    for port_no in port_nos:
+        counters = totals.get(port_no, [0] * N_COUNTERS)
+        stat = message.port_stats_entry()
+        stat.port_no = port_no
+        stat.rx_packets = counters[RX_PACKETS]
+        stat.rx_bytes = counters[RX_BYTES]
+        stat.rx_dropped = counters[RX_DROPPED]
+        stat.rx_errors = counters[RX_ERRORS]
+        stat.tx_packets = counters[TX_PACKETS]
+        stat.tx_bytes = counters[TX_BYTES]
+        stat.tx_dropped = counters[TX_DROPPED]
+        stat.tx_errors = counters[TX_ERRORS]
+        if length + len(stat) > OFP_MAX_MESSAGE_LEN:
+            reply.flags |= ofp.OFPSF_REPLY_MORE
+            reply = message.port_stats_reply()
+            reply.header.xid = request.header.xid
+            replies.append(reply)
+            length = len(reply)
+        reply.stats.append(stat)
+        length += len(stat)
+    return replies
+
+class port_counters_test(unittest.TestCase):
+    def runTest(self):
+        counters = PortCounters()
+        counters.rx(1, 100)
+        counters.rx(1, 60)
+        counters.rx_dropped(1, 3)
+        counters.rx_error(2)
+        counters.tx(2, 70)
+        counters.tx_dropped(2)
+        # Another thread's counts go in its own dict
+        thread = threading.Thread(target=counters.rx_dropped, args=(1, 2))
+        thread.start()
+        thread.join()
+        counters.worker_set(0, {2 : [1, 64, 0, 0, 0, 0, 0, 1]})
+        totals = counters.totals()
+        self.assertEqual(totals[1], [2, 160, 0, 0, 0, 0, 5, 0])
+        self.assertEqual(totals[2], [1, 64, 1, 70, 1, 0, 0, 2])
+        request = message.port_stats_request()
+        request.port_no = ofp.OFPP_ANY
+        request.header.xid = 7
+        (reply,) = port_stats_replies(request, [1, 2, 3], totals)
+        self.assertEqual(reply.flags, 0)
+        self.assertEqual([stat.port_no for stat in reply.stats], [1, 2, 3])
+        self.assertEqual(reply.stats[0].rx_dropped, 5)
+        self.assertEqual(reply.stats[1].rx_errors, 2)
+        self.assertEqual(reply.stats[1].tx_dropped, 1)
+        self.assertEqual(reply.stats[2].rx_packets, 0)
+
+class port_stats_split_test(unittest.TestCase):
+    def runTest(self):
+        request = message.port_stats_request()
+        request.port_no = ofp.OFPP_ANY
+        request.header.xid = 7
+        port_nos = range(1, 1501)
+        replies = port_stats_replies(request, port_nos, {})
+        self.assertTrue(len(replies) > 1)
+        for reply in replies:
+            self.assertTrue(len(reply.pack()) <= OFP_MAX_MESSAGE_LEN)
+            self.assertEqual(reply.header.xid, 7)
+        self.assertEqual([reply.flags for reply in replies],
+                         [ofp.OFPSF_REPLY_MORE] * (len(replies) - 1) + [0])
+        self.assertEqual([stat.port_no for reply in replies 
+                          for stat in reply.stats], port_nos)
+        # Only full replies are split off
+        stat_len = len(replies[0].stats[0])
+        self.assertTrue(len(replies[0]) + stat_len > OFP_MAX_MESSAGE_LEN)
+
@@ -0,0 +1,572 @@
+######################################################################
+#
+# All files associated with the OpenFlow Python Switch (ofps) are
+# made available for public use and benefit with the expectation
+# that others will use, modify and enhance the Software and contribute
+# those enhancements back to the community. However, since we would
+# like to make the Software available for broadest use, with as few
+# restrictions as possible permission is hereby granted, free of
+# charge, to any person obtaining a copy of this Software to deal in
+# the Software under the copyrights without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject
+# to the following conditions:
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT.  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# 
+######################################################################
+
+"""
+Longest prefix match index for flows that differ only in IPv4 prefixes
+
+When every flow in a table compares the same key bits with the same
+values, apart from CIDR style nw_src/nw_dst masks, the table can be
+searched with a two level multibit trie: a trie on the nw_dst prefix
+whose nodes hold tries on the nw_src prefix, whose nodes in turn
+hold the flows with exactly that (nw_dst, nw_src) prefix pair.  A
+lookup follows one nw_dst path and, from every node on it holding
+flows, one nw_src path; the flows found are the only candidates.
+
+Flows with a non-contiguous nw mask, or a table whose flows differ in
+anything else, make the index unusable and the table falls back to
+the classifier.  The trie is only built while the table qualifies
+and has more than one classifier subtable, and is dropped rather than
+kept in sync once either stops being true, so tables that never use
+it pay only for counting their flows' bases.
+
+Like the classifier, lookups take no lock: leaf flow lists are
+tuples swapped in whole, a node's prefix lengths are a tuple
+replaced after its prefixes are added, and a new node, nw_src trie
+or whole trie is filled before it is linked in.
+"""
+
+import bisect
+import random
+import unittest
+
+import oftest.cstruct as ofp
+import oftest.message as message
+import flow as ofps_flow
+
+NW_SRC_SHIFT = ofps_flow._SHIFT['nw_src']
+NW_DST_SHIFT = ofps_flow._SHIFT['nw_dst']
+NW_BITS = ((0xffffffff << NW_SRC_SHIFT) | (0xffffffff << NW_DST_SHIFT))
+
+def prefix_len(mask):
+    """
+    Return the length of a contiguous 32 bit prefix mask, or None
+    if mask is not of the form 1...10...0
+    """
+    host = ~mask & 0xffffffff
+    if host & (host + 1):
+        return None
+    return 32 - bin(host).count('1')
+
+STRIDE = 8
+
+class TrieNode(object):
+    """
+    One level of the multibit trie, covering STRIDE bits of address
+
+    Nodes are sparse: a prefix is stored once, under its length and
+    bits, rather than expanded into every slot it covers, and children
+    are only made for the chunks some prefix runs through.
+    """
+    def __init__(self):
+        # The value of the prefix ending exactly at this node's depth
+        self.value = None
+        # (length, bits) -> value for the prefixes ending inside this
+        # node; length is relative to the node, 0 < length < STRIDE
+        self.prefixes = {}
+        # The lengths used in prefixes, ascending; replaced, never
+        # modified, so lookups can iterate it unlocked
+        self.lengths = ()
+        # length -> number of prefixes of that length
+        self.length_counts = {}
+        self.children = {}
+
+    def prefix_get(self, length, bits):
+        if length == 0:
+            return self.value
+        return self.prefixes.get((length, bits))
+
+    def prefix_set(self, length, bits, value):
+        if length == 0:
+            self.value = value
+            return
+        if (length, bits) not in self.prefixes:
+            count = self.length_counts.get(length, 0)
+            self.length_counts[length] = count + 1
+        self.prefixes[(length, bits)] = value
+        if length not in self.lengths:
+            self.lengths = tuple(sorted(self.lengths + (length,)))
+
+    def prefix_delete(self, length, bits):
+        if length == 0:
+            self.value = None
+            return
+        del self.prefixes[(length, bits)]
+        self.length_counts[length] -= 1
+        if self.length_counts[length] == 0:
+            del self.length_counts[length]
+            self.lengths = tuple(sorted(self.length_counts.keys()))
+
+    def empty(self):
+        return (self.value is None and not self.prefixes and 
+                not self.children)
+
+class PrefixTrie(object):
+    """
+    Multibit trie over 32 bit prefixes, holding one value per prefix
+    """
+    def __init__(self):
+        self.root = TrieNode()
+
+    def _path(self, addr, length):
+        """
+        @return The chunks leading to the node for addr/length, and
+        the prefix's key within that node
+        """
+        levels = length // STRIDE
+        chunks = [(addr >> (32 - STRIDE * (level + 1))) & 0xff 
+                  for level in range(levels)]
+        rel = length - levels * STRIDE
+        bits = 0
+        if rel:
+            bits = (addr >> (32 - length)) & ((1 << rel) - 1)
+        return chunks, (rel, bits)
+
+    def get(self, addr, length):
+        """
+        Return the value stored for addr/length, or None
+        """
+        chunks, key = self._path(addr, length)
+        node = self.root
+        for chunk in chunks:
+            node = node.children.get(chunk)
+            if node is None:
+                return None
+        return node.prefix_get(*key)
+
+    def set(self, addr, length, value):
+        chunks, key = self._path(addr, length)
+        node = self.root
+        for chunk in chunks:
+            child = node.children.get(chunk)
+            if child is None:
+                child = TrieNode()
+                node.children[chunk] = child
+            node = child
+        node.prefix_set(key[0], key[1], value)
+
+    def delete(self, addr, length):
+        """
+        Remove the value for addr/length and any nodes left empty
+        """
+        chunks, key = self._path(addr, length)
+        path = [self.root]
+        for chunk in chunks:
+            path.append(path[-1].children[chunk])
+        path[-1].prefix_delete(*key)
+        for level in range(len(chunks), 0, -1):
+            if not path[level].empty():
+                break
+            del path[level - 1].children[chunks[level - 1]]
+
+    def matches(self, addr):
+        """
+        Return the values of all prefixes covering addr
+        """
+        found = []
+        node = self.root
+        for shift in (24, 16, 8, 0):
+            if node.value is not None:
+                found.append(node.value)
+            chunk = (addr >> shift) & 0xff
+            prefixes = node.prefixes
+            for length in node.lengths:
+                value = prefixes.get((length, chunk >> (STRIDE - length)))
+                if value is not None:
+                    found.append(value)
+            node = node.children.get(chunk)
+            if node is None:
+                return found
+        # /32 prefixes, the only ones held at this depth
+        if node.value is not None:
+            found.append(node.value)
+        return found
+
+    def empty(self):
+        return self.root.empty()
+
+class FlowList(object):
+    """
+    The flows with one (nw_dst, nw_src) prefix pair
+    entries is a tuple of (-priority, seq, flow), so it sorts highest
+    priority first with equal priorities in insertion order; writers
+    replace it rather than modify it
+    """
+    def __init__(self):
+        self.entries = ()
+
+class FlowTrie(PrefixTrie):
+    """
+    An nw_src trie holding FlowLists, tracking their top priority
+    """
+    def __init__(self):
+        super(FlowTrie, self).__init__()
+        self.seq = 0
+        # priority -> number of flows in this trie at that priority
+        self.priorities = {}
+        self.max_priority = -1
+
+    def insert(self, src, src_len, flow):
+        flows = self.get(src, src_len)
+        priority = flow.flow_mod.priority
+        self.seq += 1
+        if flows is None:
+            flows = FlowList()
+            flows.entries = ((-priority, self.seq, flow),)
+            self.set(src, src_len, flows)
+        else:
+            entries = list(flows.entries)
+            bisect.insort(entries, (-priority, self.seq, flow))
+            flows.entries = tuple(entries)
+        self.priorities[priority] = self.priorities.get(priority, 0) + 1
+        if priority > self.max_priority:
+            self.max_priority = priority
+
+    def remove(self, src, src_len, flow):
+        flows = self.get(src, src_len)
+        priority = flow.flow_mod.priority
+        entries = flows.entries
+        idx = bisect.bisect_left(entries, (-priority,))
+        while entries[idx][2] is not flow:
+            idx += 1
+        if len(entries) == 1:
+            self.delete(src, src_len)
+        else:
+            flows.entries = entries[:idx] + entries[idx + 1:]
+        self.priorities[priority] -= 1
+        if self.priorities[priority] == 0:
+            del self.priorities[priority]
+            if priority == self.max_priority:
+                self.max_priority = max(self.priorities.keys() or [-1])
+
+class PrefixIndex(object):
+    """
+    Per table nw_dst/nw_src trie over the flows' compiled matches
+
+    The index always counts the flows' bases and irregular masks, which
+    is cheap, but only holds a trie between build() and drop(): the
+    table builds it once the flows qualify and the trie would be used,
+    and the index drops it as soon as the flows stop qualifying.
+    @param fallback Lookup function over the same flows, used when a
+    lookup races with an update that changes the base
+    """
+    def __init__(self, fallback):
+        self.fallback = fallback
+        # (mask, value) outside the nw fields -> number of flows
+        self.bases = {}
+        # flows with a non-contiguous nw_src or nw_dst mask
+        self.irregular = 0
+        # The trie while built, else None
+        self.trie = None
+        # The (mask, value) shared by all flows while the trie is
+        # built, else None; what lookups read
+        self.base = None
+
+    def _prefixes(self, flow):
+        """
+        @return ((dst, dst_len), (src, src_len)); a length is None if
+        the mask is not a prefix
+        """
+        prefixes = []
+        for shift in (NW_DST_SHIFT, NW_SRC_SHIFT):
+            mask = (flow.mask >> shift) & 0xffffffff
+            prefixes.append(((flow.value >> shift) & 0xffffffff,
+                             prefix_len(mask)))
+        return prefixes
+
+    def _count(self, flow, delta):
+        """
+        Add delta to the counts of the flow's base and irregularity
+        """
+        base = (flow.mask & ~NW_BITS, flow.value & ~NW_BITS)
+        count = self.bases.get(base, 0) + delta
+        if count:
+            self.bases[base] = count
+        else:
+            del self.bases[base]
+        (dst, dst_len), (src, src_len) = self._prefixes(flow)
+        if dst_len is None or src_len is None:
+            self.irregular += delta
+
+    def _trie_insert(self, trie, flow):
+        (dst, dst_len), (src, src_len) = self._prefixes(flow)
+        src_trie = trie.get(dst, dst_len)
+        if src_trie is None:
+            src_trie = FlowTrie()
+            src_trie.insert(src, src_len, flow)
+            trie.set(dst, dst_len, src_trie)
+        else:
+            src_trie.insert(src, src_len, flow)
+
+    def _trie_remove(self, trie, flow):
+        (dst, dst_len), (src, src_len) = self._prefixes(flow)
+        src_trie = trie.get(dst, dst_len)
+        src_trie.remove(src, src_len, flow)
+        if src_trie.empty():
+            trie.delete(dst, dst_len)
+
+    def insert(self, flow):
+        self._count(flow, 1)
+        if self.trie is None:
+            return
+        if self.qualifies():
+            self._trie_insert(self.trie, flow)
+        else:
+            self.drop()
+
+    def remove(self, flow):
+        self._count(flow, -1)
+        if self.trie is None:
+            return
+        if self.qualifies():
+            self._trie_remove(self.trie, flow)
+        else:
+            self.drop()
+
+    def qualifies(self):
+        """
+        True if every flow shares one base and uses CIDR nw masks
+        """
+        return len(self.bases) == 1 and self.irregular == 0
+
+    def built(self):
+        return self.trie is not None
+
+    def build(self, flows):
+        """
+        Build the trie over the flows, which must qualify
+        @param flows The table's flows, highest priority first and in
+        insertion order within a priority
+        """
+        trie = PrefixTrie()
+        for flow in flows:
+            self._trie_insert(trie, flow)
+        # Fill the trie before readers can see it
+        self.trie = trie
+        self.base = self.bases.keys()[0]
+
+    def drop(self):
+        """
+        Free the trie; lookups fall back until it is built again
+        """
+        self.base = None
+        self.trie = None
+
+    def lookup(self, key):
+        """
+        Return the highest priority flow matching key, or None
+        Only valid while the trie is built
+        """
+        trie = self.trie
+        base = self.base
+        if trie is None or base is None:
+            return self.fallback(key)
+        if key & base[0] != base[1]:
+            return None
+        dst = (key >> NW_DST_SHIFT) & 0xffffffff
+        src = (key >> NW_SRC_SHIFT) & 0xffffffff
+        best = None
+        best_priority = -1
+        # Candidate nw_src tries in priority order; stop once none of
+        # the remaining ones could beat the best match.  Break on the
+        # priorities they were sorted by: a racing remove may lower one
+        # below that of a trie sorted after it.
+        candidates = [(src_trie.max_priority, src_trie) 
+                      for src_trie in trie.matches(dst)]
+        candidates.sort(key=lambda entry: entry[0], reverse=True)
+        for (max_priority, src_trie) in candidates:
+            if max_priority <= best_priority:
+                break
+            for flows in src_trie.matches(src):
+                # flows here have identical matches; first is the best
+                flow = flows.entries[0][2]
+                if flow.flow_mod.priority > best_priority:
+                    best = flow
+                    best_priority = flow.flow_mod.priority
+        if best is not None and key & best.mask != best.value:
+            # base changed under us; the classifier is always right
+            return self.fallback(key)
+        return best
+
+class prefix_trie_test(unittest.TestCase):
+    """
+    Compare trie matches with a scan of the stored prefixes
+    """
+    ADDRS = [0x0a000001, 0x0a000002, 0x0a000101, 0x0a010001, 0x0a800001,
+             0xc0a80001]
+    LENGTHS = [0, 1, 8, 9, 13, 16, 20, 24, 31, 32]
+
+    def covers(self, prefix, addr):
+        (paddr, plen) = prefix
+        if plen == 0:
+            return True
+        return paddr >> (32 - plen) == addr >> (32 - plen)
+
+    def network(self, addr, length):
+        return addr & ~(0xffffffff >> length) & 0xffffffff
+
+    def check_matches(self, trie, prefixes):
+        for addr in self.ADDRS + [0, 0xffffffff]:
+            expected = [prefix for prefix in prefixes 
+                        if self.covers(prefix, addr)]
+            self.assertEqual(sorted(trie.matches(addr)), sorted(expected))
+
+    def setUp(self):
+        self.rand = random.Random(1)
+
+    def runTest(self):
+        trie = PrefixTrie()
+        prefixes = set()
+        for addr in self.ADDRS:
+            for length in self.LENGTHS:
+                prefix = (self.network(addr, length), length)
+                prefixes.add(prefix)
+                trie.set(prefix[0], length, prefix)
+        for prefix in prefixes:
+            self.assertEqual(trie.get(*prefix), prefix)
+        self.check_matches(trie, prefixes)
+        for prefix in self.rand.sample(sorted(prefixes), len(prefixes) // 2):
+            trie.delete(*prefix)
+            prefixes.remove(prefix)
+            self.assertEqual(trie.get(*prefix), None)
+        self.check_matches(trie, prefixes)
+        for prefix in prefixes:
+            trie.delete(*prefix)
+        self.assertTrue(trie.empty())
+        self.assertEqual(trie.root.lengths, ())
+
+class prefix_index_test(prefix_trie_test):
+    """
+    Compare PrefixIndex lookups with a scan of the flows in priority order
+    """
+    def flow(self, priority, nw_src, nw_dst, nw_src_mask=None):
+        flow_mod = message.flow_mod()
+        flow_mod.priority = priority
+        match = flow_mod.match
+        match.wildcards = ofp.OFPFW_ALL & ~ofp.OFPFW_DL_TYPE
+        match.dl_src_mask = [0xff] * 6
+        match.dl_dst_mask = [0xff] * 6
+        match.dl_type = 0x800
+        (match.nw_src, length) = nw_src
+        match.nw_src_mask = 0xffffffff >> length
+        if nw_src_mask is not None:
+            match.nw_src_mask = nw_src_mask
+        (match.nw_dst, length) = nw_dst
+        match.nw_dst_mask = 0xffffffff >> length
+        flow = ofps_flow.FlowEntry()
+        flow.flow_mod_set(flow_mod)
+        return flow
+
+    def random_flow(self):
+        def prefix():
+            length = self.rand.choice(self.LENGTHS)
+            return (self.network(self.rand.choice(self.ADDRS), length), 
+                    length)
+        return self.flow(self.rand.randint(1, 20), prefix(), prefix())
+
+    def scan(self, key):
+        best = None
+        for flow in self.flows:
+            if key & flow.mask == flow.value and (best is None or 
+                    flow.flow_mod.priority > best.flow_mod.priority):
+                best = flow
+        return best
+
+    def check_lookups(self):
+        for src in self.ADDRS:
+            for dst in self.ADDRS:
+                key = ((0x800 << ofps_flow._SHIFT["dl_type"]) |
+                       (src << NW_SRC_SHIFT) | (dst << NW_DST_SHIFT))
+                found = self.index.lookup(key)
+                expected = self.scan(key)
+                if expected is None:
+                    self.assertEqual(found, None)
+                else:
+                    self.assertEqual(found.flow_mod.priority, 
+                                     expected.flow_mod.priority)
+                    self.assertEqual(key & found.mask, found.value)
+
+    def insert(self, flow):
+        self.flows.append(flow)
+        self.index.insert(flow)
+
+    def remove(self, flow):
+        self.flows.remove(flow)
+        self.index.remove(flow)
+
+    def setUp(self):
+        self.rand = random.Random(1)
+        self.flows = []
+        self.index = PrefixIndex(self.scan)
+
+    def runTest(self):
+        for i in range(60):
+            self.insert(self.random_flow())
+        # Nothing is built until asked
+        self.assertTrue(self.index.qualifies())
+        self.assertFalse(self.index.built())
+        by_priority = sorted(self.flows, 
+                             key=lambda flow: -flow.flow_mod.priority)
+        self.index.build(by_priority)
+        self.check_lookups()
+        # Kept in sync while built
+        for i in range(30):
+            self.insert(self.random_flow())
+        for flow in self.rand.sample(self.flows, 40):
+            self.remove(flow)
+        self.assertTrue(self.index.built())
+        self.check_lookups()
+
+class prefix_index_drop_test(prefix_index_test):
+    """
+    A flow that does not qualify drops the trie
+    """
+    def runTest(self):
+        for i in range(20):
+            self.insert(self.random_flow())
+        self.index.build(self.flows)
+        # Non-contiguous nw_src mask
+        irregular = self.flow(30, (0x0a000001, 32), (0x0a000001, 32),
+                              nw_src_mask=0x00ff00ff)
+        self.insert(irregular)
+        self.assertFalse(self.index.qualifies())
+        self.assertFalse(self.index.built())
+        self.check_lookups()
+        self.remove(irregular)
+        self.assertTrue(self.index.qualifies())
+        self.index.build(self.flows)
+        self.check_lookups()
+        # A flow comparing other fields
+        other = self.flow(30, (0x0a000001, 32), (0x0a000001, 32))
+        other.mask |= ofps_flow._FIELD_MASK["in_port"]
+        self.insert(other)
+        self.assertFalse(self.index.qualifies())
+        self.assertFalse(self.index.built())
+        self.remove(other)
+        for flow in list(self.flows):
+            self.remove(flow)
+        self.assertFalse(self.index.qualifies())
+        self.assertEqual(self.index.bases, {})
+        self.assertEqual(self.index.irregular, 0)
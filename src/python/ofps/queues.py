@@ -0,0 +1,674 @@
+######################################################################
+#
+# All files associated with the OpenFlow Python Switch (ofps) are
+# made available for public use and benefit with the expectation
+# that others will use, modify and enhance the Software and contribute
+# those enhancements back to the community. However, since we would
+# like to make the Software available for broadest use, with as few
+# restrictions as possible permission is hereby granted, free of
+# charge, to any person obtaining a copy of this Software to deal in
+# the Software under the copyrights without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject
+# to the following conditions:
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT.  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# 
+######################################################################
+
+
+"""
+Per-port egress queues
+
+A port with queues configured sends through them instead of straight
+to its interface.  Each queue is a FIFO with up to two token buckets:
+one filled at the queue's min rate, whose traffic the scheduler
+serves first, and one at its max rate, which caps the queue.  The
+bandwidth left once the guaranteed rates are met is shared by deficit
+round robin.  Every queue, queue 0 included, has an equal base weight
+of BASE_WEIGHT to which its min rate is added, so a queue with no min
+rate still gets a share of the spare bandwidth next to queues that
+have one.  A max rate of 0 blocks the queue; its packets wait until
+they are dropped as the queue overflows.  A scheduler thread
+drains the queues, so a bulk flow filling one queue cannot hold back
+the packets of another queue on the same port.
+
+Rates are in tenths of a percent of the port's current speed, as in
+ofp_queue_prop_min_rate; None means not configured.  Packets for a
+queue_id the port does not have go to its queue 0.
+
+The dataplane also keeps the ports' rx/tx counters (see portstats.py),
+counting every packet received, sent, dropped from a full queue or
+not fully sent, whichever thread handles it.
+
+Worker processes (see workers.py) have no scheduler of their own:
+they pass packets for queued ports to the switch process, so rates
+and counters cover all of the port's traffic.
+
+The ports receive into the ingress ring of ingress.py.
+"""
+
+import time
+import logging
+import unittest
+from collections import deque
+from threading import Thread
+from threading import Condition
+
+import oftest.cstruct as ofp
+import oftest.message as message
+from oftest import ofutils
+from portstats import port_stats_replies
+from portstats import TX_PACKETS, TX_DROPPED
+from ingress import IngressDataPlane
+from ingress import INGRESS_LIMIT
+
+# Packets held per queue; more are dropped and counted as tx_errors
+QUEUE_LIMIT = 1000
+# Seconds of traffic at its rate a token bucket can save up
+BURST_TIME = 0.05
+# Smallest token bucket, in bytes, so that any frame can conform
+BURST_MIN = 9216
+# Bytes a queue of weight BASE_WEIGHT may send per deficit round
+# robin turn
+QUANTUM = 1514
+# Weight every queue has besides its min rate, in the same tenths of
+# a percent
+BASE_WEIGHT = 100
+# Packets the scheduler takes per port before it services the others
+SCHEDULE_BATCH = 16
+# OFPQT_MIN_RATE of openflow.h; the generated cstruct has it as 0
+QUEUE_PROP_MIN_RATE = 1
+
+class TokenBucket(object):
+    """
+    A token bucket, in bytes, filled at rate bytes per second
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.depth = 0
+        if rate > 0:
+            self.depth = max(rate * BURST_TIME, BURST_MIN)
+        self.tokens = self.depth
+        self.stamp = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.depth, 
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self, size):
+        """
+        Return the seconds until size bytes of tokens are available,
+        or None if they never will be
+        """
+        if self.tokens >= size:
+            return 0
+        if self.rate <= 0:
+            return None
+        return (size - self.tokens) / self.rate
+
+class EgressQueue(object):
+    """
+    One egress queue of a port
+
+    @arg min_rate, max_rate The configured rates, in tenths of a percent
+    of the port speed, or None
+    @arg min_bucket, max_bucket Their token buckets, or None
+    @arg weight The queue's share of the spare bandwidth: BASE_WEIGHT
+    plus its min rate
+    """
+    def __init__(self, port_no, queue_id, speed, min_rate=None, 
+                 max_rate=None):
+        """
+        @param speed The port speed in kbps, as in ofp_port.curr_speed
+        """
+        self.port_no = port_no
+        self.queue_id = queue_id
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.min_bucket = None
+        self.max_bucket = None
+        # bytes per second for one tenth of a percent of the speed
+        unit = speed / 8.0
+        if min_rate is not None:
+            self.min_bucket = TokenBucket(min_rate * unit)
+        if max_rate is not None:
+            self.max_bucket = TokenBucket(max_rate * unit)
+        self.weight = BASE_WEIGHT + (min_rate or 0)
+        self.deficit = 0
+        self.packets = deque()
+        self.tx_packets = 0
+        self.tx_bytes = 0
+        self.tx_errors = 0
+
+    def refill(self, now):
+        if self.min_bucket is not None:
+            self.min_bucket.refill(now)
+        if self.max_bucket is not None:
+            self.max_bucket.refill(now)
+
+    def guaranteed(self, size):
+        """ Whether the next packet, of size bytes, is within min rate """
+        return self.min_bucket is not None and \
+            self.min_bucket.tokens >= size
+
+    def allowed(self, size):
+        """ Whether the next packet, of size bytes, is within max rate """
+        return self.max_bucket is None or self.max_bucket.tokens >= size
+
+    def take(self):
+        """
+        Dequeue the next packet, charging it to the queue
+        """
+        packet = self.packets.popleft()
+        size = len(packet)
+        if self.min_bucket is not None:
+            self.min_bucket.tokens = max(0, self.min_bucket.tokens - size)
+        if self.max_bucket is not None:
+            self.max_bucket.tokens -= size
+        self.tx_packets += 1
+        self.tx_bytes += size
+        return packet
+
+class PortQueues(object):
+    """
+    The egress queues of one port and their scheduler state
+    """
+    def __init__(self, port_no, speed):
+        self.port_no = port_no
+        self.speed = speed
+        self.queues = []
+        self.by_id = {}
+        # deficit round robin position, and whether the queue there
+        # got its quantum for this turn
+        self.turn = 0
+        self.granted = False
+
+    def add(self, queue):
+        old = self.by_id.get(queue.queue_id)
+        if old is not None:
+            self.queues.remove(old)
+        self.by_id[queue.queue_id] = queue
+        self.queues.append(queue)
+        self.queues.sort(key=lambda queue: queue.queue_id)
+        self.turn = 0
+        self.granted = False
+
+    def pick(self):
+        """
+        Return the queue to send from next, or None if every queue is
+        empty or over its max rate
+        """
+        queues = self.queues
+        eligible = False
+        for queue in queues:
+            if queue.packets:
+                size = len(queue.packets[0])
+                if not queue.allowed(size):
+                    continue
+                if queue.guaranteed(size):
+                    return queue
+                eligible = True
+        if not eligible:
+            return None
+        while True:
+            queue = queues[self.turn]
+            if queue.packets and queue.allowed(len(queue.packets[0])):
+                size = len(queue.packets[0])
+                if queue.deficit >= size:
+                    queue.deficit -= size
+                    return queue
+                if not self.granted:
+                    queue.deficit += QUANTUM * queue.weight // BASE_WEIGHT
+                    self.granted = True
+                    continue
+            elif not queue.packets:
+                queue.deficit = 0
+            self.turn = (self.turn + 1) % len(queues)
+            self.granted = False
+
+    def wait(self):
+        """
+        Return the seconds until a queue with packets is under its max
+        rate again, or None if all queues are empty or can never send
+        """
+        wait = None
+        for queue in self.queues:
+            if queue.packets:
+                size = len(queue.packets[0])
+                if queue.max_bucket is None:
+                    return 0
+                delay = queue.max_bucket.wait(size)
+                if delay is None:
+                    continue
+                if wait is None or delay < wait:
+                    wait = delay
+        return wait
+
+class PacketQueueDesc(ofp.ofp_packet_queue):
+    """
+    An ofp_packet_queue with its min rate property, if any, for a
+    queue_get_config_reply
+    """
+    def __init__(self, queue_id, min_rate=None):
+        ofp.ofp_packet_queue.__init__(self)
+        self.queue_id = queue_id
+        self.prop = None
+        if min_rate is not None:
+            self.prop = ofp.ofp_queue_prop_min_rate()
+            self.prop.prop_header.property = QUEUE_PROP_MIN_RATE
+            self.prop.prop_header.len = len(self.prop)
+            self.prop.rate = min_rate
+        self.len = len(self)
+
+    def pack(self, assertstruct=True):
+        packed = ofp.ofp_packet_queue.pack(self, assertstruct)
+        if self.prop is not None:
+            packed += self.prop.pack()
+        return packed
+
+    def __len__(self):
+        length = ofp.ofp_packet_queue.__len__(self)
+        if self.prop is not None:
+            length += len(self.prop)
+        return length
+
+class QueuedDataPlane(IngressDataPlane):
+    """
+    An IngressDataPlane whose send honours queue_id on ports with
+    queues, and that counts the packets it sends
+    """
+    def __init__(self, ingress_limit=INGRESS_LIMIT):
+        IngressDataPlane.__init__(self, ingress_limit)
+        # port_no -> PortQueues, for the ports that have queues
+        self.port_queues = {}
+        # Set in worker processes: called as (port, packet, queue_id)
+        # to pass a packet for a queued port to the switch process
+        self.queue_forward = None
+        self.queue_sync = Condition()
+        self.scheduler = None
+        self.scheduler_active = True
+        self.queue_logger = logging.getLogger("queues")
+
+    def queue_add(self, port_no, queue_id, speed, min_rate=None, 
+                  max_rate=None):
+        """
+        Configure an egress queue, replacing any with the same queue_id
+        The port also gets a queue 0 for packets without a queue.
+        @param speed The port speed in kbps, as in ofp_port.curr_speed
+        """
+        self.queue_sync.acquire()
+        port_queues = self.port_queues.get(port_no)
+        if port_queues is None:
+            port_queues = PortQueues(port_no, speed)
+            port_queues.add(EgressQueue(port_no, 0, speed))
+        port_queues.add(EgressQueue(port_no, queue_id, speed, 
+                                    min_rate, max_rate))
+        # Readers take no lock, so swap in a new dict
+        port_map = dict(self.port_queues)
+        port_map[port_no] = port_queues
+        self.port_queues = port_map
+        self.queue_sync.release()
+        self.queue_logger.info("Port %d queue %d: min rate %s, max rate %s" %
+                               (port_no, queue_id, min_rate, max_rate))
+        if self.scheduler is None:
+            self.scheduler = Thread(target=self._schedule_run)
+            self.scheduler.setDaemon(True)
+            self.scheduler.start()
+
+    def send(self, port_number, packet, queue_id=0):
+        """
+        Send a packet to the given port, through its queue if the port
+        has queues
+        """
+        port_queues = self.port_queues.get(port_number)
+        if port_queues is None:
+            return self._transmit(port_number, packet)
+        if self.queue_forward is not None:
+            self.queue_forward(port_number, packet, queue_id)
+            return len(packet)
+        queue = port_queues.by_id.get(queue_id)
+        if queue is None:
+            queue = port_queues.by_id[0]
+        self.queue_sync.acquire()
+        if len(queue.packets) >= QUEUE_LIMIT:
+            queue.tx_errors += 1
+            self.counters.tx_dropped(port_number)
+        else:
+            queue.packets.append(packet)
+            self.queue_sync.notify()
+        self.queue_sync.release()
+        return len(packet)
+
+    def send_multi(self, port_numbers, packet, queue_id=0):
+        port_queues = self.port_queues
+        for port_number in port_numbers:
+            if port_number in port_queues:
+                self.send(port_number, packet, queue_id)
+            else:
+                self._transmit(port_number, packet)
+
+    def _transmit(self, port_number, packet):
+        """
+        Hand a packet to the port's interface and count it
+        """
+        bytes = self.port_list[port_number].send(packet)
+        if bytes == len(packet):
+            self.counters.tx(port_number, bytes)
+        else:
+            self.counters.tx_error(port_number)
+            self.logger.error("Unhandled send error" +
+                     ", port %d, length mismatch %d != %d" %
+                     (port_number, bytes, len(packet)))
+        return bytes
+
+    def _schedule_batch(self, now):
+        """
+        Take a batch of packets from each port in turn; call with
+        queue_sync held
+        @return (batch, wait): the (port_no, packet) pairs to send and
+        the seconds until another queue may send, or None
+        """
+        batch = []
+        wait = None
+        for port_queues in self.port_queues.itervalues():
+            try:
+                for queue in port_queues.queues:
+                    queue.refill(now)
+                for count in range(SCHEDULE_BATCH):
+                    queue = port_queues.pick()
+                    if queue is None:
+                        break
+                    batch.append((port_queues.port_no, queue.take()))
+                delay = port_queues.wait()
+            except Exception:
+                self.queue_logger.exception("Scheduling port %d" % 
+                                            port_queues.port_no)
+                continue
+            if delay is not None and (wait is None or delay < wait):
+                wait = delay
+        return (batch, wait)
+
+    def _schedule_run(self):
+        """
+        Thread draining the queues
+        Takes a batch of packets from each port in turn under the lock
+        and sends them after releasing it.  A port whose queues fail to
+        schedule or send is logged and skipped, so it cannot stop the
+        thread for the other ports.
+        """
+        self.queue_sync.acquire()
+        while self.scheduler_active:
+            (batch, wait) = self._schedule_batch(time.time())
+            if batch:
+                self.queue_sync.release()
+                for port_number, packet in batch:
+                    try:
+                        self._transmit(port_number, packet)
+                    except Exception:
+                        self.counters.tx_error(port_number)
+                        self.queue_logger.exception("Sending to port %d" %
+                                                    port_number)
+                self.queue_sync.acquire()
+            elif wait is None:
+                self.queue_sync.wait(1)
+            else:
+                self.queue_sync.wait(max(wait, 0.001))
+        self.queue_sync.release()
+
+    def kill(self, join_threads=True):
+        self.queue_sync.acquire()
+        self.scheduler_active = False
+        self.queue_sync.notify()
+        self.queue_sync.release()
+        IngressDataPlane.kill(self, join_threads)
+
+    def port_stats_get(self, request):
+        """
+        Return the port_stats_replies for the request: one port, or all
+        ports if port_no is OFPP_ANY, in as many replies as they need
+        OF1.1 has no error for an unknown port, so it gets no entries.
+        """
+        if request.port_no == ofp.OFPP_ANY:
+            port_nos = sorted(self.port_list.keys())
+        elif request.port_no in self.port_list:
+            port_nos = [request.port_no]
+        else:
+            port_nos = []
+        return port_stats_replies(request, port_nos, self.counters.totals())
+
+    def _queues_select(self, port_no, queue_id, request):
+        """
+        Return (queues, error) for the port and queue of a request,
+        either of which may be a wildcard
+        """
+        if port_no == ofp.OFPP_ANY:
+            port_list = self.port_queues.values()
+        elif port_no in self.port_queues:
+            port_list = [self.port_queues[port_no]]
+        elif port_no in self.port_list:
+            # A port without queues
+            port_list = []
+        else:
+            return (None, ofutils.of_error_msg_make(ofp.OFPET_QUEUE_OP_FAILED,
+                                                    ofp.OFPQOFC_BAD_PORT, 
+                                                    request))
+        queues = []
+        for port_queues in port_list:
+            if queue_id == ofp.OFPQ_ALL:
+                queues += port_queues.queues
+            elif queue_id in port_queues.by_id:
+                queues.append(port_queues.by_id[queue_id])
+        if not queues and queue_id != ofp.OFPQ_ALL:
+            return (None, ofutils.of_error_msg_make(ofp.OFPET_QUEUE_OP_FAILED,
+                                                    ofp.OFPQOFC_BAD_QUEUE, 
+                                                    request))
+        return (queues, None)
+
+    def queue_stats_get(self, request):
+        """
+        Return a queue_stats_reply for the request, or an error message
+        """
+        (queues, error) = self._queues_select(request.port_no, 
+                                              request.queue_id, request)
+        if error is not None:
+            return error
+        reply = message.queue_stats_reply()
+        reply.header.xid = request.header.xid
+        for queue in queues:
+            stat = message.queue_stats_entry()
+            stat.port_no = queue.port_no
+            stat.queue_id = queue.queue_id
+            stat.tx_packets = queue.tx_packets
+            stat.tx_bytes = queue.tx_bytes
+            stat.tx_errors = queue.tx_errors
+            reply.stats.append(stat)
+        return reply
+
+    def queue_config_get(self, request):
+        """
+        Return a queue_get_config_reply for the request, or an error
+        """
+        if request.port == ofp.OFPP_ANY:
+            return ofutils.of_error_msg_make(ofp.OFPET_QUEUE_OP_FAILED,
+                                             ofp.OFPQOFC_BAD_PORT, request)
+        (queues, error) = self._queues_select(request.port, ofp.OFPQ_ALL,
+                                              request)
+        if error is not None:
+            return error
+        reply = message.queue_get_config_reply()
+        reply.header.xid = request.header.xid
+        reply.port = request.port
+        for queue in queues:
+            reply.queues.append(PacketQueueDesc(queue.queue_id, 
+                                                queue.min_rate))
+        return reply
+
+class queue_schedule_test(unittest.TestCase):
+    """
+    Drive the scheduler of one 8 Mbps port by hand: one tenth of a
+    percent of its speed is 1000 bytes per second
+    """
+    def setUp(self):
+        self.port_queues = PortQueues(1, 8000)
+        self.port_queues.add(EgressQueue(1, 0, 8000))
+
+    def queue(self, queue_id, min_rate=None, max_rate=None, count=50):
+        queue = EgressQueue(1, queue_id, 8000, min_rate, max_rate)
+        self.port_queues.add(queue)
+        for idx in range(count):
+            queue.packets.append("%d" % queue_id * 1000)
+        return queue
+
+    def picks(self, count):
+        picks = []
+        for idx in range(count):
+            queue = self.port_queues.pick()
+            if queue is None:
+                break
+            queue.take()
+            picks.append(queue.queue_id)
+        return picks
+
+    def runTest(self):
+        guaranteed = self.queue(1, min_rate=100, count=100)
+        self.queue(2, count=100)
+        # q1's 9216 byte min rate bucket is served first
+        self.assertEqual(self.picks(9), [1] * 9)
+        # Then the spare bandwidth is shared 200:100 by weight, so q2
+        # is not starved by q1
+        picks = self.picks(60)
+        self.assertTrue(2 in picks[:4])
+        self.assertTrue(39 <= picks.count(1) <= 41)
+        # Once q1's min rate bucket refills it is served first again
+        guaranteed.refill(guaranteed.min_bucket.stamp + 0.01)
+        self.assertEqual(self.picks(1), [1])
+
+class queue_max_rate_test(queue_schedule_test):
+    def runTest(self):
+        capped = self.queue(1, max_rate=50)
+        # 9216 bytes of burst, then q1 waits for its 50000 bytes/s
+        self.assertEqual(self.picks(20), [1] * 9)
+        self.assertAlmostEqual(self.port_queues.wait(), 784 / 50000.0)
+        # Other queues go on sending meanwhile
+        self.queue(2, count=2)
+        self.assertEqual(self.picks(20), [2, 2])
+        capped.refill(capped.max_bucket.stamp + 0.1)
+        self.assertEqual(self.picks(20), [1] * 5)
+
+class queue_zero_rate_test(queue_schedule_test):
+    def runTest(self):
+        blocked = self.queue(1, min_rate=0, max_rate=0)
+        self.assertEqual(blocked.weight, BASE_WEIGHT)
+        # Never eligible, without a wait to schedule
+        self.assertEqual(self.picks(20), [])
+        self.assertEqual(self.port_queues.wait(), None)
+        blocked.refill(blocked.max_bucket.stamp + 10)
+        self.assertEqual(self.picks(20), [])
+        self.queue(2, count=2)
+        self.assertEqual(self.picks(20), [2, 2])
+        self.assertEqual(self.port_queues.wait(), None)
+
+class queue_dataplane_test(unittest.TestCase):
+    """
+    A QueuedDataPlane whose scheduler the test runs, over ports that
+    record what they are sent
+    """
+    class TestPort(object):
+        def __init__(self):
+            self.sent = []
+
+        def send(self, packet, queue_id=0):
+            self.sent.append(packet)
+            return len(packet)
+
+        def kill(self):
+            pass
+
+        def join(self):
+            pass
+
+    def setUp(self):
+        self.dataplane = QueuedDataPlane()
+        for port_no in [1, 2]:
+            self.dataplane.port_list[port_no] = self.TestPort()
+        # No scheduler thread: the test calls _schedule_batch
+        self.dataplane.scheduler_active = False
+        self.dataplane.queue_add(1, 1, 8000, 100, None)
+        self.dataplane.queue_add(1, 2, 8000, None, 0)
+
+    def tearDown(self):
+        self.dataplane.kill()
+
+    def error_code(self, reply):
+        self.assertEqual(reply.header.type, ofp.OFPT_ERROR)
+        self.assertEqual(reply.type, ofp.OFPET_QUEUE_OP_FAILED)
+        return reply.code
+
+    def runTest(self):
+        dataplane = self.dataplane
+        for idx in range(QUEUE_LIMIT + 3):
+            dataplane.send(1, "x" * 100, 2)
+        dataplane.send(1, "y" * 100, 1)
+        dataplane.send(1, "z" * 100, 7)
+        dataplane.send(2, "w" * 100, 1)
+        (batch, wait) = dataplane._schedule_batch(time.time())
+        self.assertEqual(wait, None)
+        for (port_no, packet) in batch:
+            dataplane._transmit(port_no, packet)
+        self.assertEqual(dataplane.port_list[1].sent, ["y" * 100, "z" * 100])
+        self.assertEqual(dataplane.port_list[2].sent, ["w" * 100])
+        # Drops from the full queue are tx_errors of the queue and
+        # tx_dropped of the port
+        totals = dataplane.counters.totals()
+        self.assertEqual(totals[1][TX_PACKETS], 2)
+        self.assertEqual(totals[1][TX_DROPPED], 3)
+
+        request = message.queue_stats_request()
+        request.header.xid = 5
+        request.port_no = 1
+        request.queue_id = ofp.OFPQ_ALL
+        reply = dataplane.queue_stats_get(request)
+        self.assertEqual(reply.header.xid, 5)
+        self.assertEqual([(stat.port_no, stat.queue_id, stat.tx_packets,
+                           stat.tx_bytes, stat.tx_errors) 
+                          for stat in reply.stats],
+                         [(1, 0, 1, 100, 0), (1, 1, 1, 100, 0),
+                          (1, 2, 0, 0, 3)])
+        request.port_no = ofp.OFPP_ANY
+        request.queue_id = 1
+        self.assertEqual(len(dataplane.queue_stats_get(request).stats), 1)
+        # A port without queues has none to report, an unknown one is
+        # an error
+        request.port_no = 2
+        self.assertEqual(self.error_code(dataplane.queue_stats_get(request)),
+                         ofp.OFPQOFC_BAD_QUEUE)
+        request.queue_id = ofp.OFPQ_ALL
+        self.assertEqual(dataplane.queue_stats_get(request).stats, [])
+        request.port_no = 3
+        self.assertEqual(self.error_code(dataplane.queue_stats_get(request)),
+                         ofp.OFPQOFC_BAD_PORT)
+
+        request = message.queue_get_config_request()
+        request.port = 1
+        reply = dataplane.queue_config_get(request)
+        self.assertEqual(reply.port, 1)
+        self.assertEqual([(queue.queue_id, queue.prop and queue.prop.rate)
+                          for queue in reply.queues],
+                         [(0, None), (1, 100), (2, None)])
+        self.assertEqual(len(reply.pack()), len(reply))
+        request.port = 2
+        reply = dataplane.queue_config_get(request)
+        self.assertEqual((reply.port, reply.queues), (2, []))
+        request.port = 3
+        self.assertEqual(self.error_code(dataplane.queue_config_get(request)),
+                         ofp.OFPQOFC_BAD_PORT)
@@ -8,6 +8,15 @@ Created on Nov 23, 2010
 import unittest
 # this is the magic that SHOULD get all the unittests from the module
 
+from classifier import *
+from prefixtrie import *
+from flowtable import *
+from groups import *
+from portstats import *
+from ingress import *
+from queues import *
+from pipeline import *
+
 
 if __name__ == '__main__':
     unittest.main()
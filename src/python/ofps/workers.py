@@ -0,0 +1,324 @@
+######################################################################
+#
+# All files associated with the OpenFlow Python Switch (ofps) are
+# made available for public use and benefit with the expectation
+# that others will use, modify and enhance the Software and contribute
+# those enhancements back to the community. However, since we would
+# like to make the Software available for broadest use, with as few
+# restrictions as possible permission is hereby granted, free of
+# charge, to any person obtaining a copy of this Software to deal in
+# the Software under the copyrights without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject
+# to the following conditions:
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT.  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# 
+######################################################################
+
+"""
+Sharding of packet forwarding over worker processes
+
+The switch process keeps the controller connection, the dataplane
+ports and the authoritative copy of the flow tables.  Received packets
+are hashed on their 5-tuple and handed, in batches, to one of N worker
+processes, each forwarding with its own replica of the pipeline.
+
+Replicas are kept in step with an ordered update log: every flow_mod,
+table_mod and group_mod applied by the switch, every flow removed by
+expiry and every port config change is appended to each worker's
+queue, under the pipeline's update_sync so all workers see the same
+order.  Since the replicas apply the same updates in the same order,
+flows get the same flow_id everywhere.
+
+Workers keep the per-flow, per-table and per-port counters for the
+packets they forward.  counters_sync() collects them and stores the
+sums in the switch's tables and port counters, where stats replies
+and idle expiry read them.
+Packet-ins raised by a worker are sent to the controller by the switch,
+and packets for ports with egress queues are queued by the switch.
+"""
+
+import struct
+import time
+import logging
+import multiprocessing
+from threading import Thread
+from threading import Condition
+from threading import Lock
+
+from pipeline import FlowPipeline
+from portstats import PortCounters
+from oftest.packet import Packet
+from oftest.packet import LAYER_NONE
+
+# Packets handed to a worker per queue operation
+BATCH_SIZE = 32
+# Seconds to wait for workers' counters
+SYNC_TIMEOUT = 2
+
+def flow_hash(data):
+    """
+    Hash a raw packet on its IPv4 5-tuple, or on its MAC addresses if
+    it is not IPv4, so all packets of a flow go to the same worker
+    @param data The packet as a string
+    """
+    offset = 12
+    if len(data) < offset + 2:
+        return hash(data)
+    (eth_type,) = struct.unpack_from("!H", data, offset)
+    if eth_type == 0x8100 and len(data) >= offset + 6:
+        offset += 4
+        (eth_type,) = struct.unpack_from("!H", data, offset)
+    ip = offset + 2
+    if eth_type != 0x0800 or len(data) < ip + 20:
+        return hash(data[0:12])
+    ihl = (ord(data[ip]) & 0xf) * 4
+    proto = data[ip + 9]
+    key = data[ip + 12:ip + 20] + proto
+    if proto == '\x06' or proto == '\x11':   # TCP, UDP ports
+        key += data[ip + ihl:ip + ihl + 4]
+    return hash(key)
+
+class WorkerController(object):
+    """
+    Stands in for the controller connection inside a worker; messages
+    are passed to the switch process to send
+    """
+    def __init__(self, results):
+        self.results = results
+
+    def message_send(self, msg, zero_xid=False):
+        self.results.put(('message', msg, zero_xid))
+        return 0
+
+    def isAlive(self):
+        return True
+
+def worker_main(switch, index, updates, results):
+    """
+    Main loop of a worker process
+    Runs in a child forked from the switch after its ports were set
+    up, so switch is the child's own copy of the OFSwitch; the
+    dataplane ports' handles are shared with the switch for sending.
+    @param index This worker's index in the pool
+    @param updates Queue of lists of (kind, ...) items for this worker
+    @param results Queue back to the switch process
+    """
+    logger = logging.getLogger("worker%d" % index)
+    switch.workers = None
+    switch.controller = WorkerController(results)
+    # Counts from before the fork are the switch's
+    switch.dataplane.counters = PortCounters()
+    # Queued ports are scheduled by the switch process
+    switch.dataplane.queue_forward = lambda port, data, queue_id: \
+        results.put(('queued', port, data, queue_id))
+    # The switch process does expiry, so the pipeline thread is not run
+    pipeline = FlowPipeline(switch, switch.config.n_tables,
+                            switch.config.cache_size)
+    switch.pipeline = pipeline
+    for table in pipeline.tables:
+        table.hit_log = set()
+    logger.info("Worker %d started" % index)
+    while True:
+        for item in updates.get():
+            kind = item[0]
+            if kind == 'packet':
+                packet = Packet(in_port=item[1], data=item[2],
+                                layer=LAYER_NONE)
+                pipeline.apply_pipeline(switch, packet)
+            elif kind == 'flow_mod':
+                pipeline.flow_mod_process(item[1], switch.groups)
+            elif kind == 'flow_remove':
+                pipeline.tables[item[1]].flows_remove(item[2])
+                pipeline.invalidate()
+            elif kind == 'table_mod':
+                pipeline.table_mod_process(item[1])
+            elif kind == 'group_mod':
+                pipeline.group_mod_process(item[1], switch.groups)
+            elif kind == 'ports':
+                switch.ports = item[1]
+                switch.ports_update()
+                pipeline.invalidate()
+            elif kind == 'sync':
+                counters = []
+                for table in pipeline.tables:
+                    flows = [(flow.flow_id, flow.counters.packets, 
+                              flow.counters.bytes, flow.counters.last_hit) 
+                             for flow in table.hit_log]
+                    table.hit_log = set()
+                    counters.append((table.lookup_count, 
+                                     table.matched_count, flows))
+                results.put(('counters', index, item[1], counters,
+                             switch.dataplane.counters.totals()))
+            elif kind == 'stop':
+                logger.info("Worker %d exiting" % index)
+                return
+            else:
+                logger.error("Unknown update %s" % str(kind))
+
+class WorkerPool(object):
+    """
+    The worker processes of a switch, from the switch process's side
+    """
+    def __init__(self, switch, n_workers):
+        self.switch = switch
+        self.n_workers = n_workers
+        self.logger = logging.getLogger("workers")
+        self.queues = [multiprocessing.Queue() for idx in range(n_workers)]
+        self.results = multiprocessing.Queue()
+        # Packets not yet handed over, per worker
+        self.batches = [[] for idx in range(n_workers)]
+        self.processes = []
+        self.reader = None
+        # worker index -> [(lookup_count, matched_count)] per table
+        self.table_counters = [None] * n_workers
+        self.sync_lock = Lock()
+        self.sync_cond = Condition()
+        self.sync_token = 0
+        self.sync_waiting = 0
+
+    def start(self):
+        """
+        Fork the workers; call once the switch's ports are set up
+        and before any flows are installed
+        """
+        for idx in range(self.n_workers):
+            process = multiprocessing.Process(target=worker_main,
+                    args=(self.switch, idx, self.queues[idx], self.results))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        self.reader = Thread(target=self._results_run)
+        self.reader.setDaemon(True)
+        self.reader.start()
+        self.logger.info("Started %d workers" % self.n_workers)
+
+    def kill(self):
+        self.update(('stop',))
+        self.results.put(None)
+        for process in self.processes:
+            process.join(1)
+
+    def isAlive(self):
+        for process in self.processes:
+            if not process.is_alive():
+                return False
+        return True
+
+    def dispatch(self, of_port, data):
+        """
+        Queue a received packet for the worker owning its flow
+        Called from the switch's packet loop only
+        """
+        idx = flow_hash(data) % self.n_workers
+        batch = self.batches[idx]
+        batch.append(('packet', of_port, data))
+        if len(batch) >= BATCH_SIZE:
+            self.queues[idx].put(batch)
+            self.batches[idx] = []
+
+    def flush(self):
+        """
+        Hand over all partial batches
+        Called from the switch's packet loop only, once per ingress burst
+        """
+        for idx in range(self.n_workers):
+            if self.batches[idx]:
+                self.queues[idx].put(self.batches[idx])
+                self.batches[idx] = []
+
+    def update(self, item):
+        """
+        Append an update to every worker's log
+        @attention: caller must hold pipeline.update_sync, which is
+        what orders the log
+        """
+        for queue in self.queues:
+            queue.put([item])
+
+    def counters_sync(self):
+        """
+        Collect the workers' counters into the switch's tables
+        Waits at most SYNC_TIMEOUT for the workers to answer
+        """
+        self.sync_lock.acquire()
+        self.sync_cond.acquire()
+        self.sync_token += 1
+        self.sync_waiting = self.n_workers
+        for queue in self.queues:
+            queue.put([('sync', self.sync_token)])
+        deadline = time.time() + SYNC_TIMEOUT
+        while self.sync_waiting > 0:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.logger.error("Timed out waiting for worker counters")
+                break
+            self.sync_cond.wait(remaining)
+        self.sync_cond.release()
+        self.sync_lock.release()
+
+    def _counters_merge(self, index, counters):
+        """
+        Store a worker's counters and update the sums in the tables
+        Worker counters are totals, not deltas, so a late or repeated
+        report is harmless
+        """
+        self.table_counters[index] = [(lookups, matched) for 
+                                      lookups, matched, flows in counters]
+        tables = self.switch.pipeline.tables
+        for table_id, (lookups, matched, flows) in enumerate(counters):
+            table = tables[table_id]
+            table.lookup_count = sum([worker[table_id][0] for worker in
+                                      self.table_counters if worker])
+            table.matched_count = sum([worker[table_id][1] for worker in
+                                       self.table_counters if worker])
+            for flow_id, packets, bytes, last_hit in flows:
+                flow = table.flows_by_id.get(flow_id)
+                if flow is None:    # since removed
+                    continue
+                flow_counters = flow.counters
+                if flow_counters.worker_counters is None:
+                    flow_counters.worker_counters = {}
+                worker_counters = flow_counters.worker_counters
+                worker_counters[index] = (packets, bytes)
+                flow_counters.packets = sum([count[0] for count in 
+                                             worker_counters.values()])
+                flow_counters.bytes = sum([count[1] for count in 
+                                           worker_counters.values()])
+                if last_hit > flow_counters.last_hit:
+                    flow_counters.last_hit = last_hit
+
+    def _results_run(self):
+        """
+        Thread relaying packet-ins, queued packets and counters from
+        the workers
+        """
+        while True:
+            item = self.results.get()
+            if item is None:
+                return
+            if item[0] == 'message':
+                self.switch.controller.message_send(item[1], 
+                                                    zero_xid=item[2])
+            elif item[0] == 'queued':
+                self.switch.dataplane.send(item[1], item[2], 
+                                           queue_id=item[3])
+            elif item[0] == 'counters':
+                (kind, index, token, counters, port_counters) = item
+                self.sync_cond.acquire()
+                self._counters_merge(index, counters)
+                self.switch.dataplane.counters.worker_set(index, 
+                                                          port_counters)
+                if token == self.sync_token:
+                    self.sync_waiting -= 1
+                    self.sync_cond.notify()
+                self.sync_cond.release()
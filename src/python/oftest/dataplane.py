@@ -179,8 +179,7 @@ class DataPlanePort(Thread):
         @param queue_id The queue to send to (to be implemented)
         @retval The number of bytes sent
         """
-        self.logger.debug("Pkt len " + str(len(packet)) +
-             " out")
+        self.logger.debug("Pkt len %d out", len(packet))
         try:
             ret = self.pcap.inject(packet, len(packet))
         except OSError, msg:
@@ -254,14 +253,32 @@ class DataPlane:
         @param queue_id The queue to send to (to be implemented)
         """
         #@todo Verify port_number is in keys of port_list
-        self.logger.debug("Sending %d bytes to port %d" %
-                          (len(packet), port_number))
+        self.logger.debug("Sending %d bytes to port %d",
+                          len(packet), port_number)
         bytes = self.port_list[port_number].send(packet, queue_id=queue_id)
         if bytes != len(packet):
             self.logger.error("Unhandled send error, length mismatch %d != %d" %
                      (bytes, len(packet)))
         return bytes
 
+    def send_multi(self, port_numbers, packet, queue_id=0):
+        """
+        Send the same packet to several ports
+        @param port_numbers The ports to send the data to
+        @param packet Raw packet data to send to the ports
+        @param queue_id The queue to send to (to be implemented)
+        """
+        length = len(packet)
+        self.logger.debug("Sending %d bytes to ports %s",
+                          length, port_numbers)
+        port_list = self.port_list
+        for port_number in port_numbers:
+            bytes = port_list[port_number].send(packet, queue_id=queue_id)
+            if bytes != length:
+                self.logger.error("Unhandled send error" +
+                         ", port %d, length mismatch %d != %d" %
+                         (port_number, bytes, length))
+
     def flood(self, packet):
         """
         Send a packet to all ports
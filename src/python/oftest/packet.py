@@ -41,6 +41,7 @@ import unittest
 import binascii
 import string
 import collections #@UnresolvedImport
+import operator
 import oftest.action as action
 
 ETHERTYPE_IP = 0x0800
@@ -56,6 +57,143 @@ NW_MASK_ALL = 0xffffffff
 
 MPLS_BOTTOM_OF_STACK = 0x00000100
 
+# Header layers, in the order they are decoded (see Packet.decode)
+LAYER_NONE = 0
+LAYER_L2 = 1            # ethernet, VLAN and MPLS tags
+LAYER_L3 = 2            # IPv4 header
+LAYER_L4 = 3            # TCP/UDP ports, ICMP type and code
+
+# The fields of a PacketKey, in order.  MAC addresses are kept as
+# integers.
+KEY_FIELDS = ("in_port", "metadata", "dl_dst", "dl_src", "dl_vlan",
+              "dl_vlan_pcp", "dl_type", "mpls_label", "mpls_tc", "nw_tos",
+              "nw_proto", "nw_src", "nw_dst", "tp_src", "tp_dst")
+(KEY_IN_PORT, KEY_METADATA, KEY_DL_DST, KEY_DL_SRC, KEY_DL_VLAN,
+ KEY_DL_VLAN_PCP, KEY_DL_TYPE, KEY_MPLS_LABEL, KEY_MPLS_TC, KEY_NW_TOS,
+ KEY_NW_PROTO, KEY_NW_SRC, KEY_NW_DST, KEY_TP_SRC, KEY_TP_DST) = \
+    range(len(KEY_FIELDS))
+
+# Precompiled header layouts, read with unpack_from straight out of
+# the packet buffer
+_struct_H = struct.Struct("!H")
+_struct_HH = struct.Struct("!HH")
+_struct_L = struct.Struct("!L")
+_struct_BB = struct.Struct("!BB")
+# Ethernet: destination and source MACs as 16 + 32 bits, ethertype
+_struct_eth = struct.Struct("!HLHLH")
+# IPv4: version/header length, tos, protocol, source, destination
+_struct_ip = struct.Struct("!BB7xB2xLL")
+
+def _mac_to_int(mac):
+    value = 0
+    for byte in mac:
+        value = (value << 8) | byte
+    return value
+
+def _int_to_mac(value):
+    return [(value >> shift) & 0xff for shift in (40, 32, 24, 16, 8, 0)]
+
+class PacketKey(tuple):
+    """
+    The fields of a packet the flow tables match on
+
+    An immutable, hashable tuple of the KEY_FIELDS values, also
+    readable by name.  A packet whose headers are rewritten gets a
+    new key from derive(); keys are never changed in place, so they
+    can be shared and used as dictionary keys.
+    """
+    __slots__ = ()
+
+    def __new__(cls, fields):
+        return tuple.__new__(cls, fields)
+
+    def derive(self, *changes):
+        """
+        Return a copy of the key with some fields changed
+        @param changes (KEY_* index, value) pairs
+        """
+        fields = list(self)
+        for (index, value) in changes:
+            fields[index] = value
+        return tuple.__new__(PacketKey, fields)
+
+    def __repr__(self):
+        return "PacketKey(%s)" % ", ".join(["%s=%r" % field for field in
+                                           zip(KEY_FIELDS, self)])
+
+    in_port = property(operator.itemgetter(KEY_IN_PORT))
+    metadata = property(operator.itemgetter(KEY_METADATA))
+    dl_dst = property(operator.itemgetter(KEY_DL_DST))
+    dl_src = property(operator.itemgetter(KEY_DL_SRC))
+    dl_vlan = property(operator.itemgetter(KEY_DL_VLAN))
+    dl_vlan_pcp = property(operator.itemgetter(KEY_DL_VLAN_PCP))
+    dl_type = property(operator.itemgetter(KEY_DL_TYPE))
+    mpls_label = property(operator.itemgetter(KEY_MPLS_LABEL))
+    mpls_tc = property(operator.itemgetter(KEY_MPLS_TC))
+    nw_tos = property(operator.itemgetter(KEY_NW_TOS))
+    nw_proto = property(operator.itemgetter(KEY_NW_PROTO))
+    nw_src = property(operator.itemgetter(KEY_NW_SRC))
+    nw_dst = property(operator.itemgetter(KEY_NW_DST))
+    tp_src = property(operator.itemgetter(KEY_TP_SRC))
+    tp_dst = property(operator.itemgetter(KEY_TP_DST))
+
+_KEY_INDEX = dict((name, index) for (index, name) in enumerate(KEY_FIELDS))
+
+class PacketMatch(object):
+    """
+    A read-only ofp_match view of the headers of a packet
+
+    Every read goes to the packet's current key, so a match held
+    across header rewrites follows them, as the ofp_match the packet
+    used to update in place did.  The key fields are read directly;
+    anything else (masks, pack(), show(), ...) is read from an
+    ofp_match built by snapshot().
+    """
+    __slots__ = ("packet",)
+
+    def __init__(self, packet):
+        self.packet = packet
+
+    def snapshot(self):
+        """ Return an ofp_match copy of the packet's current headers """
+        packet = self.packet
+        match = ofp.ofp_match()
+        match.type = ofp.OFPMT_STANDARD
+        match.length = ofp.OFPMT_STANDARD_LENGTH
+        (match.in_port, match.metadata, dl_dst, dl_src, match.dl_vlan,
+         match.dl_vlan_pcp, match.dl_type, match.mpls_label, match.mpls_tc,
+         match.nw_tos, match.nw_proto, match.nw_src, match.nw_dst,
+         match.tp_src, match.tp_dst) = packet.key
+        match.dl_dst = _int_to_mac(dl_dst)
+        match.dl_src = _int_to_mac(dl_src)
+        if packet.decoded >= LAYER_L2:
+            match.dl_dst_mask = DL_MASK_ALL
+            match.dl_src_mask = DL_MASK_ALL
+        if packet.ip_header_offset is not None:
+            match.nw_src_mask = NW_MASK_ALL
+            match.nw_dst_mask = NW_MASK_ALL
+        return match
+
+    def __getattr__(self, name):
+        index = _KEY_INDEX.get(name)
+        if index is None:
+            return getattr(self.snapshot(), name)
+        value = self.packet.key[index]
+        if index == KEY_DL_DST or index == KEY_DL_SRC:
+            return _int_to_mac(value)
+        return value
+
+    def __eq__(self, other):
+        if isinstance(other, PacketMatch):
+            other = other.snapshot()
+        return self.snapshot() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __len__(self):
+        return len(self.snapshot())
+
 # Sigh.. not python26
 #MplsTag = collections.namedtuple("MplsTag", "label tc ttl")
 
@@ -92,12 +230,19 @@ class Packet(object):
     
     icmp_counter = 1
 
-    def __init__(self, in_port=None, data=""):
+    def __init__(self, in_port=None, data="", layer=LAYER_L4):
+        """
+        @param in_port The port the packet came in on
+        @param data The packet contents
+        @param layer The header layer to decode up to right away;
+        decode() does the rest when it is needed
+        """
         # Use entries in match when possible.
         self.in_port = in_port
-        self.data = data
-        self.bytes = len(data)
-        self.match = ofp.ofp_match()
+        self.buf = bytearray(data)
+        self.buf_shared = False             # buf is shared with a clone
+        self.bytes = len(self.buf)
+        self.key = PacketKey((in_port,) + (0,) * (len(KEY_FIELDS) - 1))
         self.logger = logging.getLogger("packet")  
         self.instructions = []
         # parsable tags
@@ -105,24 +250,55 @@ class Packet(object):
         self.tcp_header_offset = None
         self.mpls_tag_offset = None         # pointer to outer mpls tag
         self.vlan_tag_offset = None         # pointer to outer vlan tag
-        self.action_set = {}
+        self.parsed = False                 # offsets above are valid
+        self.decoded = LAYER_L4             # last header layer decoded
+        self.parse_idx = 0                  # where the next layer starts
+        # pending checksum changes, see update_checksums()
+        self.ip_csum_delta = 0
+        self.l4_csum_delta = 0
+        self.action_set = [None] * ACTION_SET_SLOTS
+        self.action_set_bits = 0
         self.queue_id = 0
 
-        if self.data != "":
-            self.parse()
+        if self.buf:
+            self.parse(layer)
+
+    def _get_data(self):
+        if self.ip_csum_delta or self.l4_csum_delta:
+            self.update_checksums()
+        return str(self.buf)
+
+    def _set_data(self, data):
+        self.buf = bytearray(data)
+        self.buf_shared = False
+        self.parsed = False
+        self.ip_csum_delta = 0
+        self.l4_csum_delta = 0
+
+    # The packet contents live in the mutable buffer self.buf, which
+    # the header setters rewrite in place; data is the immutable copy,
+    # produced on demand (e.g. once per output)
+    data = property(_get_data, _set_data)
+
+    def _get_match(self):
+        return PacketMatch(self)
+
+    # The decoded headers are kept in the PacketKey self.key; match
+    # is a read-through ofp_match view of them (see PacketMatch)
+    match = property(_get_match)
 
     def show(self):
         """ Return a ascii hex representation of the packet's data"""
         ret = ""
         c = 0
-        for b in list(self.data):
+        for b in self.buf:
             if c != 0:
                 if c % 16  == 0:
                     ret += '\n'
                 elif c % 8 == 0:
                     ret += '  '
             c += 1
-            ret += "%0.2x " % struct.unpack('B', b)
+            ret += "%0.2x " % b
         return ret
 
     def __repr__(self):
@@ -132,7 +308,7 @@ class Packet(object):
         return  self.__repr__()
 
     def __len__(self):
-        return len(self.data)
+        return len(self.buf)
 
     def simple_tcp_packet(self,
                           pktlen=100, 
@@ -171,14 +347,14 @@ class Packet(object):
         Generates a simple TCP request.  Users shouldn't assume anything 
         about this packet other than that it is a valid ethernet/IP/TCP frame.
         """
-        self.data = ""
+        self.buf = bytearray()
         self._make_ip_packet(dl_dst, dl_src, dl_vlan_enable, dl_vlan_type, 
                              dl_vlan, dl_vlan_pcp, dl_vlan_cfi, 
                              mpls_type, mpls_tags, 
                              ip_tos, ip_ttl, ip_src, ip_dst, socket.IPPROTO_TCP)
 
         # Add TCP header
-        self.data += struct.pack("!HHLLBBHHH",
+        self.buf += struct.pack("!HHLLBBHHH",
                                  tcp_sport,
                                  tcp_dport,
                                  1,     # tcp.seq
@@ -191,7 +367,7 @@ class Packet(object):
                                  )
 
         # Fill out packet
-        self.data += "D" * (pktlen - len(self.data))
+        self.buf += "D" * (pktlen - len(self.buf))
         return self
     
     def simple_icmp_packet(self,
@@ -232,7 +408,7 @@ class Packet(object):
         Generates a simple TCP request.  Users shouldn't assume anything 
         about this packet other than that it is a valid ethernet/IP/TCP frame.
         """
-        self.data = ""
+        self.buf = bytearray()
         self._make_ip_packet(dl_dst, dl_src, dl_vlan_enable, dl_vlan_type, 
                              dl_vlan, dl_vlan_pcp, dl_vlan_cfi, 
                              mpls_type, mpls_tags,
@@ -240,7 +416,7 @@ class Packet(object):
                               ip_ttl, ip_src, ip_dst, socket.IPPROTO_ICMP)
 
         # Add ICMP header
-        self.data += struct.pack("!BBHHH",
+        self.buf += struct.pack("!BBHHH",
                                  icmp_type,
                                  icmp_code,
                                  0,  # icmp.checksum
@@ -250,197 +426,266 @@ class Packet(object):
         Packet.icmp_counter += 1       
 
         # Fill out packet
-        self.data += "D" * (pktlen - len(self.data))
+        self.buf += "D" * (pktlen - len(self.buf))
 
         return self
 
     def _make_ip_packet(self, dl_dst, dl_src, dl_vlan_enable, dl_vlan_type, 
                           dl_vlan, dl_vlan_pcp, dl_vlan_cfi, mpls_type, mpls_tags,
                           ip_tos, ip_ttl, ip_src, ip_dst, ip_proto):
-        self.data = ""
+        self.buf = bytearray()
+        self.buf_shared = False
+        self.parsed = False
+        self.ip_csum_delta = 0
+        self.l4_csum_delta = 0
         addr = dl_dst.split(":")
         for byte in map(lambda z: int(z, 16), addr):
-            self.data += struct.pack("!B", byte)
+            self.buf += struct.pack("!B", byte)
         addr = dl_src.split(":")
         for byte in map(lambda z: int(z, 16), addr):
-            self.data += struct.pack("!B", byte)
+            self.buf += struct.pack("!B", byte)
 
         if (dl_vlan_enable):
             # Form and add VLAN tag
-            self.data += struct.pack("!H", dl_vlan_type)
+            self.buf += struct.pack("!H", dl_vlan_type)
             vtag = (dl_vlan & 0x0fff) | \
                             (dl_vlan_pcp & 0x7) << 13 | \
                             (dl_vlan_cfi & 0x1) << 12
-            self.data += struct.pack("!H", vtag)
+            self.buf += struct.pack("!H", vtag)
             
         if mpls_tags:
             # Add type/len field
-            self.data += struct.pack("!H", mpls_type)
+            self.buf += struct.pack("!H", mpls_type)
             mpls_tags = list(mpls_tags)          
             while len(mpls_tags):
                 tag = mpls_tags.pop(0)
                 packed_tag = tag.pack(bos = not len(mpls_tags))
-                self.data += struct.pack("!I", packed_tag)
+                self.buf += struct.pack("!I", packed_tag)
             
         else:
             # Add type/len field
-            self.data += struct.pack("!H", ETHERTYPE_IP)
+            self.buf += struct.pack("!H", ETHERTYPE_IP)
 
         # Add IP header
         v_and_hlen = 0x45  # assumes no ip or tcp options
         ip_len = 120 + 40  # assumes no ip or tcp options
-        self.data += struct.pack("!BBHHHBBH", v_and_hlen, ip_tos, ip_len, 
+        self.buf += struct.pack("!BBHHHBBH", v_and_hlen, ip_tos, ip_len, 
                                  0, # ip.id 
                                  0, # ip.frag_off
                                  ip_ttl, # ip.ttl
                                  ip_proto,
                                  0)  # ip.checksum
         # convert  ipsrc/dst to ints
-        self.data += struct.pack("!LL", ascii_ip_to_bin(ip_src), 
+        self.buf += struct.pack("!LL", ascii_ip_to_bin(ip_src), 
                                  ascii_ip_to_bin(ip_dst))
 
     def length(self):
-        return len(self.data)
+        return len(self.buf)
+
+    def clone(self):
+        """
+        Return a copy of the packet, e.g. for each bucket of a group
+
+        The two packets share the packet buffer until either one
+        rewrites it (copy on write).  The copy's action set is empty.
+        """
+        packet = Packet.__new__(Packet)
+        packet.__dict__.update(self.__dict__)
+        self.buf_shared = True
+        packet.buf_shared = True
+        packet.action_set = [None] * ACTION_SET_SLOTS
+        packet.action_set_bits = 0
+        return packet
+
+    def _unshare(self):
+        """ Give the packet its own copy of a buffer shared by clone() """
+        self.buf = bytearray(self.buf)
+        self.buf_shared = False
 
     def clear_actions(self):
-        self.action_set = {}
+        self.action_set = [None] * ACTION_SET_SLOTS
+        self.action_set_bits = 0
 
-    def parse(self):
+    def parse(self, layer=LAYER_L4):
         """
-        Update the headers in self.match based on self.data 
+        Update self.key based on self.buf 
         
         Parses the relevant header features out of the packet, using
-        the table outlined in the OF1.1 spec, Figure 4
+        the table outlined in the OF1.1 spec, Figure 4.  Only the
+        headers up to layer are decoded now.
         """
-        self.bytes = len(self.data)
-        self.match.in_port = self.in_port
-        self.match.type = ofp.OFPMT_STANDARD
-        self.match.length = ofp.OFPMT_STANDARD_LENGTH
-        self.match.wildcards = 0
-        self.match.nw_dst_mask = 0
-        self.match.nw_dst_mask = 0
-        self.match.dl_dst_mask = [ 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
-        self.match.dl_src_mask = [ 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
+        self.bytes = len(self.buf)
         self.mpls_tag_offset = None
         self.ip_header_offset = None
-        
-        idx = 0
+        self.tcp_header_offset = None
+        self.parsed = False
+        self.decoded = LAYER_NONE
+        self.parse_idx = 0
+        # Headers the new contents no longer have must not linger
+        self.key = PacketKey(self.key[:KEY_DL_DST] + 
+                             (0,) * (len(KEY_FIELDS) - KEY_DL_DST))
+        return self.decode(layer)
+
+    def decode(self, layer):
+        """
+        Decode the headers of the packet up to layer, continuing after
+        the last layer decoded
+
+        The header setters call this for the layer they change, so a
+        packet can be created decoding only what the flow tables match
+        on.
+        @param layer One of LAYER_L2, LAYER_L3 or LAYER_L4
+        @return self.key, or None if the packet could not be parsed
+        """
+        fields = list(self.key)
         try:
-            idx = self._parse_l2(idx)
-            
-            if self.match.dl_type == ETHERTYPE_IP:
-                self.ip_header_offset = idx 
-                idx = self._parse_ip(idx)
-                if self.match.nw_proto in [ socket.IPPROTO_TCP,
-                                            socket.IPPROTO_UDP,
-                                            socket.IPPROTO_ICMP]:
-                    self.tcp_header_offset = idx
-                    if self.match.nw_proto != socket.IPPROTO_ICMP:
-                        idx = self._parse_l4(idx)
-                    else:
-                        idx = self._parse_icmp(idx)
-            elif self.match.dl_type == ETHERTYPE_ARP:
-                self._parse_arp(idx)
+            if self.decoded < LAYER_L2 <= layer:
+                self.parse_idx = self._parse_l2(fields, 0)
+                self.decoded = LAYER_L2
+            if self.decoded < LAYER_L3 <= layer:
+                self.parse_idx = self._parse_l3(fields, self.parse_idx)
+                self.decoded = LAYER_L3
+            if self.decoded < LAYER_L4 <= layer:
+                self._parse_transport(fields)
+                self.decoded = LAYER_L4
         except (parse_error), e:
             self.logger.warn("Giving up on parsing packet, got %s" % 
                              (str(e)))
+            # Nothing more will decode
+            self.parsed = False
+            self.decoded = LAYER_L4
             return None
-        return self.match
+        finally:
+            # Keep what was decoded, even from a bad packet
+            self.key = PacketKey(fields)
+        self.parsed = True
+        return self.key
+
+    def _parse_l3(self, fields, idx):
+        """
+        Parse the headers following the decoded ethertype, which start
+        at self.buf[idx]
+        @param fields The list of key fields to fill in
+        """
+        dl_type = fields[KEY_DL_TYPE]
+        if dl_type == ETHERTYPE_IP:
+            self.ip_header_offset = idx 
+            idx = self._parse_ip(fields, idx)
+            if fields[KEY_NW_PROTO] in [ socket.IPPROTO_TCP,
+                                         socket.IPPROTO_UDP,
+                                         socket.IPPROTO_ICMP]:
+                self.tcp_header_offset = idx
+        elif dl_type == ETHERTYPE_ARP:
+            self._parse_arp(idx)
+        return idx
+
+    def _parse_transport(self, fields):
+        """
+        Parse the L4 header located by _parse_l3, if any
+        @param fields The list of key fields to fill in
+        """
+        if self.tcp_header_offset is None:
+            return
+        if fields[KEY_NW_PROTO] != socket.IPPROTO_ICMP:
+            self._parse_l4(fields, self.tcp_header_offset)
+        else:
+            self._parse_icmp(fields, self.tcp_header_offset)
 
     def _parse_arp(self, idx):
         # @todo Implement
         pass
 
-    def _parse_l2(self, idx):
+    def _parse_l2(self, fields, idx):
         """
         Parse Layer2 Headers of packet
         
         Parse ether src,dst,type (and vlan and QinQ headers if exists) from 
-        self.data starting at idx
+        self.buf starting at idx
+        @param fields The list of key fields to fill in
         """
         if self.bytes < 14 :
             raise parse_error("_parse_l2:: packet too shorter <14 bytes")
             
-        self.match.dl_dst = list(struct.unpack("!6B", self.data[idx:idx+6]))
-        self.match.dl_dst_mask = DL_MASK_ALL
-        idx += 6
-        self.match.dl_src = list(struct.unpack("!6B", self.data[idx:idx+6]))
-        self.match.dl_src_mask = DL_MASK_ALL
-        idx += 6
-        #pdb.set_trace()
-        l2_type = struct.unpack("!H", self.data[idx:idx+2])[0]
-        idx += 2
+        (dst_hi, dst_lo, src_hi, src_lo, l2_type) = \
+            _struct_eth.unpack_from(self.buf, idx)
+        fields[KEY_DL_DST] = (dst_hi << 32) | dst_lo
+        fields[KEY_DL_SRC] = (src_hi << 32) | src_lo
+        idx += 14
         if l2_type in [ETHERTYPE_VLAN, ETHERTYPE_VLAN_QinQ] :
             self.vlan_tag_offset = 12
-            blob = struct.unpack("!H", self.data[idx:idx+2])[0]
+            (blob, l2_type) = _struct_HH.unpack_from(self.buf, idx)
             idx += 2
-            self.match.dl_vlan_pcp = (blob & 0xe000) >> 13
+            fields[KEY_DL_VLAN_PCP] = (blob & 0xe000) >> 13
             #cfi = blob & 0x1000     #@todo figure out what to do if cfi!=0
-            self.match.dl_vlan = blob & 0x0fff
-            l2_type = struct.unpack("!H", self.data[idx:idx+2])[0]
+            fields[KEY_DL_VLAN] = blob & 0x0fff
             # now skip past any more nest VLAN tags (per the spec)
             while l2_type in [ETHERTYPE_VLAN, ETHERTYPE_VLAN_QinQ] :
                 idx += 4
                 if self.bytes < idx :
                     raise parse_error("_parse_l2(): Too many vlan tags")
-                l2_type = struct.unpack("!H", self.data[idx:idx+2])[0]
+                l2_type = _struct_H.unpack_from(self.buf, idx)[0]
             idx += 2
         else:
             self.vlan_tag_offset = None
-            self.match.dl_vlan = ofp.OFPVID_NONE
-            self.match.dl_vlan_pcp = 0
+            fields[KEY_DL_VLAN] = ofp.OFPVID_NONE
+            fields[KEY_DL_VLAN_PCP] = 0
             
         if l2_type in ETHERTYPES_MPLS:
-            if self.bytes < (idx + 4):
-                raise parse_error("_parse_l2:  Invalid MPLS header")
-            self.mpls_tag_offset = idx
-            tag = struct.unpack("!I", self.data[idx:idx+4])[0]
-            self.match.mpls_label = tag >> 12
-            self.match.mpls_tc = (tag >> 9) & 0x0007
-            idx += 4
+            idx = self._parse_mpls(fields, idx)
         else:
-            self.match.mpls_label = 0
-            self.match.mpls_tc = 0
+            fields[KEY_MPLS_LABEL] = 0
+            fields[KEY_MPLS_TC] = 0
             
-        self.match.dl_type = l2_type
+        fields[KEY_DL_TYPE] = l2_type
         return idx
+
+    def _parse_mpls(self, fields, idx):
+        """
+        Parse the outer MPLS tag of a packet starting at self.buf[idx]
+        @param fields The list of key fields to fill in
+        """
+        if self.bytes < (idx + 4):
+            raise parse_error("_parse_l2:  Invalid MPLS header")
+        self.mpls_tag_offset = idx
+        tag = _struct_L.unpack_from(self.buf, idx)[0]
+        fields[KEY_MPLS_LABEL] = tag >> 12
+        fields[KEY_MPLS_TC] = (tag >> 9) & 0x0007
+        return idx + 4
             
-    def _parse_ip(self, idx):
+    def _parse_ip(self, fields, idx):
         """
-        Parse IP Headers of a packet starting at self.data[idx]
+        Parse IP Headers of a packet starting at self.buf[idx]
+        @param fields The list of key fields to fill in
         """
         if self.bytes < (idx + 20) :
             raise parse_error("_parse_ip: Invalid IP header")
-        # the three blanks are id (2bytes), frag offset (2bytes), 
-        # and ttl (1byte)
-        (hlen_and_v, self.match.nw_tos, len, _,_,_, self.match.nw_proto) = \
-            struct.unpack("!BBHHHBB", self.data[idx:idx+10])
+        (hlen_and_v, fields[KEY_NW_TOS], fields[KEY_NW_PROTO],
+         fields[KEY_NW_SRC], fields[KEY_NW_DST]) = \
+            _struct_ip.unpack_from(self.buf, idx)
         #@todo add fragmentation parsing
         hlen = hlen_and_v & 0x0f
-        (self.match.nw_src, self.match.nw_dst) = \
-            struct.unpack("!II", self.data[idx + 12:idx+20])
-        self.match.nw_dst_mask = NW_MASK_ALL
-        self.match.nw_src_mask = NW_MASK_ALL
         return idx + (hlen *4) # this should correctly skip IP options
     
-    def _parse_l4(self, idx):
+    def _parse_l4(self, fields, idx):
         """
         Parse the src/dst ports of UDP and TCP packets
+        @param fields The list of key fields to fill in
         """
         if self.bytes < (idx + 8):
             raise parse_error("_parse_l4: Invalid L4 header")
-        (self.match.tp_src, self.match.tp_dst) = \
-            struct.unpack("!HH", self.data[idx:idx+4])
+        (fields[KEY_TP_SRC], fields[KEY_TP_DST]) = \
+            _struct_HH.unpack_from(self.buf, idx)
 
-    def _parse_icmp(self, idx):
+    def _parse_icmp(self, fields, idx):
         """
         Parse the type/code of ICMP Packets 
+        @param fields The list of key fields to fill in
         """
         if self.bytes < (idx + 4):
             raise parse_error("_parse_icmp: Invalid icmp header")
         # yes, type and code get stored into tp_dst and tp_src...
-        (self.match.tp_src, self.match.tp_dst) = \
-            struct.unpack("!BB", self.data[idx:idx+2])
+        (fields[KEY_TP_SRC], fields[KEY_TP_DST]) = \
+            _struct_BB.unpack_from(self.buf, idx)
 
 
     #
@@ -456,30 +701,31 @@ class Packet(object):
         instruction is executed.  We only record the actions for 
         later processing.  Because of this, the output port is not
         explicitly recorded in the packet; that state is recorded
-        in the action_set[set_output] item.
+        in the action_set slot of action_output.
+
+        The action set is a fixed array with one slot per action
+        type, indexed by ACTION_SET_ORDINAL; action_set_bits has
+        bit N set when slot N is occupied.
         """
-        self.action_set[action.__class__] = action
+        idx = ACTION_SET_ORDINAL[action.__class__]
+        self.action_set[idx] = action
+        self.action_set_bits |= 1 << idx
 
     def _set_1bytes(self,offset,byte):
-        """ Writes the byte at data[offset] 
-        
-        This function only exists to match the other _set_Xbytes() and
-        is trivial
-    
-        """
-        tmp= "%s%s" % (self.data[0:offset], 
-                               struct.pack('B',byte & 0xff))
-        if len(self.data) > offset + 1 :
-            tmp += self.data[offset+1:len(self.data)]
-        self.data=tmp
+        """ Writes the byte at data[offset] """
+        if offset + 1 > len(self.buf):
+            return
+        if self.buf_shared:
+            self._unshare()
+        self.buf[offset] = byte & 0xff
 
     def _set_2bytes(self,offset,short):
         """ Writes the 2 byte short in network byte order at data[offset] """
-        tmp= "%s%s" % (self.data[0:offset], 
-                               struct.pack('!H',short & 0xffff))
-        if len(self.data) > offset + 2 :
-            tmp += self.data[offset+2:len(self.data)]
-        self.data=tmp
+        if offset + 2 > len(self.buf):
+            return
+        if self.buf_shared:
+            self._unshare()
+        struct.pack_into('!H', self.buf, offset, short & 0xffff)
 
     def _set_4bytes(self,offset,word,forceNBO=True):
         """ Writes the 4 byte word at data[offset] 
@@ -489,58 +735,127 @@ class Packet(object):
         
         """
         # @todo Verify byte order
-        #pdb.set_trace()
-        fmt ="L"
+        if offset + 4 > len(self.buf):
+            return
+        if self.buf_shared:
+            self._unshare()
+        fmt = "=L"
         if forceNBO:
-            fmt = '!' + fmt 
-        
-        tmp= "%s%s" % (self.data[0:offset], 
-                               struct.pack(fmt,word & 0xffffffff))
-        if len(self.data) > offset + 4 :
-            tmp += self.data[offset+4:len(self.data)]
-        self.data=tmp
+            fmt = "!L"
+        struct.pack_into(fmt, self.buf, offset, word & 0xffffffff)
         
     def _set_6bytes(self,offset,byte_list):
         """ Writes the 6 byte sequence in the given order to data[offset] """
-        # @todo Do as a slice
-        tmp= self.data[0:offset] 
-        tmp += struct.pack("BBBBBB", *byte_list)
-        if len(self.data) > offset + 6 :
-            tmp += self.data[offset+6:len(self.data)]
-        self.data=tmp
+        if offset + 6 > len(self.buf):
+            return
+        if self.buf_shared:
+            self._unshare()
+        struct.pack_into("BBBBBB", self.buf, offset, *byte_list)
     
-    def _update_l4_checksum(self):
-        """ Recalculate the L4 checksum, if there
-        
-        Can be safely called on non-tcp/non-udp packets as a NOOP
-        """
-        if (self.ip_header_offset is None or 
-            self.tcp_header_offset is None):
+    #
+    # The _csum_set_Xbytes() functions write a header field like
+    # _set_Xbytes() and add the change they make to the sum of the
+    # header's 16 bit words to the pending IP (ip) and/or L4 (l4)
+    # checksum deltas.  2 and 4 byte fields are word aligned.
+    #
+
+    def _csum_note(self, delta, ip, l4):
+        if ip:
+            self.ip_csum_delta += delta
+        if l4:
+            self.l4_csum_delta += delta
+
+    def _csum_set_1bytes(self, start, offset, byte, ip, l4):
+        if self.buf_shared:
+            self._unshare()
+        buf = self.buf
+        if offset + 1 > len(buf):
             return
-        if self.match.nw_proto == socket.IPPROTO_TCP:
-            return self._update_tcp_checksum()
-        elif self.match.nw_proto == socket.IPPROTO_UDP:
-            return self._update_udp_checksum()
-        
-    def _update_tcp_checksum(self):
-        """ Recalculate the TCP checksum
-        
-        @warning:  Must only be called on actual TCP Packets
+        byte &= 0xff
+        delta = byte - buf[offset]
+        buf[offset] = byte
+        if not (offset - start) & 1:
+            delta <<= 8
+        self._csum_note(delta, ip, l4)
+
+    def _csum_set_2bytes(self, offset, short, ip, l4):
+        if self.buf_shared:
+            self._unshare()
+        buf = self.buf
+        if offset + 2 > len(buf):
+            return
+        short &= 0xffff
+        delta = short - _struct_H.unpack_from(buf, offset)[0]
+        _struct_H.pack_into(buf, offset, short)
+        self._csum_note(delta, ip, l4)
+
+    def _csum_set_4bytes(self, offset, word, ip, l4):
+        if self.buf_shared:
+            self._unshare()
+        buf = self.buf
+        if offset + 4 > len(buf):
+            return
+        word &= 0xffffffff
+        (hi, lo) = _struct_HH.unpack_from(buf, offset)
+        _struct_L.pack_into(buf, offset, word)
+        self._csum_note((word >> 16) + (word & 0xffff) - hi - lo, ip, l4)
+
+    def _csum_fold(self, offset, delta, udp=False):
+        """ Apply a change of delta in the words summed by the checksum
+        at data[offset]: HC' = ~(~HC + ~m + m'), RFC 1624 eqn. 3
+
+        A zero checksum is left alone: UDP uses it for 'no checksum',
+        and simple_tcp_packet() never computes any.
         """
-        #@todo implemnt tcp checksum update
-        pass
-    
-    def _update_udp_checksum(self):
-        """ Recalculate the TCP checksum
-        
-        @warning:  Must only be called on actual TCP Packets
+        if offset + 2 > len(self.buf):
+            return
+        csum = _struct_H.unpack_from(self.buf, offset)[0]
+        if csum == 0:
+            return
+        if self.buf_shared:
+            self._unshare()
+        # one's complement addition is addition modulo 0xffff; keep the
+        # sum in 1..0xffff as an end around carry sum would be
+        total = ((~csum & 0xffff) + delta - 1) % 0xffff + 1
+        csum = ~total & 0xffff
+        if udp and csum == 0:
+            csum = 0xffff
+        struct.pack_into('!H', self.buf, offset, csum)
+
+    def update_checksums(self):
+        """ Fold the header changes made since the last call into the
+        IP, TCP, UDP or ICMP checksums
+
+        The setters only record the difference they make to the
+        checksummed words; this is done once before the packet goes
+        out (reading self.data calls it).
         """
-        #@todo implemnt udp checksum update
-        pass
+        if self.ip_csum_delta and self.ip_header_offset is not None:
+            self._csum_fold(self.ip_header_offset + 10, self.ip_csum_delta)
+        if self.l4_csum_delta and self.tcp_header_offset is not None:
+            proto = self.key[KEY_NW_PROTO]
+            if proto == socket.IPPROTO_TCP:
+                self._csum_fold(self.tcp_header_offset + 16, 
+                                self.l4_csum_delta)
+            elif proto == socket.IPPROTO_UDP:
+                self._csum_fold(self.tcp_header_offset + 6, 
+                                self.l4_csum_delta, udp=True)
+            elif proto == socket.IPPROTO_ICMP:
+                self._csum_fold(self.tcp_header_offset + 2, 
+                                self.l4_csum_delta)
+        self.ip_csum_delta = 0
+        self.l4_csum_delta = 0
+
+    def _pseudo_header(self):
+        """ True if the L4 checksum covers the IP addresses """
+        return (self.tcp_header_offset is not None and
+                self.key[KEY_NW_PROTO] in [socket.IPPROTO_TCP, 
+                                        socket.IPPROTO_UDP])
 
     def set_metadata(self, value, mask):
-        self.match.metadata = (self.match.metadata & ~mask) | \
-            (value & mask)
+        metadata = self.key[KEY_METADATA]
+        self.key = self.key.derive(
+            (KEY_METADATA, (metadata & ~mask) | (value & mask)))
 
     #
     # These are the main action operations that take the 
@@ -553,178 +868,230 @@ class Packet(object):
         self.queue_id = queue_id
 
     def set_vlan_vid(self, vid):
+        if self.decoded < LAYER_L2:
+            self.decode(LAYER_L2)
         # @todo Verify proper location of VLAN id
         if self.vlan_tag_offset is None:
             self.logger.debug("set_vlan_vid(): Adding new vlan tag to untagged packet")
             self.push_vlan(ETHERTYPE_VLAN)
         offset = self.vlan_tag_offset + 2
-        short = struct.unpack('!H', self.data[offset:offset+2])[0]
+        short = _struct_H.unpack_from(self.buf, offset)[0]
         short = (short & 0xf000) | ((vid & 0x0fff) )
-        self.data = self.data[0:offset] + struct.pack('!H',short) + \
-                self.data[offset+2:len(self.data)]
-        self.match.dl_vlan = vid & 0x0fff
+        self._set_2bytes(offset, short)
+        self.key = self.key.derive((KEY_DL_VLAN, vid & 0x0fff))
         self.logger.debug("set_vlan_vid(): setting packet vlan_vid to 0x%x " % 
-                          self.match.dl_vlan)
+                          self.key[KEY_DL_VLAN])
 
     def set_vlan_pcp(self, pcp):
+        if self.decoded < LAYER_L2:
+            self.decode(LAYER_L2)
         # @todo Verify proper location of VLAN pcp
         if self.vlan_tag_offset is None:
             return
         offset = self.vlan_tag_offset + 2
-        short = struct.unpack('!H', self.data[offset:offset+2])[0]
+        short = _struct_H.unpack_from(self.buf, offset)[0]
         short = (pcp<<13 & 0xf000) | ((short & 0x0fff) )
-        self.data = self.data[0:offset] + struct.pack('!H',short) + \
-                self.data[offset+2:len(self.data)]
-        self.match.dl_vlan_pcp = pcp & 0xf
+        self._set_2bytes(offset, short)
+        self.key = self.key.derive((KEY_DL_VLAN_PCP, pcp & 0xf))
 
     def set_dl_src(self, dl_src):
         self._set_6bytes(6, dl_src)
-        self.match.dl_src = dl_src
+        self.key = self.key.derive((KEY_DL_SRC, _mac_to_int(dl_src)))
 
     def set_dl_dst(self, dl_dst):
         self._set_6bytes(0, dl_dst)
-        self.match.dl_dst = dl_dst
+        self.key = self.key.derive((KEY_DL_DST, _mac_to_int(dl_dst)))
         
     def set_nw_src(self, nw_src):
+        if self.decoded < LAYER_L3:
+            self.decode(LAYER_L3)
         if self.ip_header_offset is None:
             return
-        self._set_4bytes(self.ip_header_offset + 12, nw_src)
-        self._update_l4_checksum()
-        self.match.nw_src = nw_src
+        self._csum_set_4bytes(self.ip_header_offset + 12, nw_src,
+                              True, self._pseudo_header())
+        self.key = self.key.derive((KEY_NW_SRC, nw_src))
     
     def set_nw_dst(self, nw_dst):
+        if self.decoded < LAYER_L3:
+            self.decode(LAYER_L3)
         # @todo Verify byte order
         if self.ip_header_offset is None:
             return
-        self._set_4bytes(self.ip_header_offset + 16, nw_dst)
-        self._update_l4_checksum()
-        self.match.nw_dst = nw_dst
+        self._csum_set_4bytes(self.ip_header_offset + 16, nw_dst,
+                              True, self._pseudo_header())
+        self.key = self.key.derive((KEY_NW_DST, nw_dst))
 
     def set_nw_tos(self, tos):
+        if self.decoded < LAYER_L3:
+            self.decode(LAYER_L3)
         if self.ip_header_offset is None:
             return
-        self._set_1bytes(self.ip_header_offset + 1, tos)
-        self.match.nw_tos = tos
+        self._csum_set_1bytes(self.ip_header_offset, 
+                              self.ip_header_offset + 1, tos, True, False)
+        self.key = self.key.derive((KEY_NW_TOS, tos))
 
     def set_nw_ecn(self, ecn):
         #@todo look up ecn implementation details
         pass
 
     def set_tp_src(self, tp_src):
+        if self.decoded < LAYER_L4:
+            self.decode(LAYER_L4)
         if self.tcp_header_offset is None:
             return
-        if (self.match.nw_proto == socket.IPPROTO_TCP or
-            self.match.nw_proto == socket.IPPROTO_UDP): 
-            self._set_2bytes(self.tcp_header_offset, tp_src)
-        elif (self.match.nw_proto == socket.IPPROTO_ICMP):
-            self._set_1bytes(self.tcp_header_offset, tp_src)
-        self._update_l4_checksum()
-        self.match.tp_src = tp_src
+        nw_proto = self.key[KEY_NW_PROTO]
+        if (nw_proto == socket.IPPROTO_TCP or
+            nw_proto == socket.IPPROTO_UDP): 
+            self._csum_set_2bytes(self.tcp_header_offset, tp_src, False, True)
+        elif (nw_proto == socket.IPPROTO_ICMP):
+            self._csum_set_1bytes(self.tcp_header_offset, 
+                                  self.tcp_header_offset, tp_src, False, True)
+        self.key = self.key.derive((KEY_TP_SRC, tp_src))
             
     def set_tp_dst(self, tp_dst):
+        if self.decoded < LAYER_L4:
+            self.decode(LAYER_L4)
         if self.tcp_header_offset is None:
             return
-        if (self.match.nw_proto == socket.IPPROTO_TCP or
-            self.match.nw_proto == socket.IPPROTO_UDP): 
-            self._set_2bytes(self.tcp_header_offset +2, tp_dst)
-        elif (self.match.nw_proto == socket.IPPROTO_ICMP):
-            self._set_1bytes(self.tcp_header_offset + 1, tp_dst)
-        self._update_l4_checksum()
-        self.match.tp_dst = tp_dst
+        nw_proto = self.key[KEY_NW_PROTO]
+        if (nw_proto == socket.IPPROTO_TCP or
+            nw_proto == socket.IPPROTO_UDP): 
+            self._csum_set_2bytes(self.tcp_header_offset + 2, tp_dst, 
+                                  False, True)
+        elif (nw_proto == socket.IPPROTO_ICMP):
+            self._csum_set_1bytes(self.tcp_header_offset, 
+                                  self.tcp_header_offset + 1, tp_dst, 
+                                  False, True)
+        self.key = self.key.derive((KEY_TP_DST, tp_dst))
 
     IP_OFFSET_TTL = 8
     
     def copy_ttl_out(self):
+        if self.decoded < LAYER_L2:
+            self.decode(LAYER_L2)
         if self.mpls_tag_offset is None:
             # No MPLS tag.
             return
-        outerTag = struct.unpack("!I", self.data[self.mpls_tag_offset:
-                                                 self.mpls_tag_offset+4])[0]
+        outerTag = _struct_L.unpack_from(self.buf, self.mpls_tag_offset)[0]
         if not (outerTag & MPLS_BOTTOM_OF_STACK):
             # Payload is another MPLS tag:
-            innerTag = struct.unpack("!I", self.data[self.mpls_tag_offset+4:
-                                                     self.mpls_tag_offset+8])[0]
+            innerTag = _struct_L.unpack_from(self.buf, self.mpls_tag_offset+4)[0]
             outerTag = (outerTag & 0xFFFFFF00) | (innerTag & 0x000000FF)
             self._set_4bytes(self.mpls_tag_offset, outerTag)
         else:
             # This MPLS tag is the bottom of the stack.
             # See if the payload looks like it might be IPv4.
-            versionLen = struct.unpack("B", 
-                                       self.data[self.mpls_tag_offset+4])[0]
+            versionLen = self.buf[self.mpls_tag_offset+4]
             if versionLen >> 4 != 4:
                 # This is not IPv4.
                 return;
             # This looks like IPv4, so copy the TTL.
-            ipTTL = struct.unpack("B", self.data[self.mpls_tag_offset + 4 +
-                                                 Packet.IP_OFFSET_TTL])[0]
+            ipTTL = self.buf[self.mpls_tag_offset + 4 +
+                             Packet.IP_OFFSET_TTL]
             outerTag = (outerTag & 0xFFFFFF00) | (ipTTL & 0xFF)
             self._set_4bytes(self.mpls_tag_offset, outerTag)      
             return
 
     def copy_ttl_in(self):
+        if self.decoded < LAYER_L2:
+            self.decode(LAYER_L2)
         if self.mpls_tag_offset is None:
             # No MPLS tag.
             return
-        outerTag = struct.unpack("!I", self.data[self.mpls_tag_offset:
-                                                 self.mpls_tag_offset+4])[0]
+        outerTag = _struct_L.unpack_from(self.buf, self.mpls_tag_offset)[0]
         if not (outerTag & MPLS_BOTTOM_OF_STACK):
             # Payload is another MPLS tag:
-            innerTag = struct.unpack("!I", self.data[self.mpls_tag_offset+4:
-                                                     self.mpls_tag_offset+8])[0]
+            innerTag = _struct_L.unpack_from(self.buf, self.mpls_tag_offset+4)[0]
             innerTag = (innerTag & 0xFFFFFF00) | (outerTag & 0x000000FF)
             self._set_4bytes(self.mpls_tag_offset+4, innerTag)
         else:
             # This MPLS tag is the bottom of the stack.
             # See if the payload looks like it might be IPv4.
-            versionLen = struct.unpack("B", self.data[self.mpls_tag_offset+4])[0]
+            versionLen = self.buf[self.mpls_tag_offset+4]
             if versionLen >> 4 != 4:
                 # This is not IPv4.
                 return;
-            # This looks like IPv4, so copy the TTL.
-            self._set_1bytes(self.mpls_tag_offset + 4 + Packet.IP_OFFSET_TTL,
-                             outerTag & 0x000000FF) 
-            #@todo update checksum
+            # This looks like IPv4, so copy the TTL.  The IP header is
+            # not parsed under MPLS, so its checksum is fixed right away
+            ip = self.mpls_tag_offset + 4
+            if ip + Packet.IP_OFFSET_TTL >= len(self.buf):
+                return
+            ttl = outerTag & 0x000000FF
+            delta = (ttl - self.buf[ip + Packet.IP_OFFSET_TTL]) << 8
+            self._set_1bytes(ip + Packet.IP_OFFSET_TTL, ttl)
+            self._csum_fold(ip + 10, delta)
             return
 
     def set_mpls_label(self, mpls_label):
+        if self.decoded < LAYER_L2:
+            self.decode(LAYER_L2)
         if self.mpls_tag_offset is None:
             return
-        tag = struct.unpack("!I", self.data[self.mpls_tag_offset:
-                                            self.mpls_tag_offset+4])[0]
+        tag = _struct_L.unpack_from(self.buf, self.mpls_tag_offset)[0]
         tag = ((mpls_label & 0xfffff) << 12) | (tag & 0x00000fff)
-        self.match.mpls_label = mpls_label
+        self.key = self.key.derive((KEY_MPLS_LABEL, mpls_label))
         self._set_4bytes(self.mpls_tag_offset, tag)
 
     def set_mpls_tc(self, mpls_tc):
+        if self.decoded < LAYER_L2:
+            self.decode(LAYER_L2)
         if self.mpls_tag_offset is None:
             return
-        tag = struct.unpack("!I", self.data[self.mpls_tag_offset:
-                                            self.mpls_tag_offset+4])[0]
+        tag = _struct_L.unpack_from(self.buf, self.mpls_tag_offset)[0]
         tag = ((mpls_tc & 0x7) << 9) | (tag & 0xfffff1ff)
-        self.match.mpls_tc = mpls_tc
+        self.key = self.key.derive((KEY_MPLS_TC, mpls_tc))
         self._set_4bytes(self.mpls_tag_offset, tag)
 
     def set_mpls_ttl(self, ttl):
+        if self.decoded < LAYER_L2:
+            self.decode(LAYER_L2)
         if self.mpls_tag_offset is None:
             return   
         self._set_1bytes(self.mpls_tag_offset + 3, ttl)
 
     def dec_mpls_ttl(self):
+        if self.decoded < LAYER_L2:
+            self.decode(LAYER_L2)
         if self.mpls_tag_offset is None:
             return
-        ttl = struct.unpack("B", self.data[self.mpls_tag_offset + 3])[0]
+        ttl = self.buf[self.mpls_tag_offset + 3]
         self.set_mpls_ttl(ttl - 1)
 
+    def _shift_offsets(self, offset, delta):
+        """
+        Move the cached offsets of headers at or beyond offset by delta
+        bytes, after a tag was inserted into or removed from the packet
+        """
+        if self.mpls_tag_offset is not None and self.mpls_tag_offset >= offset:
+            self.mpls_tag_offset += delta
+        if self.ip_header_offset is not None and self.ip_header_offset >= offset:
+            self.ip_header_offset += delta
+        if (self.tcp_header_offset is not None and 
+            self.tcp_header_offset >= offset):
+            self.tcp_header_offset += delta
+        if self.parse_idx >= offset:
+            self.parse_idx += delta
+        self.bytes = len(self.buf)
+
+    #
+    # The tag operations below adjust the parsed state of the packet
+    # in place when its offsets are known to be valid (self.parsed).
+    # Anything unusual (a packet that did not parse, an ethertype of
+    # the wrong kind, MPLS under a VLAN tag) is spliced and reparsed.
+    #
+
     def push_vlan(self, ethertype):
+        if self.decoded < LAYER_L2:
+            self.decode(LAYER_L2)
         if len(self) < 14: 
             self.logger.error("NOT Pushing a new VLAN tag: packet too short!")
             pass    # invalid ethernet frame, can't add vlan tag
 
         # from 4.8.1 of the spec, default values are zero
         # on a push operation if no VLAN tag already exists
-        l2_type = struct.unpack("!H", self.data[12:14])[0]
+        l2_type = _struct_H.unpack_from(self.buf, 12)[0]
         if ((l2_type == ETHERTYPE_VLAN) or (l2_type == ETHERTYPE_VLAN_QinQ)):
-            current_tag = struct.unpack("!H", self.data[14:16])[0]
+            current_tag = _struct_H.unpack_from(self.buf, 14)[0]
         else:
             current_tag = 0
         new_tag = struct.pack('!HH',
@@ -733,62 +1100,144 @@ class Packet(object):
                                   ethertype & 0xffff,
                                   current_tag
                                   )
-        self.data = self.data[0:12] + new_tag + self.data[12:len(self.data)]  
-        self.parse()
+        if self.buf_shared:
+            self._unshare()
+        self.buf[12:12] = new_tag
+        if not (self.parsed and 
+                ethertype in [ETHERTYPE_VLAN, ETHERTYPE_VLAN_QinQ]):
+            self.parse(self.decoded)
+            return
+        self._shift_offsets(12, 4)
+        # The new outer tag carries the fields of the old one, if any
+        self.vlan_tag_offset = 12
+        self.key = self.key.derive(
+            (KEY_DL_VLAN_PCP, (current_tag & 0xe000) >> 13),
+            (KEY_DL_VLAN, current_tag & 0x0fff))
 
     def pop_vlan(self):
+        if self.decoded < LAYER_L2:
+            self.decode(LAYER_L2)
         if self.vlan_tag_offset is None:
             pass
-        self.data = self.data[0:12] + self.data[16:len(self.data)]
-        self.parse()
+        if self.buf_shared:
+            self._unshare()
+        del self.buf[12:16]
+        if not (self.parsed and self.vlan_tag_offset is not None):
+            self.parse(self.decoded)
+            return
+        self._shift_offsets(16, -4)
+        l2_type = _struct_H.unpack_from(self.buf, 12)[0]
+        if l2_type in [ETHERTYPE_VLAN, ETHERTYPE_VLAN_QinQ]:
+            blob = _struct_H.unpack_from(self.buf, 14)[0]
+            self.key = self.key.derive(
+                (KEY_DL_VLAN_PCP, (blob & 0xe000) >> 13),
+                (KEY_DL_VLAN, blob & 0x0fff))
+        else:
+            self.vlan_tag_offset = None
+            self.key = self.key.derive((KEY_DL_VLAN, ofp.OFPVID_NONE),
+                                       (KEY_DL_VLAN_PCP, 0))
 
     def push_mpls(self, ethertype):
+        if self.decoded < LAYER_L3:
+            self.decode(LAYER_L3)
         tag = MplsTag(0, 0, 0)
         bos = False
+        # The label stack hides the headers the pending deltas apply to
+        if self.ip_csum_delta or self.l4_csum_delta:
+            self.update_checksums()
         
         if self.mpls_tag_offset:
             # The new tag defaults to the old one.
-            packed_tag = struct.unpack("!I", self.data[self.mpls_tag_offset:
-                                                       self.mpls_tag_offset+4])[0]
+            packed_tag = _struct_L.unpack_from(self.buf,
+                                               self.mpls_tag_offset)[0]
             (tag, _) = MplsTag.unpack(packed_tag)
             
         else:
             # Pushing a new label stack, set the BoS bit and get TTL from IP.
             bos = True
             if self.ip_header_offset:
-                ttl = struct.unpack("B", self.data[self.ip_header_offset + \
-                                                       Packet.IP_OFFSET_TTL])[0]
+                ttl = self.buf[self.ip_header_offset + Packet.IP_OFFSET_TTL]
                 tag = MplsTag(0, 0, ttl)
                                                        
-        self.data = self.data[0:14] + \
-                    struct.pack("!I", tag.pack(bos)) + \
-                    self.data[14:]
+        packed_tag = tag.pack(bos)
+        if self.buf_shared:
+            self._unshare()
+        self.buf[14:14] = struct.pack("!I", packed_tag)
         self._set_2bytes(12, ethertype)   
-        # Reparse to update offsets, ethertype, etc.
-        self.parse()
+        if not (self.parsed and self.vlan_tag_offset is None and
+                ethertype in ETHERTYPES_MPLS):
+            # Reparse to update offsets, ethertype, etc.
+            self.parse(self.decoded)
+            return
+        # The label stack now hides the network header
+        self.bytes = len(self.buf)
+        self.mpls_tag_offset = 14
+        self.ip_header_offset = None
+        self.tcp_header_offset = None
+        self.key = self.key.derive(
+            (KEY_MPLS_LABEL, packed_tag >> 12),
+            (KEY_MPLS_TC, (packed_tag >> 9) & 0x0007),
+            (KEY_DL_TYPE, ethertype),
+            (KEY_NW_TOS, 0), (KEY_NW_PROTO, 0),
+            (KEY_NW_SRC, 0), (KEY_NW_DST, 0),
+            (KEY_TP_SRC, 0), (KEY_TP_DST, 0))
             
     def pop_mpls(self, ethertype):
+        if self.decoded < LAYER_L2:
+            self.decode(LAYER_L2)
         # Ignore if no existing tags.
         if self.mpls_tag_offset:
-            self.data = self.data[0:self.mpls_tag_offset] + \
-                        self.data[self.mpls_tag_offset + 4:]
+            offset = self.mpls_tag_offset
+            if self.buf_shared:
+                self._unshare()
+            del self.buf[offset:offset + 4]
             self._set_2bytes(12, ethertype)
-            
-            # Reparse to update offsets, ethertype, etc.
-            self.parse()
+            if not (self.parsed and self.vlan_tag_offset is None):
+                # Reparse to update offsets, ethertype, etc.
+                self.parse(self.decoded)
+                return
+            # Only the header exposed by the pop needs parsing
+            self.bytes = len(self.buf)
+            self.mpls_tag_offset = None
+            if ethertype in ETHERTYPES_MPLS:
+                fields = list(self.key)
+                try:
+                    self.parse_idx = self._parse_mpls(fields, offset)
+                except (parse_error), e:
+                    self.logger.warn("Giving up on parsing packet, got %s" % 
+                                     (str(e)))
+                    self.parsed = False
+                    self.decoded = LAYER_L4
+                    return
+                fields[KEY_DL_TYPE] = ethertype
+                self.key = PacketKey(fields)
+            else:
+                self.key = self.key.derive((KEY_MPLS_LABEL, 0),
+                                           (KEY_MPLS_TC, 0),
+                                           (KEY_DL_TYPE, ethertype))
+                self.parse_idx = offset
+            # Decode what the pop exposed as far as before
+            layer = self.decoded
+            self.decoded = LAYER_L2
+            self.decode(layer)
     
     def set_nw_ttl(self, ttl):
+        if self.decoded < LAYER_L3:
+            self.decode(LAYER_L3)
         if self.ip_header_offset is None:
             return
-        self._set_1bytes(self.ip_header_offset + Packet.IP_OFFSET_TTL, ttl)
-        self._update_l4_checksum()
-        # don't need to update self.match; no ttl in it
+        self._csum_set_1bytes(self.ip_header_offset,
+                              self.ip_header_offset + Packet.IP_OFFSET_TTL,
+                              ttl, True, False)
+        # don't need to update self.key; no ttl in it
 
     def dec_nw_ttl(self):
+        if self.decoded < LAYER_L3:
+            self.decode(LAYER_L3)
         if self.ip_header_offset is None:
             return
         offset = self.ip_header_offset + Packet.IP_OFFSET_TTL
-        old_ttl = struct.unpack("b",self.data[offset:offset + 1])[0]
+        old_ttl = struct.unpack_from("b", self.buf, offset)[0]
         self.set_nw_ttl( old_ttl - 1)
 
     #
@@ -797,20 +1246,27 @@ class Packet(object):
     #
 
     def action_output(self, action, switch):
-        if action.port < ofp.OFPP_MAX:
-            switch.dataplane.send(action.port, self.data, 
-                                  queue_id=self.queue_id)
-        elif action.port == ofp.OFPP_ALL:
-            for of_port in switch.ports.iterkeys():
-                if of_port != self.in_port: 
-                    switch.dataplane.send(of_port, self.data, 
-                                          queue_id=self.queue_id)
-        elif action.port == ofp.OFPP_IN_PORT:
-            switch.dataplane.send(self.in_port, self.data, 
-                                  queue_id=self.queue_id)
+        """
+        Send the packet; ALL, FLOOD and IN_PORT use the switch's
+        egress lists, which leave out OFPPC_NO_FWD ports
+        """
+        port = action.port
+        if port < ofp.OFPP_MAX:
+            if port in switch.fwd_ports:
+                switch.dataplane.send(port, self.data, 
+                                      queue_id=self.queue_id)
+        elif port == ofp.OFPP_ALL or port == ofp.OFPP_FLOOD:
+            ports = switch.flood_lists.get(self.in_port, switch.all_ports)
+            if ports:
+                switch.dataplane.send_multi(ports, self.data, 
+                                            queue_id=self.queue_id)
+        elif port == ofp.OFPP_IN_PORT:
+            if self.in_port in switch.fwd_ports:
+                switch.dataplane.send(self.in_port, self.data, 
+                                      queue_id=self.queue_id)
         else:
             switch.logger.error("NEED to implement action_output" + 
-                                " for port %d" % action.port)        
+                                " for port %d" % port)        
 
     def action_set_queue(self, action, switch):
         self.set_queue(action.queue_id)
@@ -885,128 +1341,75 @@ class Packet(object):
         self.dec_nw_ttl()
 
     def action_group(self, action, switch):
-        pass
+        switch.groups.group_execute(action.group_id, self, switch)
 
     def execute_action_set(self, switch):
         """
         Execute the actions in the action set for the packet
-        according to the order given in ordered_action_list.
+        according to the order given in ACTION_SET_ORDER.
 
-        This determines the order in which
-        actions in the packet's action set are executed
+        Only the occupied slots are visited, lowest ordinal first;
+        an empty action set returns immediately.
 
         @param switch The parent switch object (for sending pkts out)
 
         @todo Verify the ordering in this list
         """
-        cls = action.action_copy_ttl_in
-        if cls in self.action_set.keys():
-            self.logger.debug("Action copy_ttl_in")
-            self.action_copy_ttl_in(self.action_set[cls], switch)
-
-        cls = action.action_pop_mpls
-        if cls in self.action_set.keys():
-            self.logger.debug("Action pop_mpls")
-            self.action_pop_mpls(self.action_set[cls], switch)
-        cls = action.action_pop_vlan
-        if cls in self.action_set.keys():
-            self.logger.debug("Action pop_vlan")
-            self.action_pop_vlan(self.action_set[cls], switch)
-        cls = action.action_push_mpls
-        if cls in self.action_set.keys():
-            self.logger.debug("Action push_mpls")
-            self.action_push_mpls(self.action_set[cls], switch)
-        cls = action.action_push_vlan
-        if cls in self.action_set.keys():
-            self.logger.debug("Action push_vlan")
-            self.action_push_vlan(self.action_set[cls], switch)
-
-        cls = action.action_dec_mpls_ttl
-        if cls in self.action_set.keys():
-            self.logger.debug("Action dec_mpls_ttl")
-            self.action_dec_mpls_ttl(self.action_set[cls], switch)
-        cls = action.action_dec_nw_ttl
-        if cls in self.action_set.keys():
-            self.logger.debug("Action dec_nw_ttl")
-            self.action_dec_nw_ttl(self.action_set[cls], switch)
-        cls = action.action_copy_ttl_out
-        if cls in self.action_set.keys():
-            self.logger.debug("Action copy_ttl_out")
-            self.action_copy_ttl_out(self.action_set[cls], switch)
-
-        cls = action.action_set_dl_dst
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_dl_dst")
-            self.action_set_dl_dst(self.action_set[cls], switch)
-        cls = action.action_set_dl_src
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_dl_src")
-            self.action_set_dl_src(self.action_set[cls], switch)
-        cls = action.action_set_mpls_label
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_mpls_label")
-            self.action_set_mpls_label(self.action_set[cls], switch)
-        cls = action.action_set_mpls_tc
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_mpls_tc")
-            self.action_set_mpls_tc(self.action_set[cls], switch)
-        cls = action.action_set_mpls_ttl
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_mpls_ttl")
-            self.action_set_mpls_ttl(self.action_set[cls], switch)
-        cls = action.action_set_nw_dst
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_nw_dst")
-            self.action_set_nw_dst(self.action_set[cls], switch)
-        cls = action.action_set_nw_ecn
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_nw_ecn")
-            self.action_set_nw_ecn(self.action_set[cls], switch)
-        cls = action.action_set_nw_src
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_nw_src")
-            self.action_set_nw_src(self.action_set[cls], switch)
-        cls = action.action_set_nw_tos
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_nw_tos")
-            self.action_set_nw_tos(self.action_set[cls], switch)
-        cls = action.action_set_nw_ttl
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_nw_ttl")
-            self.action_set_nw_ttl(self.action_set[cls], switch)
-        cls = action.action_set_queue
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_queue")
-            self.action_set_queue(self.action_set[cls], switch)
-        cls = action.action_set_tp_dst
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_tp_dst")
-            self.action_set_tp_dst(self.action_set[cls], switch)
-        cls = action.action_set_tp_src
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_tp_src")
-            self.action_set_tp_src(self.action_set[cls], switch)
-        cls = action.action_set_vlan_pcp
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_vlan_pcp")
-            self.action_set_vlan_pcp(self.action_set[cls], switch)
-        cls = action.action_set_vlan_vid
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_vlan_vid")
-            self.action_set_vlan_vid(self.action_set[cls], switch)
-
-        cls = action.action_group
-        if cls in self.action_set.keys():
-            self.logger.debug("Action group")
-            self.action_group(self.action_set[cls], switch)
-        cls = action.action_experimenter
-        if cls in self.action_set.keys():
-            self.logger.debug("Action experimenter")
-            self.action_experimenter(self.action_set[cls], switch)
-        cls = action.action_output
-        if cls in self.action_set.keys():
-            self.logger.debug("Action set_output")
-            self.action_output(self.action_set[cls], switch)
+        bits = self.action_set_bits
+        if not bits:
+            return
+        if bits & ACTION_SET_GROUP_BIT:
+            # A group takes precedence over an output action
+            bits &= ~ACTION_SET_OUTPUT_BIT
+        slots = self.action_set
+        while bits:
+            low = bits & -bits
+            bits ^= low
+            idx = low.bit_length() - 1
+            self.logger.debug("Action %s", ACTION_SET_ORDER[idx][1])
+            _action_set_functions[idx](self, slots[idx], switch)
+
+# The order in which the actions of an action set are executed; the
+# position of an action class in this list is its slot in the action set
+ACTION_SET_ORDER = [
+    (action.action_copy_ttl_in, "copy_ttl_in"),
+
+    (action.action_pop_mpls, "pop_mpls"),
+    (action.action_pop_vlan, "pop_vlan"),
+    (action.action_push_mpls, "push_mpls"),
+    (action.action_push_vlan, "push_vlan"),
+
+    (action.action_dec_mpls_ttl, "dec_mpls_ttl"),
+    (action.action_dec_nw_ttl, "dec_nw_ttl"),
+    (action.action_copy_ttl_out, "copy_ttl_out"),
+
+    (action.action_set_dl_dst, "set_dl_dst"),
+    (action.action_set_dl_src, "set_dl_src"),
+    (action.action_set_mpls_label, "set_mpls_label"),
+    (action.action_set_mpls_tc, "set_mpls_tc"),
+    (action.action_set_mpls_ttl, "set_mpls_ttl"),
+    (action.action_set_nw_dst, "set_nw_dst"),
+    (action.action_set_nw_ecn, "set_nw_ecn"),
+    (action.action_set_nw_src, "set_nw_src"),
+    (action.action_set_nw_tos, "set_nw_tos"),
+    (action.action_set_nw_ttl, "set_nw_ttl"),
+    (action.action_set_queue, "set_queue"),
+    (action.action_set_tp_dst, "set_tp_dst"),
+    (action.action_set_tp_src, "set_tp_src"),
+    (action.action_set_vlan_pcp, "set_vlan_pcp"),
+    (action.action_set_vlan_vid, "set_vlan_vid"),
+
+    (action.action_group, "group"),
+    (action.action_experimenter, "experimenter"),
+    (action.action_output, "output"),
+]
+ACTION_SET_SLOTS = len(ACTION_SET_ORDER)
+ACTION_SET_ORDINAL = dict((cls, idx) for idx, (cls, name)
+                          in enumerate(ACTION_SET_ORDER))
+ACTION_SET_GROUP_BIT = 1 << ACTION_SET_ORDINAL[action.action_group]
+ACTION_SET_OUTPUT_BIT = 1 << ACTION_SET_ORDINAL[action.action_output]
+_action_set_functions = [getattr(Packet, "action_" + name)
+                         for cls, name in ACTION_SET_ORDER]
 
 
 def ascii_ip_to_bin(ip):
@@ -1262,6 +1665,20 @@ class vlan_mod(simple_tcp_test):
         self.pkt.set_vlan_vid(0xbabe)
         self.assertEqual(match.dl_vlan, 0x0abe)
 
+class match_view_test(simple_tcp_test):
+    """ A match held across rewrites reads the packet's current headers """
+    def runTest(self):
+        match = self.pkt.match
+        snapshot = match.snapshot()
+        self.pkt.set_nw_src(ascii_ip_to_bin('10.0.0.1'))
+        self.pkt.set_dl_dst([0x02, 0x00, 0x00, 0x00, 0x00, 0x01])
+        self.assertEqual(match.nw_src, ascii_ip_to_bin('10.0.0.1'))
+        self.assertEqual(match.dl_dst, [0x02, 0x00, 0x00, 0x00, 0x00, 0x01])
+        self.assertEqual(snapshot.nw_src, ascii_ip_to_bin('192.168.0.1'))
+        self.assertNotEqual(match, snapshot)
+        self.assertEqual(match, self.pkt.match.snapshot())
+        self.assertEqual(match.nw_src_mask, NW_MASK_ALL)
+
 class simple_tcp_with_mpls_test(unittest.TestCase):
     """ Make sure that simple_tcp_packet does what it should 
                           pktlen=100, 
@@ -1294,6 +1711,238 @@ class simple_tcp_with_mpls_test(unittest.TestCase):
         self.assertEqual(match.mpls_label, 0xabcde)
         self.assertEqual(match.mpls_tc, 0x5)
 
+class tag_test(unittest.TestCase):
+    """
+    Push and pop VLAN and MPLS tags, comparing the offsets and key the
+    operations leave behind with a fresh parse of the same bytes
+    """
+    def packet(self, layer=LAYER_L4, **kwargs):
+        data = Packet().simple_tcp_packet(**kwargs).data
+        return Packet(in_port=1, data=data, layer=layer)
+
+    def mpls_packet(self, n_tags, **kwargs):
+        tags = [MplsTag(0x10000 + i, i, 0x40 + i) for i in range(n_tags)]
+        return self.packet(mpls_type=ETHERTYPE_MPLS, mpls_tags=tags,
+                           **kwargs)
+
+    def check_reparse(self, pkt):
+        reparsed = Packet(in_port=pkt.in_port, data=pkt.data)
+        self.assertEqual(pkt.bytes, reparsed.bytes)
+        self.assertEqual(pkt.vlan_tag_offset, reparsed.vlan_tag_offset)
+        self.assertEqual(pkt.mpls_tag_offset, reparsed.mpls_tag_offset)
+        self.assertEqual(pkt.ip_header_offset, reparsed.ip_header_offset)
+        self.assertEqual(pkt.tcp_header_offset, reparsed.tcp_header_offset)
+        self.assertEqual(pkt.key, reparsed.key)
+
+    def runTest(self):
+        pkt = self.packet()
+        pkt.push_vlan(ETHERTYPE_VLAN)
+        self.check_reparse(pkt)
+        self.assertEqual(pkt.key.dl_vlan, 0)
+        pkt.set_vlan_vid(0x123)
+        pkt.pop_vlan()
+        self.check_reparse(pkt)
+        self.assertEqual(pkt.key.dl_vlan, ofp.OFPVID_NONE)
+
+class tag_qinq_test(tag_test):
+    def runTest(self):
+        pkt = self.packet(dl_vlan_enable=True, dl_vlan=0x123, dl_vlan_pcp=5)
+        pkt.push_vlan(ETHERTYPE_VLAN_QinQ)
+        self.check_reparse(pkt)
+        # The new outer tag starts as a copy of the inner one
+        self.assertEqual(pkt.key.dl_vlan, 0x123)
+        self.assertEqual(pkt.key.dl_vlan_pcp, 5)
+        pkt.set_vlan_vid(0x456)
+        self.check_reparse(pkt)
+        pkt.pop_vlan()
+        self.check_reparse(pkt)
+        self.assertEqual(pkt.key.dl_vlan, 0x123)
+        pkt.pop_vlan()
+        self.check_reparse(pkt)
+
+class tag_mpls_test(tag_test):
+    def runTest(self):
+        pkt = self.mpls_packet(2)
+        pkt.push_mpls(ETHERTYPE_MPLS)
+        self.check_reparse(pkt)
+        self.assertEqual(pkt.key.mpls_label, 0x10000)
+        pkt.set_mpls_label(0x20000)
+        for ethertype in [ETHERTYPE_MPLS, ETHERTYPE_MPLS, ETHERTYPE_IP]:
+            pkt.pop_mpls(ethertype)
+            self.check_reparse(pkt)
+        self.assertEqual(pkt.key.nw_src, ascii_ip_to_bin('192.168.0.1'))
+        self.assertEqual(pkt.key.tp_dst, 80)
+
+class tag_mixed_test(tag_test):
+    def runTest(self):
+        # VLAN tags over an MPLS label stack
+        pkt = self.mpls_packet(2)
+        pkt.push_vlan(ETHERTYPE_VLAN)
+        self.check_reparse(pkt)
+        pkt.push_vlan(ETHERTYPE_VLAN_QinQ)
+        self.check_reparse(pkt)
+        pkt.pop_mpls(ETHERTYPE_MPLS)
+        self.check_reparse(pkt)
+        pkt.pop_vlan()
+        self.check_reparse(pkt)
+        pkt.pop_vlan()
+        self.check_reparse(pkt)
+        pkt.pop_mpls(ETHERTYPE_IP)
+        self.check_reparse(pkt)
+        self.assertEqual(pkt.key.dl_type, ETHERTYPE_IP)
+
+class tag_push_mpls_test(tag_test):
+    def runTest(self):
+        # The label stack hides the IP and TCP headers from the key
+        pkt = self.packet(ip_tos=0x20)
+        pkt.push_mpls(ETHERTYPE_MPLS)
+        self.check_reparse(pkt)
+        self.assertEqual(pkt.key.nw_src, 0)
+        self.assertEqual(pkt.key.tp_dst, 0)
+        pkt.pop_mpls(ETHERTYPE_IP)
+        self.check_reparse(pkt)
+        # Under a VLAN tag push_mpls reparses
+        pkt = self.packet(dl_vlan_enable=True)
+        pkt.push_mpls(ETHERTYPE_MPLS)
+        self.check_reparse(pkt)
+
+class tag_lazy_test(tag_test):
+    def runTest(self):
+        # Only L2 decoded: the offsets of the layers decoded later
+        # must still come out right
+        pkt = self.packet(layer=LAYER_L2, dl_vlan_enable=True)
+        pkt.push_vlan(ETHERTYPE_VLAN_QinQ)
+        pkt.decode(LAYER_L4)
+        self.check_reparse(pkt)
+        pkt = self.mpls_packet(1, layer=LAYER_L2)
+        pkt.pop_mpls(ETHERTYPE_IP)
+        pkt.decode(LAYER_L4)
+        self.check_reparse(pkt)
+
+class checksum_test(unittest.TestCase):
+    """
+    Rewrite the checksummed header fields of a packet and compare the
+    incrementally maintained checksums with ones computed from scratch
+    """
+    L4_CSUM_OFFSET = {socket.IPPROTO_TCP : 16,
+                      socket.IPPROTO_UDP : 6,
+                      socket.IPPROTO_ICMP : 2}
+
+    def checksum(self, data):
+        if len(data) % 2:
+            data += "\0"
+        total = sum(struct.unpack("!%dH" % (len(data) / 2), data))
+        while total >> 16:
+            total = (total & 0xffff) + (total >> 16)
+        return ~total & 0xffff
+
+    def recompute(self, data, ip, proto):
+        """
+        Return data with the IP and L4 checksums computed from scratch
+        @param ip The offset of the IP header in data
+        @param proto The IP protocol of the L4 header following it
+        """
+        buf = bytearray(data)
+        hlen = (buf[ip] & 0x0f) * 4
+        struct.pack_into("!H", buf, ip + 10, 0)
+        struct.pack_into("!H", buf, ip + 10, 
+                         self.checksum(str(buf[ip:ip + hlen])))
+        l4 = ip + hlen
+        offset = l4 + self.L4_CSUM_OFFSET[proto]
+        if proto == socket.IPPROTO_UDP and buf[offset:offset + 2] == "\0\0":
+            # No checksum
+            return str(buf)
+        struct.pack_into("!H", buf, offset, 0)
+        segment = str(buf[l4:])
+        if proto != socket.IPPROTO_ICMP:
+            segment = (str(buf[ip + 12:ip + 20]) + 
+                       struct.pack("!BBH", 0, proto, len(segment)) + segment)
+        csum = self.checksum(segment)
+        if proto == socket.IPPROTO_UDP and csum == 0:
+            csum = 0xffff
+        struct.pack_into("!H", buf, offset, csum)
+        return str(buf)
+
+    def packet(self, proto, **kwargs):
+        """
+        Return a packet of the given IP protocol with valid checksums
+        """
+        if proto == socket.IPPROTO_ICMP:
+            pkt = Packet().simple_icmp_packet(**kwargs)
+        else:
+            pkt = Packet().simple_tcp_packet(**kwargs)
+        ip = Packet(data=pkt.data).ip_header_offset
+        buf = pkt.buf
+        if proto == socket.IPPROTO_UDP:
+            buf[ip + 9] = proto
+            struct.pack_into("!HHHH", buf, ip + 20, 1234, 80, 
+                             len(buf) - ip - 20, 0)
+        return Packet(in_port=1, data=self.recompute(str(buf), ip, proto))
+
+    def rewrite(self, pkt):
+        pkt.set_nw_src(ascii_ip_to_bin('10.1.2.3'))
+        pkt.set_nw_dst(ascii_ip_to_bin('172.31.254.1'))
+        pkt.set_nw_tos(0xb8)
+        pkt.dec_nw_ttl()
+        if pkt.key.nw_proto == socket.IPPROTO_ICMP:
+            pkt.set_tp_src(0)
+            pkt.set_tp_dst(3)
+        else:
+            pkt.set_tp_src(0xfffe)
+            pkt.set_tp_dst(443)
+
+    def check_checksums(self, pkt, proto):
+        data = pkt.data
+        ip = pkt.ip_header_offset
+        self.assertEqual(data, self.recompute(data, ip, proto))
+
+    def runTest(self):
+        for proto in [socket.IPPROTO_TCP, socket.IPPROTO_UDP, 
+                      socket.IPPROTO_ICMP]:
+            pkt = self.packet(proto, ip_tos=0x10, ip_ttl=65)
+            self.rewrite(pkt)
+            self.check_checksums(pkt, proto)
+            # Again after the pending changes were folded in
+            pkt.set_nw_ttl(1)
+            pkt.set_nw_src(0)
+            self.check_checksums(pkt, proto)
+
+class checksum_vlan_test(checksum_test):
+    def runTest(self):
+        pkt = self.packet(socket.IPPROTO_TCP, dl_vlan_enable=True)
+        pkt.set_nw_dst(ascii_ip_to_bin('1.1.1.1'))
+        pkt.pop_vlan()
+        self.rewrite(pkt)
+        pkt.push_vlan(ETHERTYPE_VLAN)
+        self.check_checksums(pkt, socket.IPPROTO_TCP)
+
+class checksum_udp_zero_test(checksum_test):
+    def runTest(self):
+        pkt = self.packet(socket.IPPROTO_UDP)
+        struct.pack_into("!H", pkt.buf, pkt.tcp_header_offset + 6, 0)
+        self.rewrite(pkt)
+        self.check_checksums(pkt, socket.IPPROTO_UDP)
+        self.assertEqual(pkt.data[pkt.tcp_header_offset + 6:
+                                  pkt.tcp_header_offset + 8], "\0\0")
+
+class checksum_mpls_test(checksum_test):
+    def runTest(self):
+        # A pending change is folded in before the label stack hides
+        # the IP header
+        pkt = self.packet(socket.IPPROTO_TCP, ip_ttl=64)
+        self.rewrite(pkt)
+        pkt.push_mpls(ETHERTYPE_MPLS)
+        pkt.set_mpls_ttl(0x20)
+        # copy_ttl_in fixes the IP checksum under the label at once
+        pkt.copy_ttl_in()
+        ip = pkt.mpls_tag_offset + 4
+        data = pkt.data
+        self.assertEqual(ord(data[ip + Packet.IP_OFFSET_TTL]), 0x20)
+        self.assertEqual(data, self.recompute(data, ip, socket.IPPROTO_TCP))
+        pkt.pop_mpls(ETHERTYPE_IP)
+        pkt.set_tp_dst(8080)
+        self.check_checksums(pkt, socket.IPPROTO_TCP)
+
 if __name__ == '__main__':
     print("Running packet tests\n")
     unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+######################################################################
+#
+# All files associated with the OpenFlow Python Test (oftest) are
+# made available for public use and benefit with the expectation
+# that others will use, modify and enhance the Software and contribute
+# those enhancements back to the community. However, since we would
+# like to make the Software available for broadest use, with as few
+# restrictions as possible permission is hereby granted, free of
+# charge, to any person obtaining a copy of this Software to deal in
+# the Software under the copyrights without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject
+# to the following conditions:
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT.  IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+######################################################################
+
+"""
+Micro-benchmark of packet header decoding
+
+Times decoding a corpus of typical frames (plain ethernet, VLAN,
+QinQ, MPLS, TCP, UDP and ICMP) into Packet objects, to each header
+layer, and building a match structure from the decoded headers.
+
+Usage: packet_bench.py [packets per measurement]
+"""
+
+import sys
+import socket
+import struct
+import logging
+import timeit
+
+from oftest.packet import Packet
+from oftest.packet import MplsTag
+from oftest.packet import ETHERTYPE_ARP
+from oftest.packet import ETHERTYPE_MPLS
+from oftest.packet import ETHERTYPE_VLAN_QinQ
+from oftest.packet import LAYER_NONE, LAYER_L2, LAYER_L3, LAYER_L4
+
+DEFAULT_COUNT = 20000
+
+def frame_corpus():
+    """
+    Return a list of (name, frame data) pairs of typical frames
+    """
+    corpus = []
+
+    data = bytearray(Packet().simple_tcp_packet().data)
+    data[12:14] = struct.pack("!H", ETHERTYPE_ARP)
+    corpus.append(("plain", str(data)))
+
+    corpus.append(("tcp", Packet().simple_tcp_packet().data))
+
+    data = bytearray(Packet().simple_tcp_packet().data)
+    data[23] = socket.IPPROTO_UDP
+    corpus.append(("udp", str(data)))
+
+    corpus.append(("icmp", Packet().simple_icmp_packet().data))
+
+    corpus.append(("vlan", Packet().simple_tcp_packet(dl_vlan_enable=True,
+                                                      dl_vlan=10).data))
+
+    pkt = Packet(data=Packet().simple_tcp_packet(dl_vlan_enable=True,
+                                                 dl_vlan=10).data)
+    pkt.push_vlan(ETHERTYPE_VLAN_QinQ)
+    corpus.append(("qinq", pkt.data))
+
+    tags = [MplsTag(0x12345, 3, 64), MplsTag(0x6789a, 0, 64)]
+    corpus.append(("mpls", Packet().simple_tcp_packet(mpls_type=ETHERTYPE_MPLS,
+                                                      mpls_tags=tags).data))
+    return corpus
+
+def time_per_packet(func, count):
+    """
+    Return the microseconds per call of func, best of three runs
+    """
+    return min(timeit.repeat(func, number=count, repeat=3)) / count * 1e6
+
+def run(count=DEFAULT_COUNT):
+    layers = [("none", LAYER_NONE), ("l2", LAYER_L2), ("l3", LAYER_L3),
+              ("l4", LAYER_L4)]
+    print "usec/packet %8s" % "frame" + \
+        "".join(["%9s" % name for (name, _) in layers]) + "%9s" % "match"
+    for (name, data) in frame_corpus():
+        row = []
+        for (_, layer) in layers:
+            row.append(time_per_packet(
+                    lambda: Packet(in_port=1, data=data, layer=layer), count))
+        pkt = Packet(in_port=1, data=data)
+        row.append(time_per_packet(lambda: pkt.match, count))
+        print "            %8s" % name + "".join(["%9.2f" % t for t in row])
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    if len(sys.argv) > 1:
+        run(int(sys.argv[1]))
+    else:
+        run()